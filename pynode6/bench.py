@@ -0,0 +1,1050 @@
+import argparse
+import array
+import contextlib
+import io
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import timeit
+
+import main
+
+def generate_source(path, size_mb):
+    line_no = 0
+    target = size_mb * 1024 * 1024
+    with open(path, 'w') as file:
+        while file.tell() < target:
+            chunk = ''.join(f'let x{n} = {n};\nprint x{n};\n' for n in range(line_no, line_no + 10_000))
+            file.write(chunk)
+            line_no += 10_000
+    return path
+
+def generate_program(path, size_mb):
+    # Mixed top-level statements with nested blocks, strings and comments
+    line_no = 0
+    target = size_mb * 1024 * 1024
+    with open(path, 'w') as file:
+        while file.tell() < target:
+            chunk = ''.join(
+                f'let x{n} = {n};\n'
+                f'print "value {{ {n}";  // comment {{\n'
+                f'for i in arr {{\n    if i {{\n        print i;\n    }}\n}}\n'
+                for n in range(line_no, line_no + 1_000))
+            file.write(chunk)
+            line_no += 1_000
+    return path
+
+def generate_records(path, size_mb):
+    # CSV data, ~100 bytes per line: id, a small number, padding
+    line_no = 0
+    target = size_mb * 1024 * 1024
+    padding = 'x' * 80
+    with open(path, 'w') as file:
+        while file.tell() < target:
+            file.write(''.join(f'{n},{n % 1000},{padding}\n' for n in range(line_no, line_no + 100_000)))
+            line_no += 100_000
+    return path
+
+def measure_load(path, mode):
+    # Runs in a fresh process so ru_maxrss reflects only this load
+    start = time.perf_counter()
+    if mode == 'read':
+        with open(path, 'r', buffering=1) as file:
+            code = file.read()
+    else:
+        code = main.load_source(path)
+    loaded = time.perf_counter()
+    count = sum(1 for _ in main.Lexer(code).tokens)
+    lexed = time.perf_counter()
+    return {
+        'mode': mode,
+        'load_s': round(loaded - start, 3),
+        'lex_s': round(lexed - loaded, 3),
+        'tokens': count,
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+
+def bench_load(sizes):
+    with tempfile.TemporaryDirectory() as tmp:
+        for size_mb in sizes:
+            path = generate_source(os.path.join(tmp, f'{size_mb}mb.pn'), size_mb)
+            for mode in ('read', 'mmap'):
+                out = subprocess.run([sys.executable, __file__, '_load', path, mode],
+                                     capture_output=True, text=True, check=True).stdout
+                print(json.dumps({'size_mb': size_mb, **json.loads(out)}))
+
+def bench_parse(size_mb, workers):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = generate_program(os.path.join(tmp, 'program.pn'), size_mb)
+        for count in workers:
+            start = time.perf_counter()
+            nodes = len(main.parse_parallel(path, count))
+            elapsed = time.perf_counter() - start
+            print(json.dumps({'size_mb': size_mb, 'workers': count, 'nodes': nodes,
+                              'parse_s': round(elapsed, 3), 'mb_per_s': round(size_mb / elapsed, 2)}))
+
+def bench_rerun(lines, repeat=5):
+    # Full parse versus IncrementalParser re-run after a one-line edit in the middle
+    lines = max(7, lines - lines % 7)  # generate_program writes 7-line groups; a cut inside one leaves a block open
+    with tempfile.TemporaryDirectory() as tmp:
+        path = generate_program(os.path.join(tmp, 'program.pn'), 1)
+        with open(path) as file:
+            source = ''.join(file.readlines()[:lines])
+    edited = source.splitlines(keepends=True)
+    middle = len(edited) // 2
+    middle -= middle % 7  # the `let` that starts a group
+    edited[middle] = edited[middle].replace(' = ', ' = 1', 1)
+    edited = ''.join(edited)
+
+    def full():
+        lexer = main.Lexer(edited)
+        return main.Parser(lexer.tokens, lexer).parse()
+
+    incremental = main.IncrementalParser()
+    first = time.perf_counter()
+    incremental.parse(source)
+    first = time.perf_counter() - first
+    full_s = min(timeit.repeat(full, number=1, repeat=repeat))
+    rerun_s = min(timeit.repeat(lambda: (incremental.parse(edited), incremental.parse(source)),
+                                number=1, repeat=repeat)) / 2
+    assert incremental.parse(edited) == full()
+    print(json.dumps({'lines': lines, 'full_parse_s': round(full_s, 4), 'first_run_s': round(first, 4),
+                      'rerun_s': round(rerun_s, 4), 'reparsed_statements': incremental.reparsed}))
+
+def bench_batch(count, workers):
+    with tempfile.TemporaryDirectory() as tmp:
+        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sample.pn')) as file:
+            sample = file.read()
+        for n in range(count):
+            with open(os.path.join(tmp, f'script{n}.pn'), 'w') as file:
+                file.write(sample)
+        files = main.expand_targets([tmp])
+        for count_workers in [1] + workers:
+            start = time.perf_counter()
+            results = main.run_batch(files, count_workers)
+            elapsed = time.perf_counter() - start
+            print(json.dumps({'scripts': len(files), 'workers': count_workers, 'wall_s': round(elapsed, 3),
+                              'failed': sum(1 for result in results if result['exit_code'])}))
+
+def bench_arith(iterations):
+    # The loop statement body is compiled once; the driver stands in for the loop back-edge
+    source = 'let acc = acc + i * 3 % 7 - i % 5;\nlet t = acc - i;\n'
+    for fast_paths in (False, True):
+        lexer = main.Lexer(source)
+        interpreter = main.Interpreter(main.Parser(lexer.tokens, lexer).parse(), fast_paths)
+        variables = interpreter.memory.variables
+        variables['acc'] = 0
+        steps = [step for _, step in interpreter.compiler.compile(interpreter.ast)]
+        start = time.perf_counter()
+        for i in range(iterations):
+            variables['i'] = i
+            for step in steps:
+                step()
+        elapsed = time.perf_counter() - start
+        print(json.dumps({'iterations': iterations, 'fast_paths': fast_paths, 'seconds': round(elapsed, 3),
+                          'ns_per_iteration': round(elapsed / iterations * 1e9, 1), 'acc': variables['acc']}))
+
+def bench_concat(sizes, naive_sizes):
+    # `s = s + "piece"` repeated; the final print flattens the string once
+    lexer = main.Lexer('let s = "";\ns = s + "piece" + 1;\nlet text = s;\n')
+    ast = main.Parser(lexer.tokens, lexer).parse()
+    for builders, counts in ((True, sizes), (False, naive_sizes)):
+        for count in counts:
+            interpreter = main.Interpreter(ast)
+            interpreter.compiler.string_builders = builders
+            (_, init), (_, append), (_, read) = interpreter.compiler.compile(ast)
+            start = time.perf_counter()
+            init()
+            for _ in range(count):
+                append()
+            read()
+            elapsed = time.perf_counter() - start
+            assert len(interpreter.memory.variables['text']) == count * 6
+            print(json.dumps({'pieces': count, 'builders': builders, 'seconds': round(elapsed, 3),
+                              'ns_per_piece': round(elapsed / count * 1e9, 1)}))
+
+def bench_switch(cases, dispatches):
+    source = 'switch (x) {\n' + ''.join(f'    case {n}:\n        r = {n} * 2;\n        break;\n'
+                                         for n in range(cases)) + '    default:\n        r = -1;\n}\n'
+    lexer = main.Lexer(source)
+    ast = main.Parser(lexer.tokens, lexer).parse()
+    keys = [(n * 7919) % (cases + 10) for n in range(dispatches)]  # spread over the cases, some misses
+    for jump_tables in (False, True):
+        interpreter = main.Interpreter(ast)
+        interpreter.compiler.jump_tables = jump_tables
+        (_, switch), = interpreter.compiler.compile(ast)
+        variables = interpreter.memory.variables
+        start = time.perf_counter()
+        for key in keys:
+            variables['x'] = key
+            switch()
+        elapsed = time.perf_counter() - start
+        print(json.dumps({'cases': cases, 'dispatches': dispatches, 'jump_table': jump_tables,
+                          'seconds': round(elapsed, 3), 'us_per_dispatch': round(elapsed / dispatches * 1e6, 2)}))
+
+def nested_loops_source(outer, inner):
+    # Nested counted loops; `scale * 3 + offset` is invariant in both loops
+    return f"""
+let scale = 7;
+let offset = 2;
+let total = 0;
+let i = 0;
+while (i < {outer}) {{
+    let j = 0;
+    while (j < {inner}) {{
+        total = total + scale * 3 + offset;
+        j = j + 1;
+    }}
+    i = i + 1;
+}}
+"""
+
+def bench_loops(outer, inner):
+    source = nested_loops_source(outer, inner)
+    lexer = main.Lexer(source)
+    ast = main.Parser(lexer.tokens, lexer).parse()
+    for optimize in (False, True):
+        interpreter = main.Interpreter(ast)
+        interpreter.compiler.loop_optimizations = optimize
+        start = time.perf_counter()
+        interpreter.interpret()
+        elapsed = time.perf_counter() - start
+        print(json.dumps({'iterations': outer * inner, 'loop_optimizations': optimize,
+                          'seconds': round(elapsed, 3), 'total': interpreter.memory.variables['total']}))
+
+def bench_for(iterations):
+    # The collection is bound from Python; the body is compiled once and run per item
+    source = """
+let evens = 0;
+let total = 0;
+let text = "";
+for item in data {
+    let doubled = item * 2;
+    if item % 2 == 0 {
+        evens = evens + 1;
+    } else {
+        total = total + doubled;
+    }
+    let last = `item ${item}`;
+}
+"""
+    lexer = main.Lexer(source)
+    ast = main.Parser(lexer.tokens, lexer).parse()
+    interpreter = main.Interpreter(ast)
+    interpreter.memory.variables['data'] = list(range(iterations))
+    start = time.perf_counter()
+    interpreter.interpret()
+    elapsed = time.perf_counter() - start
+    print(json.dumps({'iterations': iterations, 'seconds': round(elapsed, 3),
+                      'ns_per_iteration': round(elapsed / iterations * 1e9, 1),
+                      'evens': interpreter.memory.variables['evens']}))
+
+def bench_types(iterations):
+    # Share of binary operations compiled without type guards, and the run time with
+    # and without the inference pass
+    loop = f"""
+let acc = 0;
+let scale = 3;
+let label = "n";
+let i = 0;
+while (i < {iterations}) {{
+    acc = acc + i * scale % 7 - i % 5;
+    if (acc > 100000) {{
+        acc = acc - 100000;
+    }}
+    let text = label + i;
+    i = i + 1;
+}}
+"""
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sample.pn')) as file:
+        sample = file.read()
+    for name, source in (('sample.pn', sample), ('loops', nested_loops_source(100, iterations // 100)), ('loop', loop)):
+        lexer = main.Lexer(source)
+        ast = main.Parser(lexer.tokens, lexer).parse()
+        for specialize in (False, True):
+            interpreter = main.Interpreter(ast)
+            interpreter.compiler.type_specialization = specialize
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                interpreter.interpret()
+            elapsed = time.perf_counter() - start
+            counts = interpreter.compiler.operation_counts
+            total = sum(counts.values())
+            print(json.dumps({'program': name, 'type_specialization': specialize, **counts,
+                              'specialized_fraction': round((total - counts['guarded']) / total, 3) if total else None,
+                              'seconds': round(elapsed, 3)}))
+
+def bench_trace(sizes):
+    # Hot loops with and without tracing; small sizes show the warm-up cost (interpreted
+    # iterations before the threshold plus building the trace), large ones the steady state
+    source = """
+let total = 0;
+let text = "";
+let i = 0;
+while (i < n) {
+    let doubled = i * 2;
+    if doubled % 3 == 0 {
+        total = total + doubled;
+    } else {
+        total = total - 1;
+    }
+    text = `${i}`;
+    i = i + 1;
+}
+"""
+    lexer = main.Lexer(source)
+    ast = main.Parser(lexer.tokens, lexer).parse()
+    for size in sizes:
+        for tracing in (False, True):
+            interpreter = main.Interpreter(ast, tracing=tracing)
+            interpreter.memory.variables['n'] = size
+            start = time.perf_counter()
+            interpreter.interpret()
+            elapsed = time.perf_counter() - start
+            print(json.dumps({'iterations': size, 'tracing': tracing, 'seconds': round(elapsed, 4),
+                              'ns_per_iteration': round(elapsed / size * 1e9, 1),
+                              'trace_compile_s': round(sum(tracer.compile_seconds
+                                                           for tracer in interpreter.compiler.tracers), 5),
+                              'total': interpreter.memory.variables['total']}))
+
+def generate_modules(directory, count):
+    # Modules in import chains of 10, each with a few definitions, a loop and a switch;
+    # main.pn imports every one of them
+    for n in range(count):
+        with open(os.path.join(directory, f'm{n}.pn'), 'w') as file:
+            if n % 10:
+                file.write(f'import "m{n - 1}.pn";\n')
+            file.write(f"""let scale{n} = {n} + 1;
+let label{n} = "module {n}";
+let apply{n} = x => x * scale{n} + {n};
+let table{n} = range(20).map(i => i * scale{n});
+let total{n} = 0;
+for item in table{n} {{
+    if item % 3 == 0 {{
+        total{n} = total{n} + item;
+    }} else {{
+        total{n} = total{n} - 1;
+    }}
+}}
+switch {n} % 4 {{
+    case 0:
+        label{n} = label{n} + " even";
+        break;
+    default:
+        label{n} = `${{label{n}}} other`;
+}}
+""")
+    with open(os.path.join(directory, 'main.pn'), 'w') as file:
+        file.write(''.join(f'import "m{n}.pn";\n' for n in range(count)))
+        file.write(f'print apply{count - 1}(2);\n')
+    return os.path.join(directory, 'main.pn')
+
+def measure_imports(path):
+    # Runs in a fresh process, so the first run compiles every module
+    source = open(path).read()
+
+    def run():
+        start = time.perf_counter()
+        lexer = main.Lexer(source)
+        interpreter = main.Interpreter(main.Parser(lexer.tokens, lexer).parse(), file_name=path)
+        with contextlib.redirect_stdout(io.StringIO()):
+            interpreter.interpret()
+        return round(time.perf_counter() - start, 4)
+
+    directory = os.path.dirname(path)
+    results = {'cold_s': run(), 'warm_s': min(run() for _ in range(5))}
+    for name in os.listdir(directory):
+        os.utime(os.path.join(directory, name))
+    results['touched_s'] = run()  # every file is hashed again, nothing recompiled
+    with open(os.path.join(directory, 'm9.pn'), 'a') as file:
+        file.write('let edited = 1;\n')
+    results['one_edit_s'] = run()  # m9.pn recompiled; it is the end of its chain
+    return results
+
+def bench_imports(count):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = generate_modules(tmp, count)
+        out = subprocess.run([sys.executable, __file__, '_imports', path],
+                             capture_output=True, text=True, check=True).stdout
+        print(json.dumps({'modules': count, **json.loads(out)}))
+
+BUILTIN_TASKS = (
+    ('sum', "let result = sum(data);", """
+let result = 0;
+for item in data {
+    result = result + item;
+}
+"""),
+    ('max', "let result = max(data);", """
+let result = data[0];
+for item in data {
+    if item > result {
+        result = item;
+    }
+}
+"""),
+    ('join', 'let result = join(data, ",");', """
+let result = "";
+let first = true;
+for item in data {
+    if first {
+        result = `${item}`;
+        first = false;
+    } else {
+        result = result + "," + item;
+    }
+}
+"""),
+    ('sum_range', "let result = sum(range(n));", """
+let result = 0;
+let i = 0;
+while i < n {
+    result = result + i;
+    i = i + 1;
+}
+"""),
+)
+
+def bench_builtins(size):
+    # Each builtin against the loop a program would otherwise write; both run with the
+    # default compiler settings (the loops are traced once hot)
+    for name, builtin, loop in BUILTIN_TASKS:
+        results = {}
+        for mode, source in (('builtin', builtin), ('loop', loop)):
+            lexer = main.Lexer(source)
+            ast = main.Parser(lexer.tokens, lexer).parse()
+            interpreter = main.Interpreter(ast)
+            interpreter.memory.variables.update(data=list(range(size)), n=size)
+            start = time.perf_counter()
+            interpreter.interpret()
+            results[mode] = time.perf_counter() - start
+            results[mode + '_result'] = interpreter.memory.variables['result']
+        assert results['builtin_result'] == results['loop_result'], name
+        print(json.dumps({'task': name, 'elements': size, 'builtin_s': round(results['builtin'], 4),
+                          'loop_s': round(results['loop'], 4),
+                          'speedup': round(results['loop'] / results['builtin'], 1)}))
+
+VIEW_CHAIN = """
+let chain = data.map(x => x * 3).filter(x => x % 2 == 0).slice(10, -10).map(x => x + 1).filter(x => x % 7 != 0);
+let total = 0;
+for value in chain {
+    total = total + value;
+}
+"""
+
+def measure_views(size, lazy):
+    # Runs in a fresh process so ru_maxrss reflects only this chain
+    lexer = main.Lexer(VIEW_CHAIN)
+    interpreter = main.Interpreter(main.Parser(lexer.tokens, lexer).parse())
+    interpreter.compiler.lazy_arrays = lazy
+    interpreter.memory.variables['data'] = list(range(size))
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    interpreter.interpret()
+    elapsed = time.perf_counter() - start
+    return {'lazy': lazy, 'seconds': round(elapsed, 3),
+            'extra_peak_rss_mb': round((resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before) / 1024, 1),
+            'total': interpreter.memory.variables['total']}
+
+STREAM_PROGRAMS = {
+    'lines': """
+let count = 0;
+let chars = 0;
+for line in lines(path) {
+    count = count + 1;
+    chars = chars + line.length;
+}
+let result = count;
+""",
+    'csv': "let result = sum(csv(path).map(row => number(row[1])));",
+}
+
+def measure_stream(path, kind):
+    # Runs in a fresh process so ru_maxrss reflects only this pass over the file
+    lexer = main.Lexer(STREAM_PROGRAMS[kind])
+    interpreter = main.Interpreter(main.Parser(lexer.tokens, lexer).parse())
+    interpreter.memory.variables['path'] = path
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    interpreter.interpret()
+    elapsed = time.perf_counter() - start
+    return {'program': kind, 'seconds': round(elapsed, 2),
+            'mb_per_s': round(os.path.getsize(path) / 1024 / 1024 / elapsed, 1),
+            'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+            'extra_peak_rss_mb': round((resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before) / 1024, 1),
+            'result': interpreter.memory.variables['result']}
+
+def bench_stream(sizes, directory):
+    # A for loop over lines() and a csv() map/sum chain on generated files; the extra
+    # peak RSS should stay flat as the file grows
+    with tempfile.TemporaryDirectory(dir=directory) as tmp:
+        for size_mb in sizes:
+            path = generate_records(os.path.join(tmp, f'{size_mb}mb.csv'), size_mb)
+            for kind in STREAM_PROGRAMS:
+                out = subprocess.run([sys.executable, __file__, '_stream', path, kind],
+                                     capture_output=True, text=True, check=True).stdout
+                print(json.dumps({'size_mb': size_mb, **json.loads(out)}), flush=True)
+            os.remove(path)
+
+SHARED_WORKER = """
+let data = args[0];
+let part = data.length / workers;
+let start = worker * part;
+let result = sum(data.slice(start, start + part));
+"""
+
+def measure_shared(size_mb, workers, mode):
+    # Runs in a fresh process; every worker gets the whole array and sums its share
+    count = size_mb * 1024 * 1024 // 8 // workers * workers
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'worker.pn')
+        with open(path, 'w') as file:
+            file.write(SHARED_WORKER)
+        items = array.array('q', range(count))
+        data = main.SharedArray.allocate('q', count, items) if mode == 'shared' else main.ArrayView(items, ())
+        del items
+        start = time.perf_counter()
+        total = sum(main.builtin_parallel(path, workers, data))
+        elapsed = time.perf_counter() - start
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return {'mode': mode, 'seconds': round(elapsed, 2),
+            'parent_peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+            'largest_worker_peak_rss_mb': round(usage.ru_maxrss / 1024, 1), 'total': total}
+
+def bench_shared(sizes, workers, modes):
+    # Pickling copies the array into every worker (workers x size of memory in flight);
+    # a shared array sends only its name
+    for size_mb in sizes:
+        for mode in modes:
+            out = subprocess.run([sys.executable, __file__, '_shared', str(size_mb), str(workers), mode],
+                                 capture_output=True, text=True, check=True).stdout
+            print(json.dumps({'size_mb': size_mb, 'workers': workers, **json.loads(out)}), flush=True)
+
+def generate_definitions(path, statements, names):
+    # Statements over a few thousand long variable names, each reading two others
+    with open(path, 'w') as file:
+        for first in range(0, statements, 100_000):
+            file.write(''.join(f'let counter_value_{n % names} = counter_value_{(n * 7 + 1) % names} '
+                               f'+ counter_value_{(n * 13 + 2) % names} * 2;\n'
+                               for n in range(first, min(first + 100_000, statements))))
+    return path
+
+def measure_intern(path, interned, repeat=5):
+    # Runs in a fresh process; parses the mapped file, then looks up every name node in a
+    # variable store keyed the way the interpreter keys it, by the names in the AST
+    start = time.perf_counter()
+    code = main.load_source(path)
+    lexer = main.Lexer(code, symbols=None if interned else False)
+    ast = main.Parser(lexer.tokens, lexer).parse()
+    parsed = time.perf_counter() - start
+    ast_bytes = main.deep_size(ast)
+    variables = {node['name']: 0 for node in ast}
+    names = [node['name'] for node in main.walk(ast) if node.get('type') == 'name']
+
+    def lookups():
+        for name in names:
+            variables[name]
+
+    lookup_s = min(timeit.repeat(lookups, number=1, repeat=repeat))
+    return {'interned': interned, 'parse_s': round(parsed, 3), 'ast_mb': round(ast_bytes / 2**20, 1),
+            'lookup_ns': round(lookup_s / len(names) * 1e9, 1),
+            'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)}
+
+def bench_intern(statements, names):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = generate_definitions(os.path.join(tmp, 'definitions.pn'), statements, names)
+        for interned in (False, True):
+            out = subprocess.run([sys.executable, __file__, '_intern', path, str(int(interned))],
+                                 capture_output=True, text=True, check=True).stdout
+            print(json.dumps({'statements': statements, 'names': names, **json.loads(out)}), flush=True)
+
+TEMPORARIES = """
+let round = 0;
+let checksum = 0;
+while (round < rounds) {
+    let values = sort(range(0, size).map(x => x * 3 + round));
+    let text = join(values, ",");
+    let digits = text.length;
+    checksum = checksum + digits % 1000;
+    round = round + 1;
+}
+let after = sum(range(0, size));
+"""
+
+def measure_lifetimes(size, rounds, lifetimes):
+    # Runs in a fresh process; peak RSS during the loop, and RSS once it has finished
+    # with the interpreter and its variables still alive
+    lexer = main.Lexer(TEMPORARIES)
+    interpreter = main.Interpreter(main.Parser(lexer.tokens, lexer).parse())
+    interpreter.compiler.lifetimes = lifetimes
+    interpreter.memory.variables.update(size=size, rounds=rounds)
+    start = time.perf_counter()
+    interpreter.interpret()
+    elapsed = time.perf_counter() - start
+    with open('/proc/self/statm') as file:
+        resident = int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    return {'lifetimes': lifetimes, 'seconds': round(elapsed, 3),
+            'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+            'end_rss_mb': round(resident / 2**20, 1), 'variables': sorted(interpreter.memory.variables)}
+
+def bench_lifetimes(size, rounds):
+    # A loop building an array and a string per iteration: block scoping and liveness
+    # drop each before the next is built, and nothing is left once the loop ends
+    for count in rounds:
+        for lifetimes in (False, True):
+            out = subprocess.run([sys.executable, __file__, '_lifetimes', str(size), str(count), str(int(lifetimes))],
+                                 capture_output=True, text=True, check=True).stdout
+            print(json.dumps({'size': size, 'rounds': count, **json.loads(out)}), flush=True)
+
+TASK_PROGRAM = """
+let i = 0;
+let acc = 0;
+while (i < steps) {
+    acc = acc + task * weight;
+    i = i + 1;
+}
+result = acc;
+"""
+
+def bench_scopes(count, names, tasks, steps):
+    # Cost of a task's variables: a copy-on-write Scope versus a copy of the parent
+    parent = {f'name_{n}': n for n in range(names)}
+    start = time.perf_counter()
+    for _ in range(count):
+        main.Scope(parent)
+    scope_s = time.perf_counter() - start
+    copies = max(1, count // 100)
+    start = time.perf_counter()
+    for _ in range(copies):
+        dict(parent)
+    copy_s = (time.perf_counter() - start) / copies * count
+    scope = main.Scope(parent)
+    scope['own'] = 1
+    lookups = {
+        'dict_ns': lambda: parent['name_1'],
+        'scope_own_ns': lambda: scope['own'],
+        'scope_parent_ns': lambda: scope['name_1'],
+    }
+    print(json.dumps({'scopes': count, 'parent_names': names, 'scope_create_s': round(scope_s, 3),
+                      'dict_copy_s': round(copy_s, 3),
+                      **{key: round(min(timeit.repeat(read, number=100_000, repeat=5)) / 100_000 * 1e9, 1)
+                         for key, read in lookups.items()}}))
+    # Tasks on threads writing the same names: each in its own scope, then all in one
+    # shared dict as a loop whose iterations share a store would
+    lexer = main.Lexer(TASK_PROGRAM)
+    ast = main.Parser(lexer.tokens, lexer).parse()
+    expected = [task * 3 * steps for task in range(tasks)]
+    start = time.perf_counter()
+    finished = main.run_tasks(ast, {'steps': steps, 'weight': 3}, tasks, lambda task: {'task': task})
+    elapsed = time.perf_counter() - start
+    results = [scope['result'] for _, scope in finished]
+    print(json.dumps({'mode': 'scopes', 'tasks': tasks, 'steps': steps, 'seconds': round(elapsed, 3),
+                      'wrong_results': sum(got != want for got, want in zip(results, expected))}))
+    shared = {'steps': steps, 'weight': 3}
+    results = [None] * tasks
+
+    def run_shared(task):
+        interpreter = main.Interpreter(ast)
+        interpreter.compiler.variables = shared
+        shared['task'] = task
+        interpreter.interpret()
+        results[task] = shared['result']
+
+    start = time.perf_counter()
+    with main.ThreadPoolExecutor(max_workers=tasks) as executor:
+        list(executor.map(run_shared, range(tasks)))
+    elapsed = time.perf_counter() - start
+    print(json.dumps({'mode': 'shared dict', 'tasks': tasks, 'steps': steps, 'seconds': round(elapsed, 3),
+                      'wrong_results': sum(got != want for got, want in zip(results, expected))}))
+
+BUDGET_LOOP = """
+let total = 0;
+let i = 0;
+while (i < n) {
+    total = total + i % 7;
+    i = i + 1;
+}
+"""
+
+STOPPED_PROGRAMS = {
+    'while loop': 'let i = 0;\nwhile (true) {\n    i = i + 1;\n}\n',
+    'for loop': 'let n = 0;\nfor x in range(0, 1000000000000) {\n    n = n + x % 3;\n}\n',
+    'pipeline': 'let total = sum(range(0, 1000000000000).map(x => x + 1));\n',
+}
+
+def bench_budget(iterations, wait):
+    # Tight loop with the default budget (only the countdown) and with every limit set,
+    # interpreted and traced; then time from cancel() to the end of a run's thread
+    lexer = main.Lexer(BUDGET_LOOP)
+    ast = main.Parser(lexer.tokens, lexer).parse()
+    for tracing in (False, True):
+        for limited in (False, True):
+            budget = main.Budget(max_steps=10 * iterations, seconds=3600, max_memory=2**40) if limited else None
+            interpreter = main.Interpreter(ast, budget=budget, tracing=tracing)
+            interpreter.memory.variables['n'] = iterations
+            start = time.perf_counter()
+            interpreter.interpret()
+            elapsed = time.perf_counter() - start
+            print(json.dumps({'tracing': tracing, 'limits': limited, 'iterations': iterations,
+                              'ns_per_iteration': round(elapsed / iterations * 1e9, 1),
+                              'steps': interpreter.budget.steps}))
+    for name, source in STOPPED_PROGRAMS.items():
+        for tracing in (False, True):
+            lexer = main.Lexer(source)
+            interpreter = main.Interpreter(main.Parser(lexer.tokens, lexer).parse(), tracing=tracing)
+            stopped = []
+
+            def run():
+                try:
+                    interpreter.interpret()
+                except main.RunCancelled:
+                    stopped.append(time.perf_counter())
+
+            thread = threading.Thread(target=run)
+            thread.start()
+            time.sleep(wait)
+            cancelled = time.perf_counter()
+            interpreter.budget.cancel()
+            thread.join()
+            print(json.dumps({'program': name, 'tracing': tracing, 'stopped': bool(stopped),
+                              'cancel_to_exit_ms': round((time.perf_counter() - cancelled) * 1000, 3),
+                              'steps': interpreter.budget.steps}))
+
+RUN_PROGRAM = """
+let total = 0;
+for i in range(0, {iterations}) {{
+    total = total + i % 7;
+    if (i % {every} == 0) {{
+        print i;
+    }}
+}}
+print total;
+"""
+
+def run_submissions(runs, submitted):
+    # Polls until every run has finished; returns (output per run, most runs started at once)
+    outputs = {run: [] for run in submitted}
+    active = peak = 0
+    while any(run.finished is None for run in submitted):
+        for kind, run, data in runs.poll(0.1):
+            if kind == 'start':
+                active += 1
+                peak = max(peak, active)
+            elif kind == 'exit':
+                active -= 1
+            else:
+                outputs[run].append(data)
+    return {run: ''.join(parts) for run, parts in outputs.items()}, peak
+
+def bench_runs(submissions, workers, iterations):
+    # Launcher run queue: `submissions` runs submitted at once, then as many endless
+    # runs stopped at once, running and queued alike
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'run.pn')
+        with open(path, 'w') as file:
+            file.write(RUN_PROGRAM.format(iterations=iterations, every=max(1, iterations // 100)))
+        endless = os.path.join(tmp, 'endless.pn')
+        with open(endless, 'w') as file:
+            file.write('let i = 0;\nwhile (true) {\n    i = i + 1;\n}\n')
+        expected = io.StringIO()
+        with contextlib.redirect_stdout(expected):
+            main.run_code(main.load_source(path))
+        for count_workers in workers:
+            runs = main.RunQueue(count_workers)
+            try:
+                start = time.perf_counter()
+                submitted = [runs.submit(path) for _ in range(submissions)]
+                outputs, peak = run_submissions(runs, submitted)
+                elapsed = time.perf_counter() - start
+                waits = sorted(run.started - run.submitted for run in submitted)
+                print(json.dumps({'submissions': submissions, 'workers': count_workers, 'wall_s': round(elapsed, 3),
+                                  'peak_running': peak, 'wait_p50_s': round(waits[len(waits) // 2], 3),
+                                  'wait_max_s': round(waits[-1], 3),
+                                  'failed': sum(1 for run in submitted if run.status != 'done'),
+                                  'wrong_output': sum(1 for run in submitted if outputs[run] != expected.getvalue())}))
+                submitted = [runs.submit(endless) for _ in range(submissions)]
+                while sum(1 for run in submitted if run.started is not None) < count_workers:
+                    runs.poll(0.1)
+                start = time.perf_counter()
+                for run in submitted:
+                    runs.stop(run)
+                run_submissions(runs, submitted)
+                print(json.dumps({'endless': submissions, 'workers': count_workers,
+                                  'stop_all_ms': round((time.perf_counter() - start) * 1000, 3),
+                                  'stopped': sum(1 for run in submitted if run.status == 'stopped')}))
+            finally:
+                runs.close()
+
+def output_chunks(lines):
+    # Program output as RunOutput sends it: chunks of about 4 KB
+    chunk = []
+    size = 0
+    for n in range(lines):
+        line = f"line {n}: total = {n * 7 % 1000}\n"
+        chunk.append(line)
+        size += len(line)
+        if size >= 4096:
+            yield ''.join(chunk)
+            chunk = []
+            size = 0
+    if chunk:
+        yield ''.join(chunk)
+
+def measure_output(lines, mode, rows=40, samples=1_000):
+    # Runs in a fresh process: output kept as an OutputBuffer or, for comparison, as a
+    # list of lines; then the cost of fetching a screenful as the view does on a redraw
+    import random
+    random.seed(1)
+    start = time.perf_counter()
+    if mode == 'buffer':
+        buffer = main.OutputBuffer()
+        for chunk in output_chunks(lines):
+            buffer.append(chunk)
+        window = buffer.lines
+    else:
+        buffer = []
+        for chunk in output_chunks(lines):
+            buffer.extend(chunk.splitlines())
+        window = lambda first, count: buffer[first:first + count]
+    result = {'mode': mode, 'lines': len(buffer), 'append_s': round(time.perf_counter() - start, 3),
+              'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)}
+
+    def latency(tops):
+        times = []
+        for top in tops:
+            begin = time.perf_counter()
+            window(top, rows)
+            times.append(time.perf_counter() - begin)
+        times.sort()
+        return {'p50_ms': round(times[len(times) // 2] * 1000, 4), 'p99_ms': round(times[len(times) * 99 // 100] * 1000, 4)}
+
+    result['jump'] = latency([random.randrange(lines - rows) for _ in range(samples)])
+    first = random.randrange(lines - rows - samples)
+    result['scroll'] = latency(range(first, first + samples))
+    result['end'] = latency([lines - rows] * samples)
+    if mode == 'buffer':
+        start = time.perf_counter()
+        found = buffer.find(f"line {lines - 1}:")
+        result['find_last_line_s'] = round(time.perf_counter() - start, 3)
+        result['found'] = found == lines - 1
+        result['index_entries'] = len(buffer.offsets)
+        result['spill_mb'] = round(buffer.size / 2**20, 1)
+    return result
+
+def bench_output(lines, modes):
+    for mode in modes:
+        out = subprocess.run([sys.executable, __file__, '_output', str(lines), mode],
+                             capture_output=True, text=True, check=True).stdout
+        print(out.strip())
+
+REPL_INPUTS = {
+    'expression': 'd{last} + d1',
+    'definition': 'let q = d5 * 2;',
+    'loop': 'let acc = 0;\nfor i in range(0, 100) {{\n    acc = acc + d7;\n}}',
+}
+
+def bench_repl(definitions, repeat):
+    # Per-input latency of a REPL session as definitions pile up (one per input), then of
+    # a few typical inputs with all of them in scope, against re-running the whole
+    # program so far as a file would be
+    def percentiles(times):
+        times = sorted(times)
+        return {'p50_ms': round(times[len(times) // 2] * 1000, 4), 'p99_ms': round(times[len(times) * 99 // 100] * 1000, 4)}
+
+    session = main.ReplSession()
+    output = io.StringIO()  # what the inputs print
+
+    def run(source):
+        with contextlib.redirect_stdout(output):
+            start = time.perf_counter()
+            session.run(source)
+            return time.perf_counter() - start
+
+    times = [run(f'let d{n} = {n};') for n in range(definitions)]
+    window = max(1, min(1_000, definitions // 10))
+    print(json.dumps({'definitions': definitions, 'first': percentiles(times[:window]),
+                      'last': percentiles(times[-window:])}))
+    program = ''.join(f'let d{n} = {n};\n' for n in range(definitions))
+    for name, source in REPL_INPUTS.items():
+        source = source.format(last=definitions - 1)
+        times = [run(source) for _ in range(repeat)]
+        rerun = []
+        for _ in range(3):
+            with contextlib.redirect_stdout(output):
+                start = time.perf_counter()
+                lexer = main.Lexer(program + source)
+                main.Interpreter(main.Parser(lexer.tokens, lexer).parse()).interpret()
+                rerun.append(time.perf_counter() - start)
+        print(json.dumps({'input': name, 'definitions': definitions, 'repl': percentiles(times),
+                          'rerun_all_ms': round(min(rerun) * 1000, 3)}))
+
+def bench_views(sizes):
+    # 5-stage map/filter/slice chain consumed by a for loop, as lazy views versus a new
+    # array per stage; the source array is built before the peak RSS baseline is taken
+    for size in sizes:
+        for mode in ('eager', 'lazy'):
+            out = subprocess.run([sys.executable, __file__, '_views', str(size), mode],
+                                 capture_output=True, text=True, check=True).stdout
+            print(json.dumps({'elements': size, **json.loads(out)}))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pynode benchmarks")
+    sub = parser.add_subparsers(dest='bench', required=True)
+    load = sub.add_parser('load', help="file loading and lexing")
+    load.add_argument('--sizes', type=int, nargs='+', default=[100, 1000], help="input sizes in MB")
+    parse = sub.add_parser('parse', help="parallel lexing and parsing")
+    parse.add_argument('--size', type=int, default=50, help="input size in MB")
+    parse.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8])
+    rerun = sub.add_parser('rerun', help="incremental re-parse after a one-line edit")
+    rerun.add_argument('--lines', type=int, default=50_000)
+    batch = sub.add_parser('batch', help="multi-file batch runner")
+    batch.add_argument('--count', type=int, default=1_000)
+    batch.add_argument('--workers', type=int, nargs='+', default=[2, 4, 8])
+    arith = sub.add_parser('arith', help="integer arithmetic fast paths")
+    arith.add_argument('--iterations', type=int, default=10_000_000)
+    concat = sub.add_parser('concat', help="string building in a loop")
+    concat.add_argument('--sizes', type=int, nargs='+', default=[250_000, 500_000, 1_000_000])
+    concat.add_argument('--naive-sizes', type=int, nargs='+', default=[25_000, 50_000, 100_000])
+    switch = sub.add_parser('switch', help="switch jump tables versus linear case tests")
+    switch.add_argument('--cases', type=int, default=1_000)
+    switch.add_argument('--dispatches', type=int, default=100_000)
+    loops = sub.add_parser('loops', help="nested while loops")
+    loops.add_argument('--outer', type=int, default=1_000)
+    loops.add_argument('--inner', type=int, default=10_000)
+    for_loop = sub.add_parser('for', help="for loop with a multi-statement body")
+    for_loop.add_argument('--iterations', type=int, default=1_000_000)
+    types = sub.add_parser('types', help="static type specialization")
+    types.add_argument('--iterations', type=int, default=1_000_000)
+    trace = sub.add_parser('trace', help="tracing of hot loops")
+    trace.add_argument('--sizes', type=int, nargs='+', default=[1_000, 10_000, 100_000, 1_000_000])
+    views = sub.add_parser('views', help="lazy array views versus eager array operations")
+    views.add_argument('--sizes', type=int, nargs='+', default=[1_000_000, 10_000_000])
+    builtins = sub.add_parser('builtins', help="native builtins versus hand-written loops")
+    builtins.add_argument('--size', type=int, default=1_000_000)
+    stream = sub.add_parser('stream', help="streaming lines() and csv() over large files")
+    stream.add_argument('--sizes', type=int, nargs='+', default=[100, 1_000, 10_240], help="file sizes in MB")
+    stream.add_argument('--dir', help="where to generate the files (default: the temp directory)")
+    imports = sub.add_parser('imports', help="program startup with cold and warm module caches")
+    imports.add_argument('--count', type=int, default=200)
+    shared = sub.add_parser('shared', help="arrays sent to worker processes: pickled versus shared memory")
+    shared.add_argument('--sizes', type=int, nargs='+', default=[1_024], help="array sizes in MB")
+    shared.add_argument('--workers', type=int, default=8)
+    shared.add_argument('--modes', nargs='+', choices=('pickle', 'shared'), default=['pickle', 'shared'])
+    intern = sub.add_parser('intern', help="AST memory and variable lookups with and without interning")
+    intern.add_argument('--statements', type=int, default=1_000_000)
+    intern.add_argument('--names', type=int, default=5_000)
+    lifetimes = sub.add_parser('lifetimes', help="memory of block-scoped temporaries in a long loop")
+    lifetimes.add_argument('--size', type=int, default=1_000_000)
+    lifetimes.add_argument('--rounds', type=int, nargs='+', default=[5, 50])
+    scopes = sub.add_parser('scopes', help="copy-on-write task scopes: creation, lookups and concurrent tasks")
+    scopes.add_argument('--count', type=int, default=1_000_000)
+    scopes.add_argument('--names', type=int, default=10_000, help="variables in the parent scope")
+    scopes.add_argument('--tasks', type=int, default=32)
+    scopes.add_argument('--steps', type=int, default=100_000)
+    budget = sub.add_parser('budget', help="safepoint overhead and time from cancel to the end of a run")
+    budget.add_argument('--iterations', type=int, default=2_000_000)
+    budget.add_argument('--wait', type=float, default=0.5, help="seconds a run goes on before it is cancelled")
+    runs = sub.add_parser('runs', help="launcher run queue: many submissions at once, then stopping them")
+    runs.add_argument('--submissions', type=int, default=100)
+    runs.add_argument('--workers', type=int, nargs='+', default=[1, os.cpu_count() or 1])
+    runs.add_argument('--iterations', type=int, default=200_000, help="loop iterations of each run")
+    output = sub.add_parser('output', help="output view storage: append, scroll, jump and search over long output")
+    output.add_argument('--lines', type=int, default=10_000_000)
+    output.add_argument('--modes', nargs='+', default=['buffer', 'list'], choices=['buffer', 'list'])
+    repl = sub.add_parser('repl', help="REPL per-input latency with many earlier definitions")
+    repl.add_argument('--definitions', type=int, default=10_000)
+    repl.add_argument('--repeat', type=int, default=200)
+    child = sub.add_parser('_load')
+    child.add_argument('path')
+    child.add_argument('mode')
+    stream_child = sub.add_parser('_stream')
+    stream_child.add_argument('path')
+    stream_child.add_argument('kind')
+    imports_child = sub.add_parser('_imports')
+    imports_child.add_argument('path')
+    shared_child = sub.add_parser('_shared')
+    shared_child.add_argument('size_mb', type=int)
+    shared_child.add_argument('workers', type=int)
+    shared_child.add_argument('mode')
+    intern_child = sub.add_parser('_intern')
+    intern_child.add_argument('path')
+    intern_child.add_argument('interned', type=int)
+    lifetimes_child = sub.add_parser('_lifetimes')
+    lifetimes_child.add_argument('size', type=int)
+    lifetimes_child.add_argument('rounds', type=int)
+    lifetimes_child.add_argument('lifetimes', type=int)
+    output_child = sub.add_parser('_output')
+    output_child.add_argument('lines', type=int)
+    output_child.add_argument('mode')
+    views_child = sub.add_parser('_views')
+    views_child.add_argument('size', type=int)
+    views_child.add_argument('mode')
+    args = parser.parse_args()
+
+    if args.bench == 'load':
+        bench_load(args.sizes)
+    elif args.bench == 'parse':
+        bench_parse(args.size, args.workers)
+    elif args.bench == 'rerun':
+        bench_rerun(args.lines)
+    elif args.bench == 'batch':
+        bench_batch(args.count, args.workers)
+    elif args.bench == 'arith':
+        bench_arith(args.iterations)
+    elif args.bench == 'concat':
+        bench_concat(args.sizes, args.naive_sizes)
+    elif args.bench == 'switch':
+        bench_switch(args.cases, args.dispatches)
+    elif args.bench == 'loops':
+        bench_loops(args.outer, args.inner)
+    elif args.bench == 'for':
+        bench_for(args.iterations)
+    elif args.bench == 'types':
+        bench_types(args.iterations)
+    elif args.bench == 'trace':
+        bench_trace(args.sizes)
+    elif args.bench == 'views':
+        bench_views(args.sizes)
+    elif args.bench == 'builtins':
+        bench_builtins(args.size)
+    elif args.bench == 'stream':
+        bench_stream(args.sizes, args.dir)
+    elif args.bench == 'imports':
+        bench_imports(args.count)
+    elif args.bench == 'shared':
+        bench_shared(args.sizes, args.workers, args.modes)
+    elif args.bench == 'intern':
+        bench_intern(args.statements, args.names)
+    elif args.bench == 'lifetimes':
+        bench_lifetimes(args.size, args.rounds)
+    elif args.bench == 'scopes':
+        bench_scopes(args.count, args.names, args.tasks, args.steps)
+    elif args.bench == 'budget':
+        bench_budget(args.iterations, args.wait)
+    elif args.bench == 'runs':
+        bench_runs(args.submissions, args.workers, args.iterations)
+    elif args.bench == 'output':
+        bench_output(args.lines, args.modes)
+    elif args.bench == 'repl':
+        bench_repl(args.definitions, args.repeat)
+    elif args.bench == '_load':
+        print(json.dumps(measure_load(args.path, args.mode)))
+    elif args.bench == '_stream':
+        print(json.dumps(measure_stream(args.path, args.kind)))
+    elif args.bench == '_imports':
+        print(json.dumps(measure_imports(args.path)))
+    elif args.bench == '_shared':
+        print(json.dumps(measure_shared(args.size_mb, args.workers, args.mode)))
+    elif args.bench == '_intern':
+        print(json.dumps(measure_intern(args.path, bool(args.interned))))
+    elif args.bench == '_lifetimes':
+        print(json.dumps(measure_lifetimes(args.size, args.rounds, bool(args.lifetimes))))
+    elif args.bench == '_output':
+        print(json.dumps(measure_output(args.lines, args.mode)))
+    elif args.bench == '_views':
+        print(json.dumps(measure_views(args.size, args.mode == 'lazy')))
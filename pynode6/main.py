@@ -1,13 +1,179 @@
 import tkinter as tk
+import tkinter.font
+from tkinter import ttk
 import re
 import os
 import threading
 import time
+import mmap
+import bisect
+import sys
+import io
+import glob
+import json
+import shlex
+import argparse
+import contextlib
+import operator
+import itertools
+import collections
+import array
+import weakref
+import tracemalloc
+import codecs
+import inspect
+import csv
+import hashlib
+import tempfile
+import queue
+import multiprocessing
+import multiprocessing.connection
+import signal
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait
+from multiprocessing import shared_memory
+
+PARSE_WORKERS = os.cpu_count() or 1
+PARALLEL_PARSE_MIN_SIZE = 64 * 1024 * 1024  # smaller files are parsed in-thread
+BATCH_WORKERS = os.cpu_count() or 1
+RUN_WORKERS = os.cpu_count() or 1  # launcher runs executing at once; later ones wait in a queue
+TASK_THREADS = 32  # threads running the tasks of one tasks() call
+SPEED_MULTIPLIER = 10_000_000_000_000_000
+SAFEPOINT_INTERVAL = 1_024  # safepoints between two full checks of a run's budget
+MEMORY_CHECK_SECONDS = 0.01  # the resident size is read at most this often per budget
+PARALLEL_CHECK_SECONDS = 0.05  # a run waiting in parallel() checks its budget this often
+# Worker processes start from a clean server process rather than a fork of the caller,
+# whose parse, REPL and batch threads may hold locks a forked child would inherit
+PROCESSES = multiprocessing.get_context('forkserver' if 'forkserver' in multiprocessing.get_all_start_methods()
+                                        else 'spawn')
+
+class PNError(Exception):
+    # Errors in .pn programs, reported with the line they occurred on
+    def __init__(self, message, line=None):
+        super().__init__(f"line {line}: {message}" if line is not None else message)
+        self.message = message
+        self.line = line
+
+class RunStopped(PNError):
+    # A run ended by its Budget rather than by an error in the program
+    pass
+
+class RunCancelled(RunStopped):
+    pass
+
+class BudgetExceeded(RunStopped):
+    pass
+
+class Budget:
+    # Cancellation token and limits of one run. Loops count down `left` at every
+    # iteration and long array pipelines once per chunk of items (calls cannot recurse,
+    # so they end on their own); when it runs out, check() counts the steps and tests
+    # the cancel flag, the step limit, the clock and the process's resident size.
+    # cancel() empties `left`, so the run stops at its next safepoint. A budget with a
+    # parent (a task's, or an imported module's) also charges its steps there, under the
+    # parent's lock, as the tasks of one tasks() call charge it from their own threads.
+    __slots__ = ('left', 'granted', 'steps', 'max_steps', 'seconds', 'deadline', 'max_memory',
+                 'memory_checked', 'cancelled', 'parent', 'lock')
+
+    def __init__(self, max_steps=None, seconds=None, max_memory=None, parent=None):
+        self.steps = 0  # safepoints passed, up to the last check
+        self.max_steps = max_steps
+        self.seconds = seconds
+        self.deadline = None  # set by start()
+        self.max_memory = max_memory  # bytes
+        self.memory_checked = 0.0
+        self.cancelled = False
+        self.parent = parent
+        self.lock = threading.Lock()
+        self.granted = self.left = self.interval()
+
+    def interval(self):
+        if self.max_steps is None:
+            return SAFEPOINT_INTERVAL
+        return max(1, min(SAFEPOINT_INTERVAL, self.max_steps - self.steps))
+
+    def start(self):
+        # The time limit counts from the start of the run, not from its submission
+        if self.seconds is not None and self.deadline is None:
+            self.deadline = time.monotonic() + self.seconds
+
+    def cancel(self):
+        self.cancelled = True
+        self.left = 0
+
+    def check(self):
+        consumed = self.granted - self.left
+        self.steps += consumed
+        if self.cancelled:
+            raise RunCancelled("Run cancelled")
+        if self.max_steps is not None and self.steps >= self.max_steps:
+            raise BudgetExceeded(f"Step limit of {self.max_steps} exceeded")
+        now = time.monotonic()
+        if self.deadline is not None and now >= self.deadline:
+            raise BudgetExceeded(f"Time limit of {self.seconds:g}s exceeded")
+        if self.max_memory is not None and now - self.memory_checked >= MEMORY_CHECK_SECONDS:
+            self.memory_checked = now
+            resident = resident_memory()
+            if resident is not None and resident > self.max_memory:
+                raise BudgetExceeded(f"Memory limit of {format_size(self.max_memory)} exceeded "
+                                     f"({format_size(resident)} resident)")
+        parent = self.parent
+        if parent is not None:
+            with parent.lock:
+                parent.left -= consumed
+                if parent.left <= 0:
+                    parent.check()
+        self.granted = self.left = self.interval()
+
+    def remaining(self):
+        # (max_steps, seconds, max_memory) still left to this budget and those it charges,
+        # for a Budget bounding work done on the run's behalf in another process
+        limits = [None, None, None]
+        now = time.monotonic()
+        budget = self
+        while budget is not None:
+            used = budget.steps + budget.granted - budget.left
+            left = (None if budget.max_steps is None else budget.max_steps - used,
+                    None if budget.deadline is None else budget.deadline - now, budget.max_memory)
+            limits = [value if limit is None else limit if value is None else min(limit, value)
+                      for limit, value in zip(limits, left)]
+            budget = budget.parent
+        steps, seconds, memory = limits
+        return (None if steps is None else max(steps, 0), None if seconds is None else max(seconds, 0.0), memory)
+
+    def check_all(self):
+        # A safepoint for a run that makes no steps, e.g. one waiting on other processes;
+        # the budgets it charges are checked too, as their clocks run on
+        budget = self
+        while budget is not None:
+            budget.check()
+            budget = budget.parent
+
+    def items(self, items):
+        # An iterator over items with a safepoint per SAFEPOINT_INTERVAL of them
+        return itertools.chain.from_iterable(self.chunks(iter(items)))
+
+    def chunks(self, items):
+        while True:
+            chunk = list(itertools.islice(items, SAFEPOINT_INTERVAL))
+            if not chunk:
+                return
+            self.left -= 1
+            self.check()  # a chunk is long enough to test the clock each time
+            yield chunk
+
+def resident_memory():
+    # Resident size of this process in bytes, or None where it cannot be read cheaply
+    try:
+        with open('/proc/self/statm') as file:
+            return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return None
 
 # Adjust memory usage for the application
 class OptimizedMemory:
-    def __init__(self):
-        self.variables = {}
+    def __init__(self, parent=None):
+        # parent: variables a task reads through a copy-on-write Scope
+        self.variables = {} if parent is None else Scope(parent)
 
     def set_variable(self, name, value):
         # Store only necessary variables
@@ -16,18 +182,163 @@ class OptimizedMemory:
     def get_variable(self, name):
         return self.variables.get(name, None)
 
+KEYWORDS = ('let', 'const', 'var', 'delete', 'print', 'console.log', 'if', 'else', 'switch', 'case', 'default',
+            'for', 'while', 'do', 'function', 'return', 'call', 'async', 'await', 'Promise', 'push', 'pop', 'shift',
+            'unshift', 'slice', 'splice', 'new', 'Object.assign', 'Object.keys')
+SYMBOLS = ('=>', '==', '!=', '<=', '>=', '=', '+', '-', '*', '/', '%', '<', '>', '(', ')', '[', ']', ',', ':', ';', '{', '}', '.')
+COMPARISONS = ('==', '!=', '<', '>', '<=', '>=')
+
+SKIP = r'(?:[ \t\n\r\f\v]|//[^\n]*)*'  # whitespace and line comments
+# Identifiers go on with ASCII letters, digits and '_' and with any non-ASCII character,
+# as the bytes of a UTF-8 character cannot be told apart without decoding them; one
+# class for str and bytes keeps the two lexers splitting text the same way
+WORD = r'[0-9A-Za-z_\x80-\U0010ffff]'
+# Keywords must end at a word boundary, or `doubled` would lex as `do` + `ubled`
+TOKEN_PATTERN = (SKIP + '(' + '(?:' + '|'.join(re.escape(k) for k in KEYWORDS) + f')(?!{WORD})|[a-zA-Z_]{WORD}*'
+                 + r'|[0-9]+(?:\.[0-9]+)?|".*?"|`.*?`|' + '|'.join(re.escape(s) for s in SYMBOLS) + ')' + SKIP)
+TOKEN_RE = re.compile(TOKEN_PATTERN)
+BYTES_WORD = r'[0-9A-Za-z_\x80-\xff]'
+BYTES_TOKEN_RE = re.compile(TOKEN_PATTERN.replace(WORD, BYTES_WORD).encode())
+# Keywords and symbols come from this table rather than being decoded
+STATIC_TOKENS = {token.encode(): token for token in KEYWORDS + SYMBOLS}
+# Whitespace and comments before the first token. Skipped on their own, since the leading
+# SKIP of a token match that finds no token after it backtracks into a comment, and text
+# like `// c` would lex as `c`; every later match starts where the one before ended
+SKIP_RE = re.compile(SKIP)
+BYTES_SKIP_RE = re.compile(SKIP.encode())
+
+BOUNDARY_PATTERN = r'"[^"\n]*"|`[^`\n]*`|//[^\n]*|[{}]'
+BOUNDARY_RE = re.compile(BOUNDARY_PATTERN)
+BYTES_BOUNDARY_RE = re.compile(BOUNDARY_PATTERN.encode())
+COMMENT_TAIL_RE = re.compile(r'//[^"\n]*$')
+BYTES_COMMENT_TAIL_RE = re.compile(COMMENT_TAIL_RE.pattern.encode())
+CONTINUATION_RE = re.compile(f'(?:else|while)(?!{WORD})')  # tokens that go on after a block's '}'
+BYTES_CONTINUATION_RE = re.compile(f'(?:else|while)(?!{BYTES_WORD})'.encode())
+# Tokens that only start a statement, so a line before one ends a statement without ';'
+STATEMENT_START_PATTERN = (r'(?:let|const|var|print|console\.log|if|for|while|do|switch|break|continue|delete|import'
+                           r'|function|return)')
+STATEMENT_START_RE = re.compile(STATEMENT_START_PATTERN + f'(?!{WORD})')
+BYTES_STATEMENT_START_RE = re.compile((STATEMENT_START_PATTERN + f'(?!{BYTES_WORD})').encode())
+OPEN_TAIL_RE = re.compile(f'(?<!{WORD})else$')  # a line ending with this goes on in the next one
+BYTES_OPEN_TAIL_RE = re.compile(f'(?<!{BYTES_WORD})else$'.encode())
+COUNT_WINDOW = 16 * 1024 * 1024
+STREAM_CHUNK = 1024 * 1024  # bytes per read for lines(), csv() and stdin
+MODULE_PATH = [path for path in os.environ.get('PN_PATH', '').split(os.pathsep) if path]  # after the importer's directory
+
+def count_newlines(code, start, end):
+    if isinstance(code, str):
+        return code.count('\n', start, end)
+    if isinstance(code, bytes):
+        return code.count(b'\n', start, end)
+    # mmap has no count(); scan it in bounded windows
+    total = 0
+    while start < end:
+        stop = min(end, start + COUNT_WINDOW)
+        total += code[start:stop].count(b'\n')
+        start = stop
+    return total
+
+def split_lines(code):
+    # code.splitlines(keepends=True); an mmap is sliced in bounded windows rather than
+    # copied whole. The last piece of each window may be cut short, so it is carried on
+    if not isinstance(code, mmap.mmap):
+        return code.splitlines(keepends=True)
+    lines, rest = [], b''
+    for start in range(0, len(code), COUNT_WINDOW):
+        pieces = (rest + code[start:start + COUNT_WINDOW]).splitlines(keepends=True)
+        rest = pieces.pop()
+        lines += pieces
+    if rest:
+        lines.append(rest)
+    return lines
+
+class SymbolTable:
+    # Strings and literal values of one compilation, one object per distinct token, so
+    # the AST and the variable store hold references to them rather than copies; an
+    # identifier is also interned process-wide, as Python interns its own names, so a
+    # variable lookup matches its key by identity
+    __slots__ = ('tokens', 'literals')
+
+    def __init__(self):
+        self.tokens = {}    # source text (str, or raw bytes when lexing bytes) -> token
+        self.literals = {}  # number or string literal token -> its value
+
+    def token(self, text, key=None):
+        token = sys.intern(text) if text[0].isalpha() or text[0] == '_' else text
+        self.tokens[text if key is None else key] = token
+        return token
+
 class Lexer:
-    def __init__(self, code):
-        self.code = code
+    def __init__(self, code, start=0, end=None, first_line=1, symbols=None):
+        self.code = code  # str, bytes or mmap
+        self.start = start
+        self.end = len(code) if end is None else end
+        self.offset = start  # offset of the most recent token
+        self.line_offset = start
+        self.line_number = first_line
+        # A SymbolTable to share, None for a new one, or False to not intern at all
+        self.symbols = SymbolTable() if symbols is None else symbols or None
         self.tokens = self.lazy_tokenize()
 
     def lazy_tokenize(self):
-        pattern = r'\s*(let|const|var|delete|print|console\.log|if|else|switch|case|default|for|while|do|function|return|call|async|await|Promise|push|pop|shift|unshift|slice|splice|new|Object\.assign|Object\.keys|[a-zA-Z_]\w*|[0-9]+|".*?"|[=+();{}])\s*'
-        return (token for token in re.findall(pattern, self.code))
+        if isinstance(self.code, str):
+            return self.lazy_tokenize_str()
+        return self.lazy_tokenize_bytes()
+
+    def lazy_tokenize_str(self):
+        start = SKIP_RE.match(self.code, self.start, self.end).end()
+        if self.symbols is None:
+            for match in TOKEN_RE.finditer(self.code, start, self.end):
+                self.offset = match.start(1)
+                yield match.group(1)
+            return
+        symbols, tokens = self.symbols, self.symbols.tokens
+        for match in TOKEN_RE.finditer(self.code, start, self.end):
+            self.offset = match.start(1)
+            text = match.group(1)
+            token = tokens.get(text)
+            yield token if token is not None else symbols.token(text)
+
+    def lazy_tokenize_bytes(self):
+        # Decode only identifiers, numbers and string literals, each distinct one once
+        # when interning
+        static = STATIC_TOKENS
+        start = BYTES_SKIP_RE.match(self.code, self.start, self.end).end()
+        if self.symbols is None:
+            for match in BYTES_TOKEN_RE.finditer(self.code, start, self.end):
+                self.offset = match.start(1)
+                raw = match.group(1)
+                token = static.get(raw)
+                yield token if token is not None else raw.decode('utf-8')
+            return
+        symbols, tokens = self.symbols, self.symbols.tokens
+        for match in BYTES_TOKEN_RE.finditer(self.code, start, self.end):
+            self.offset = match.start(1)
+            raw = match.group(1)
+            token = static.get(raw) or tokens.get(raw)
+            if token is None:
+                token = symbols.token(raw.decode('utf-8'), raw)
+            yield token
+
+    def line(self):
+        # Line of the most recent token, counted forward from the previous call
+        self.line_number += count_newlines(self.code, self.line_offset, self.offset)
+        self.line_offset = self.offset
+        return self.line_number
+
+LITERAL_NAMES = {'true': True, 'false': False, 'null': None}
+RESERVED_WORDS = ('in', 'break', 'continue', 'import')  # not lexer keywords, but never variable names
+TEMPLATE_RE = re.compile(r'\$\{(.*?)\}')
+METHODS = ('slice', 'splice', 'map', 'filter')  # array methods, called as `value.name(args)`
+PROPERTIES = ('length',)
 
 class Parser:
-    def __init__(self, tokens):
+    def __init__(self, tokens, lexer=None):
         self.tokens = tokens
+        self.lexer = lexer  # used for line numbers
+        self.symbols = lexer.symbols if lexer is not None else None
+        self.breakable = 0  # nesting depth of constructs that accept 'break'
+        self.loops = 0      # nesting depth of loops, which also accept 'continue'
         self.current_token = None
         self.next_token()
 
@@ -36,102 +347,3986 @@ class Parser:
             self.current_token = next(self.tokens)
         except StopIteration:
             self.current_token = None
+        return self.current_token
 
-    def parse(self):
-        ast = []
-        while self.current_token is not None:
-            if self.current_token in ('let', 'const', 'var'):
-                var_name = next(self.tokens, None)
-                next(self.tokens, None)  # '='
-                value = next(self.tokens, None)
-                ast.append({'type': 'variable_assignment', 'name': var_name, 'value': value})
-            elif self.current_token in ('print', 'console.log'):
-                value = next(self.tokens, None)
-                ast.append({'type': 'print', 'value': value})
-            elif self.current_token == 'if':
-                condition = next(self.tokens, None)
-                body = []
-                next(self.tokens, None)  # '{'
-                while self.current_token != '}' and self.current_token is not None:
-                    body.append(self.current_token)
-                    self.next_token()
-                next(self.tokens, None)  # '}'
-                ast.append({'type': 'if', 'condition': condition, 'body': body})
-            elif self.current_token == 'for':
-                var_name = next(self.tokens, None)
-                next(self.tokens, None)  # 'in'
-                collection = next(self.tokens, None)
-                body = []
-                next(self.tokens, None)  # '{'
-                while self.current_token != '}' and self.current_token is not None:
-                    body.append(self.current_token)
-                    self.next_token()
-                next(self.tokens, None)  # '}'
-                ast.append({'type': 'for', 'var': var_name, 'collection': collection, 'body': body})
+    def line(self):
+        return self.lexer.line() if self.lexer else None
+
+    def error(self, message):
+        return PNError(message, self.line())
+
+    def expect(self, token):
+        if self.current_token != token:
+            found = 'end of file' if self.current_token is None else repr(self.current_token)
+            raise self.error(f"Expected {token!r} but found {found}")
+        self.next_token()
+
+    def variable_name(self, after):
+        # The token following `after`, which has to be a name a variable can have
+        name = self.next_token()
+        if name is None or name in KEYWORDS or name in RESERVED_WORDS or name in LITERAL_NAMES \
+                or not (name[0].isalpha() or name[0] == '_'):
+            raise self.error(f"Expected a variable name after {after!r}")
+        self.next_token()
+        return name
+
+    def parse_expression(self):
+        left = self.parse_additive()
+        while self.current_token in COMPARISONS:
+            op = self.current_token
+            self.next_token()
+            left = {'type': 'binary', 'op': op, 'left': left, 'right': self.parse_additive()}
+        return left
+
+    def parse_additive(self):
+        left = self.parse_term()
+        while self.current_token in ('+', '-'):
+            op = self.current_token
+            self.next_token()
+            left = {'type': 'binary', 'op': op, 'left': left, 'right': self.parse_term()}
+        return left
+
+    def parse_term(self):
+        left = self.parse_unary()
+        while self.current_token in ('*', '/', '%'):
+            op = self.current_token
+            self.next_token()
+            left = {'type': 'binary', 'op': op, 'left': left, 'right': self.parse_unary()}
+        return left
+
+    def parse_unary(self):
+        if self.current_token == '-':
+            self.next_token()
+            operand = self.parse_unary()
+            if operand['type'] == 'number':
+                return {'type': 'number', 'value': -operand['value']}
+            return {'type': 'binary', 'op': '-', 'left': {'type': 'number', 'value': 0}, 'right': operand}
+        return self.parse_postfix()
+
+    def parse_arguments(self):
+        # `(a, b, ...)`, the current token being '('
+        self.next_token()
+        args = []
+        while self.current_token != ')':
+            args.append(self.parse_expression())
+            if self.current_token != ',':
+                break
+            self.next_token()
+        self.expect(')')
+        return args
+
+    def parse_postfix(self):
+        # `f(args)`, `value[index]`, `value.method(args)` and `value.property`, left to right
+        node = self.parse_primary()
+        while self.current_token in ('(', '[', '.'):
+            if self.current_token == '(':
+                node = {'type': 'call', 'callee': node, 'args': self.parse_arguments()}
+                continue
+            if self.current_token == '[':
+                self.next_token()
+                node = {'type': 'index', 'target': node, 'index': self.parse_expression()}
+                self.expect(']')
+                continue
+            name = self.next_token()
+            if self.next_token() == '(':
+                if name not in METHODS:
+                    raise self.error(f"Unknown method {name!r}")
+                node = {'type': 'method', 'target': node, 'name': name, 'args': self.parse_arguments()}
+            else:
+                if name not in PROPERTIES:
+                    raise self.error(f"Unknown property {name!r}")
+                node = {'type': 'property', 'target': node, 'name': name}
+        return node
+
+    def parse_primary(self):
+        token = self.current_token
+        if token is None:
+            raise self.error("Expected an expression but found end of file")
+        first = token[0]
+        if first.isdigit():
+            # Numeric literals are converted once here, never at run time
+            self.next_token()
+            return {'type': 'number', 'value': self.literal(token)}
+        if first == '"':
+            self.next_token()
+            return {'type': 'string', 'value': self.literal(token)}
+        if first == '`':
+            line = self.line()
+            self.next_token()
+            return self.parse_template(token[1:-1], line)
+        if token == '(':
+            self.next_token()
+            node = self.parse_expression()
+            self.expect(')')
+            return node
+        if token == '[':
+            self.next_token()
+            items = []
+            while self.current_token != ']':
+                items.append(self.parse_expression())
+                if self.current_token != ',':
+                    break
+                self.next_token()
+            self.expect(']')
+            return {'type': 'array', 'items': items}
+        if token in LITERAL_NAMES:
+            self.next_token()
+            return {'type': 'constant', 'value': LITERAL_NAMES[token]}
+        if (first.isalpha() or first == '_') and token not in KEYWORDS and token not in RESERVED_WORDS:
+            if self.next_token() == '=>':
+                self.next_token()
+                return {'type': 'arrow', 'param': token, 'body': self.parse_expression()}
+            return {'type': 'name', 'name': token}
+        raise self.error(f"Unexpected {token!r} in expression")
+
+    def literal(self, token):
+        # Value of a number or string literal token; repeated literals share one value
+        if self.symbols is not None:
+            value = self.symbols.literals.get(token)
+            if value is not None:
+                return value
+        if token[0] == '"':
+            value = token[1:-1]
+        else:
+            value = float(token) if '.' in token else int(token)
+        if self.symbols is not None:
+            self.symbols.literals[token] = value
+        return value
+
+    def parse_template(self, text, line):
+        # `text ${expr} text` -> literal strings and parsed expressions, in order
+        parts = []
+        for index, piece in enumerate(TEMPLATE_RE.split(text)):
+            if index % 2 == 0:
+                if piece:
+                    parts.append({'type': 'string', 'value': piece})
+                continue
+            lexer = Lexer(piece, first_line=line, symbols=self.symbols or False)
+            parser = Parser(lexer.tokens, lexer)
+            parts.append(parser.parse_expression())
+            if parser.current_token is not None:
+                raise parser.error(f"Unexpected {parser.current_token!r} in template")
+        return {'type': 'template', 'parts': parts}
+
+    def parse_block(self):
+        self.expect('{')
+        statements = self.parse_statements(('}',))
+        self.expect('}')
+        return statements
+
+    def parse_loop_block(self):
+        self.breakable += 1
+        self.loops += 1
+        body = self.parse_block()
+        self.breakable -= 1
+        self.loops -= 1
+        return body
+
+    def parse_switch(self, line):
+        self.next_token()
+        subject = self.parse_expression()
+        self.expect('{')
+        cases = []
+        self.breakable += 1
+        while self.current_token in ('case', 'default'):
+            if self.current_token == 'case':
+                self.next_token()
+                label = self.parse_expression()
             else:
+                if any(case['label'] is None for case in cases):
+                    raise self.error("More than one 'default' in switch")
                 self.next_token()
-        return ast
+                label = None
+            self.expect(':')
+            cases.append({'label': label, 'body': self.parse_statements(('case', 'default', '}'))})
+        self.breakable -= 1
+        self.expect('}')
+        return {'type': 'switch', 'subject': subject, 'cases': cases, 'line': line}
+
+    def parse_statement(self):
+        # One statement node, or None for an empty statement
+        line = self.line()
+        token = self.current_token
+        if token in ('let', 'const', 'var'):
+            var_name = self.variable_name(token)
+            self.expect('=')
+            value = self.parse_expression()
+            node = {'type': 'variable_assignment', 'kind': token, 'name': var_name, 'value': value, 'line': line}
+        elif token in ('print', 'console.log'):
+            self.next_token()
+            value = self.parse_expression()
+            node = {'type': 'print', 'value': value, 'line': line}
+        elif token == 'if':
+            self.next_token()
+            condition = self.parse_expression()
+            body = self.parse_block()
+            else_body = []
+            if self.current_token == 'else':
+                self.next_token()
+                if self.current_token == 'if':
+                    else_body = [self.parse_statement()]  # else if
+                else:
+                    else_body = self.parse_block()
+            node = {'type': 'if', 'condition': condition, 'body': body, 'else_body': else_body, 'line': line}
+        elif token == 'for':
+            var_name = self.variable_name(token)
+            self.expect('in')
+            collection = self.parse_expression()
+            body = self.parse_loop_block()
+            node = {'type': 'for', 'var': var_name, 'collection': collection, 'body': body, 'line': line}
+        elif token == 'switch':
+            node = self.parse_switch(line)
+        elif token == 'while':
+            self.next_token()
+            condition = self.parse_expression()
+            body = self.parse_loop_block()
+            node = {'type': 'while', 'condition': condition, 'body': body, 'line': line}
+        elif token == 'do':
+            self.next_token()
+            body = self.parse_loop_block()
+            self.expect('while')
+            condition = self.parse_expression()
+            node = {'type': 'do_while', 'condition': condition, 'body': body, 'line': line}
+        elif token == 'break':
+            if not self.breakable:
+                raise self.error("'break' outside a switch or loop")
+            self.next_token()
+            node = {'type': 'break', 'line': line}
+        elif token == 'delete':
+            name = self.variable_name(token)
+            node = {'type': 'delete', 'name': name, 'line': line}
+        elif token == 'import':
+            path = self.next_token()
+            if path is None or path[0] != '"':
+                raise self.error("Expected a module path string after 'import'")
+            self.next_token()
+            node = {'type': 'import', 'path': path[1:-1], 'line': line}
+        elif token == 'continue':
+            if not self.loops:
+                raise self.error("'continue' outside a loop")
+            self.next_token()
+            node = {'type': 'continue', 'line': line}
+        elif token not in KEYWORDS and (token[0].isalpha() or token[0] == '_'):
+            target = self.parse_expression()
+            if self.current_token != '=':
+                # An expression run for its effect, such as a call of parallel() or tasks()
+                node = {'type': 'expression_statement', 'value': target, 'line': line}
+            elif target['type'] == 'name':
+                # Plain assignment to an existing name, or to one item of it
+                self.next_token()
+                node = {'type': 'variable_assignment', 'kind': None, 'name': token,
+                        'value': self.parse_expression(), 'line': line}
+            elif target['type'] == 'index' and target['target']['type'] == 'name':
+                self.next_token()
+                node = {'type': 'index_assignment', 'name': token, 'index': target['index'],
+                        'value': self.parse_expression(), 'line': line}
+            else:
+                raise self.error("Only a name or one item of it can be assigned to")
+        elif token == ';':
+            self.next_token()
+            return None
+        else:
+            raise self.error(f"Unexpected {token!r}")
+        if self.current_token == ';':
+            self.next_token()
+        return node
+
+    def parse_statements(self, stop=()):
+        statements = []
+        while self.current_token is not None and self.current_token not in stop:
+            node = self.parse_statement()
+            if node is not None:
+                statements.append(node)
+        return statements
+
+    def parse(self):
+        return self.parse_statements()
+
+def ends_statement(line, following=None):
+    # True if the line, minus a trailing comment, ends a top-level statement: with ';';
+    # with '}' unless the next token, in the lines following() returns, is `else` or
+    # `while`, which go on with an if or a do-while; or, in code without semicolons,
+    # with anything but `else` when the next token can only start a statement. A '}'
+    # then `while` can also be an if followed by a while loop; keeping the two in one
+    # segment still parses the same
+    if isinstance(line, str):
+        text = COMMENT_TAIL_RE.sub('', line).rstrip()
+        semicolon, brace, open_tail = ';', '}', OPEN_TAIL_RE
+        continuation, statement_start = CONTINUATION_RE, STATEMENT_START_RE
+    else:
+        text = BYTES_COMMENT_TAIL_RE.sub(b'', line).rstrip()
+        semicolon, brace, open_tail = b';', b'}', BYTES_OPEN_TAIL_RE
+        continuation, statement_start = BYTES_CONTINUATION_RE, BYTES_STATEMENT_START_RE
+    tail = text[-1:]
+    if tail == semicolon:
+        return True
+    if not text or following is None:
+        return tail == brace
+    found = first_token(following())
+    if tail == brace:
+        return found is None or continuation.match(*found) is None
+    return found is not None and statement_start.match(*found) is not None and open_tail.search(text) is None
+
+def blank_line(line):
+    # Only whitespace and comments
+    return (SKIP_RE if isinstance(line, str) else BYTES_SKIP_RE).match(line).end() == len(line)
+
+def first_token(lines):
+    # (line, offset) of the first token in lines, or None if they have none
+    for line in lines:
+        start = (SKIP_RE if isinstance(line, str) else BYTES_SKIP_RE).match(line).end()
+        if start < len(line):
+            return line, start
+    return None
+
+def lines_after(code, pos):
+    # The lines of code from pos on, sliced one at a time
+    newline = '\n' if isinstance(code, str) else b'\n'
+    while pos < len(code):
+        end = code.find(newline, pos)
+        end = len(code) if end == -1 else end + 1
+        yield code[pos:end]
+        pos = end
+
+def statement_end(code, lo, hi):
+    # First line break in [lo, hi) that follows a complete statement
+    newline = '\n' if isinstance(code, str) else b'\n'
+
+    def following():
+        return lines_after(code, pos + 1)
+    pos = code.find(newline, lo, hi)
+    while pos != -1:
+        if ends_statement(code[code.rfind(newline, 0, pos) + 1:pos], following):
+            return pos + 1
+        pos = code.find(newline, pos + 1, hi)
+    return None
+
+def split_statements(lines, start=0, stop=None):
+    # Yield (first, end) line ranges of top-level statements in lines[start:],
+    # using the same rule as statement_end; ends early once stop(end) is true
+    if start >= len(lines):
+        return
+    if isinstance(lines[start], str):
+        pattern, open_brace, close_brace, quotes = BOUNDARY_RE, '{', '}', ('"', '`', '//')
+    else:
+        pattern, open_brace, close_brace, quotes = BYTES_BOUNDARY_RE, b'{', b'}', (b'"', b'`', b'//')
+    depth = 0
+    first = start
+
+    def following():
+        return map(lines.__getitem__, range(index + 1, len(lines)))
+    for index in range(start, len(lines)):
+        line = lines[index]
+        if quotes[0] in line or quotes[1] in line or quotes[2] in line:
+            for match in pattern.finditer(line):
+                token = match.group()
+                if token == open_brace:
+                    depth += 1
+                elif token == close_brace:
+                    depth = max(0, depth - 1)
+        else:
+            depth = max(0, depth + line.count(open_brace) - line.count(close_brace))
+        if depth == 0 and ends_statement(line, following):
+            yield first, index + 1
+            if stop is not None and stop(index + 1):
+                return
+            first = index + 1
+    if first < len(lines):
+        yield first, len(lines)
+
+def find_statement_boundaries(code, chunks):
+    # Split offsets at top-level statement ends, outside braces and string literals
+    size = len(code)
+    targets = [size * i // chunks for i in range(1, chunks)]
+    if isinstance(code, str):
+        pattern, open_brace, close_brace = BOUNDARY_RE, '{', '}'
+    else:
+        pattern, open_brace, close_brace = BYTES_BOUNDARY_RE, b'{', b'}'
+    boundaries = [0]
+    depth = last = target = 0
+
+    def take(region_end):
+        # [last, region_end) is at depth 0
+        nonlocal target
+        while target < len(targets):
+            cut = statement_end(code, max(targets[target], last, boundaries[-1]), region_end)
+            if cut is None:
+                return
+            boundaries.append(cut)
+            while target < len(targets) and targets[target] < cut:
+                target += 1
+
+    for match in pattern.finditer(code):
+        if target == len(targets):
+            break
+        if depth == 0 and match.start() > targets[target]:
+            take(match.start())
+        token = match.group()
+        if token == open_brace:
+            depth += 1
+        elif token == close_brace:
+            depth = max(0, depth - 1)
+        last = match.end()
+    if depth == 0:
+        take(size)
+    if boundaries[-1] != size:
+        boundaries.append(size)
+    return boundaries
+
+def parse_file_chunk(file_name, start, end, first_line):
+    code = load_source(file_name)
+    try:
+        lexer = Lexer(code, start, end, first_line)
+        return Parser(lexer.tokens, lexer).parse()
+    finally:
+        if isinstance(code, mmap.mmap):
+            code.close()
+
+def parse_parallel(file_name, workers=None):
+    # Lex and parse top-level statement chunks in a process pool; each worker maps the file itself
+    workers = workers or os.cpu_count() or 1
+    code = load_source(file_name)
+    try:
+        boundaries = find_statement_boundaries(code, workers * 2)
+        first_lines = [1]
+        for start, end in zip(boundaries, boundaries[1:-1]):
+            first_lines.append(first_lines[-1] + count_newlines(code, start, end))
+    finally:
+        if isinstance(code, mmap.mmap):
+            code.close()
+    starts, ends = boundaries[:-1], boundaries[1:]
+    if workers == 1 or len(starts) == 1:  # a pool would only add its startup to one chunk
+        parts = map(parse_file_chunk, [file_name] * len(starts), starts, ends, first_lines)
+        return [node for part in parts for node in part]
+    with ProcessPoolExecutor(max_workers=workers, mp_context=PROCESSES) as executor:
+        parts = executor.map(parse_file_chunk, [file_name] * len(starts), starts, ends, first_lines)
+        return [node for part in parts for node in part]
+
+def common_prefix(a, b):
+    # Length of the common prefix of two lists, by binary search over C-level slice compares
+    lo, hi = 0, min(len(a), len(b))
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[lo:mid] == b[lo:mid]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+def common_suffix(a, b, limit):
+    lo, hi = 0, limit
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[len(a) - mid:len(a) - lo] == b[len(b) - mid:len(b) - lo]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+def parse_segment(lines, first, end, symbols=None):
+    lexer = Lexer(lines[first][:0].join(lines[first:end]), first_line=first + 1, symbols=symbols)
+    return Parser(lexer.tokens, lexer).parse()
+
+def shift_lines(node, shift):
+    # Copy of a reused statement moved by `shift` lines, nested block statements included
+    if isinstance(node, list):
+        return [shift_lines(item, shift) for item in node]
+    if isinstance(node, dict):
+        moved = {key: shift_lines(value, shift) for key, value in node.items()}
+        if 'line' in moved:
+            moved['line'] += shift
+        return moved
+    return node
+
+class IncrementalParser:
+    # Keeps the previous run's lines, statement spans and ASTs for one file. A re-run
+    # re-splits and re-parses from the first edited statement until the split lines up
+    # with an old statement boundary inside the unchanged tail, then reuses the rest.
+    def __init__(self):
+        self.lines = []
+        self.spans = []  # (first, end) line ranges of top-level statements
+        self.asts = []   # nodes per span
+        self.reparsed = 0
+        self.symbols = SymbolTable()  # shared by every statement of the file, over all runs
+        self.lock = threading.Lock()
+
+    def parse(self, code):
+        lines = split_lines(code)
+        with self.lock:
+            old_lines, old_spans, old_asts = self.lines, self.spans, self.asts
+            prefix = common_prefix(old_lines, lines)
+            suffix = common_suffix(old_lines, lines, min(len(old_lines), len(lines)) - prefix)
+            shift = len(lines) - len(old_lines)
+            old_starts = [first for first, _ in old_spans]
+            tail = len(old_lines) - suffix
+
+            keep = bisect.bisect_right([end for _, end in old_spans], prefix)
+            if lines != old_lines:
+                # Where a statement ends can depend on the lines after it: on a missing ';',
+                # or on an `else` or `while` after its '}'. So one followed by the edit, or
+                # by nothing but blank and comment lines before it, is parsed again
+                while keep and all(map(blank_line, lines[old_spans[keep - 1][1]:prefix])):
+                    keep -= 1
+            spans, asts = old_spans[:keep], old_asts[:keep]
+            start = spans[-1][1] if spans else 0
+
+            def aligned(end):
+                old_end = end - shift
+                if old_end < tail:
+                    return False
+                index = bisect.bisect_left(old_starts, old_end)
+                return index < len(old_starts) and old_starts[index] == old_end
+
+            for first, end in split_statements(lines, start, aligned if old_spans else None):
+                spans.append((first, end))
+                asts.append(parse_segment(lines, first, end, self.symbols))
+            self.reparsed = len(spans) - keep
+
+            resume = bisect.bisect_left(old_starts, (spans[-1][1] if spans else 0) - shift)
+            if spans and resume < len(old_spans) and old_starts[resume] == spans[-1][1] - shift:
+                for (first, end), nodes in zip(old_spans[resume:], old_asts[resume:]):
+                    spans.append((first + shift, end + shift))
+                    asts.append(nodes if shift == 0 else shift_lines(nodes, shift))
+
+            self.lines, self.spans, self.asts = lines, spans, asts
+            return [node for nodes in asts for node in nodes]
+
+NUMBER_TYPES = (int, float)
+NUMBER_SET = frozenset(NUMBER_TYPES)
+LITERAL_TYPES = ('number', 'string', 'constant')
+
+class StringBuilder:
+    # Value of a string variable grown with `s = s + piece`. Appends share one parts
+    # list; a builder covers its first `count` parts, so an alias taken earlier never
+    # sees later appends, and the text is joined once, when it is read.
+    __slots__ = ('parts', 'count', 'text')
+
+    def __init__(self, parts):
+        self.parts = parts
+        self.count = len(parts)
+        self.text = None
+
+    def append(self, piece):
+        parts = self.parts
+        if self.count != len(parts):
+            parts = parts[:self.count]  # another alias already appended here
+        parts.append(piece)
+        return StringBuilder(parts)
+
+    def __str__(self):
+        if self.text is None:
+            self.text = ''.join(self.parts[:self.count])
+        return self.text
+
+def slice_bounds(length, start, stop):
+    # JS slice() bounds: negative values count from the end, both are clamped
+    return slice(start, stop).indices(length)[:2]
+
+def compact(items):
+    # A list, or a typed buffer when every item is an int or every item a float
+    items = list(items)
+    kind = type(items[0]) if items else None
+    if kind in (int, float) and all(type(item) is kind for item in items):
+        try:
+            return array.array('q' if kind is int else 'd', items)
+        except OverflowError:
+            pass
+    return items
+
+class ArrayView:
+    # Result of slice/splice/map/filter: the source array and the stages still to apply.
+    # The first consumer runs every stage in one fused pass over the source, with no
+    # intermediate arrays; a second consumer materializes the result once. Callbacks
+    # run when the view is consumed, with the variable values they captured.
+    __slots__ = ('source', 'stages', 'items', 'consumed')
+
+    def __init__(self, source, stages):
+        self.source = source  # a list, a stream, a shared array's copy or another view's items
+        # ('map', fn), ('filter', fn), ('slice', start, stop) or ('splice', start, count, items)
+        self.stages = stages
+        self.items = None if stages else source  # e.g. range(): nothing to compute
+        self.consumed = False
+
+    def extend(self, stage):
+        if self.items is None and not self.consumed:
+            return ArrayView(self.source, self.stages + (stage,))
+        return ArrayView(self.values(), (stage,))
+
+    def values(self):
+        if self.items is None:
+            self.items = compact(self.run())
+        return self.items
+
+    def __iter__(self):
+        # Every pass has safepoints, including one over a stage-less range()
+        if self.items is not None or self.consumed:
+            return budgeted(self.values())
+        self.consumed = True
+        return self.run()
+
+    def __len__(self):
+        # Computed from the stages unless a filter makes the length depend on the items
+        if self.items is not None:
+            return len(self.items)
+        if type(self.source) is Stream:
+            return self.count()
+        length = len(self.source)
+        for stage in self.stages:
+            if stage[0] == 'filter':
+                return self.count()
+            if stage[0] == 'slice':
+                start, stop = slice_bounds(length, stage[1], stage[2])
+                length = max(0, stop - start)
+            elif stage[0] == 'splice':
+                start = slice_bounds(length, stage[1], None)[0]
+                count = length - start if stage[2] is None else min(max(0, stage[2]), length - start)
+                length += len(stage[3]) - count
+        return length
+
+    def count(self):
+        # Length that depends on the items (a filter, or a stream source)
+        if self.consumed:
+            return len(self.values())
+        self.consumed = True
+        return sum(1 for _ in self.run())  # counted in the fused pass, not stored
+
+    def __eq__(self, other):
+        if type(other) in ARRAY_TYPES:
+            return list(self) == list(other)
+        return NotImplemented
+
+    __hash__ = None
+
+    def run(self):
+        # Each stage wraps the iterator of the one before; the length is tracked while it
+        # is known, and an unknown one is only needed for negative bounds
+        source, stages = self.source, self.stages
+        if stages and stages[0][0] == 'slice' and type(source) in (SharedArray, range):
+            # Sliced without copying, instead of skipping items one by one
+            start, stop = slice_bounds(len(source), stages[0][1], stages[0][2])
+            source, stages = source[start:stop], stages[1:]
+        if type(source) is Stream:
+            items, length = source.open_records(), None  # the safepoints are added below
+        else:
+            items, length = iter(source), len(source)
+        for stage in stages:
+            kind = stage[0]
+            if kind == 'map':
+                items = map(stage[1], items)
+            elif kind == 'filter':
+                items, length = filter(stage[1], items), None
+            else:
+                start, stop = stage[1], stage[2] if kind == 'slice' else None
+                if length is None and kind == 'slice' and start >= 0 and stop is not None and stop < 0:
+                    items = drop_last(itertools.islice(items, start, None), -stop)
+                    continue
+                if length is None and (start < 0 or (stop is not None and stop < 0)):
+                    buffered = list(items)
+                    items, length = iter(buffered), len(buffered)
+                if length is not None:
+                    start, stop = slice_bounds(length, start, stop)
+                if kind == 'slice':
+                    items = itertools.islice(items, start, stop)
+                    if length is not None:
+                        length = max(0, stop - start)
+                else:
+                    inserted = stage[3]
+                    if stage[2] is None:  # no count: everything from start is removed
+                        items = itertools.chain(itertools.islice(items, start), inserted)
+                        count = length - start if length is not None else 0
+                    else:
+                        count = max(0, stage[2])
+                        items = itertools.chain(itertools.islice(items, start), inserted,
+                                                itertools.islice(items, count, None))
+                    if length is not None:
+                        length += len(inserted) - min(count, length - start)
+        return budgeted(items)
+
+def budgeted(items):
+    # An iterator over items with the safepoints of the budget of the run on this thread
+    budget = getattr(CURRENT_SCOPE, 'budget', None)
+    return iter(items) if budget is None else budget.items(items)
+
+def drop_last(items, count):
+    # All but the last `count` items, without knowing the length in advance
+    window = collections.deque(itertools.islice(items, count))
+    for item in items:
+        window.append(item)
+        yield window.popleft()
+
+class SharedArray:
+    # A numeric array in a shared memory block that every process holding it reads and
+    # writes in place. Pickling sends only the block's name. The process that allocated
+    # the block owns it and unlinks it once the array is collected or the process exits;
+    # the others only unmap it.
+    __slots__ = ('memory', 'items', '__weakref__')
+
+    def __init__(self, memory, typecode, length, owner):
+        self.memory = memory
+        self.items = memory.buf[:length * array.array(typecode).itemsize].cast(typecode)
+        weakref.finalize(self, release_shared, memory, self.items, owner)
+
+    @classmethod
+    def allocate(cls, typecode, length, items=None):
+        # A new block of zeros, or a copy of items, a buffer of that typecode ('q' or 'd')
+        memory = shared_memory.SharedMemory(create=True, size=max(1, length * array.array(typecode).itemsize))
+        shared = cls(memory, typecode, length, True)
+        if items is not None:
+            shared.items[:] = items
+        return shared
+
+    def __reduce__(self):
+        return attach_shared, (self.memory.name, self.items.format, len(self.items))
+
+    def __len__(self):
+        return len(self.items)
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __getitem__(self, index):
+        return self.items[index]
+
+    def snapshot(self, start=0, stop=None):
+        # A typed buffer copy of items[start:stop] as they are now, copied as bytes
+        copy = array.array(self.items.format)
+        copy.frombytes(self.items[start:stop].cast('B'))
+        return copy
+
+    def __eq__(self, other):
+        if type(other) in ARRAY_TYPES:
+            return list(self) == list(other)
+        return NotImplemented
+
+    __hash__ = None
+
+    def store(self, index, value):
+        if not 0 <= index < len(self.items):
+            raise PNError(f"Index {index} is out of range for a shared array of length {len(self.items)}")
+        if self.items.format == 'd':
+            if type(value) not in NUMBER_TYPES:
+                raise PNError(f"Cannot store {type_name(value)} in a shared float array")
+            value = float(value)
+        elif type(value) is not int:
+            raise PNError(f"Cannot store {type_name(value)} in a shared int array")
+        elif not -2 ** 63 <= value < 2 ** 63:
+            raise PNError("Shared int arrays hold 64-bit values")
+        self.items[index] = value
+
+def attach_shared(name, typecode, length):
+    return SharedArray(shared_memory.SharedMemory(name=name), typecode, length, False)
+
+def release_shared(memory, items, owner):
+    items.release()
+    try:
+        memory.close()
+    except BufferError:
+        pass  # an iterator still maps it; the mapping goes when the process exits
+    if owner:
+        memory.unlink()
+
+ARRAY_TYPES = (list, ArrayView, SharedArray)
+
+def integer_argument(method, value):
+    if type(value) is not int:
+        raise PNError(f"{method}() expects int arguments, not {type_name(value)}")
+    return value
+
+def array_method(target, name, args, lazy=True):
+    # slice/splice/map/filter build a view over the array; with lazy=False each call
+    # produces a new list, as an eager implementation would
+    if type(target) not in ITERABLE_TYPES:
+        raise PNError(f"Cannot call {name}() on {type_name(target)}")
+    if name in ('map', 'filter'):
+        if len(args) != 1 or not callable(args[0]):
+            raise PNError(f"{name}() expects a function")
+        stage = (name, args[0])
+    elif name == 'slice':
+        if len(args) > 2:
+            raise PNError("slice() expects at most 2 arguments")
+        bounds = [integer_argument(name, arg) for arg in args]
+        stage = ('slice', bounds[0] if bounds else 0, bounds[1] if len(bounds) > 1 else None)
+    else:
+        if not args:
+            raise PNError("splice() expects a start index")
+        start = integer_argument(name, args[0])
+        count = integer_argument(name, args[1]) if len(args) > 1 else None
+        stage = ('splice', start, count, tuple(args[2:]))
+    if type(target) is ArrayView:
+        view = target.extend(stage)
+    elif type(target) is SharedArray:
+        # Written in place, so a view reads a copy taken now, as the eager result would;
+        # a slice copies only its own items
+        if stage[0] == 'slice':
+            view = ArrayView(target.snapshot(*slice_bounds(len(target), stage[1], stage[2])), ())
+        else:
+            view = ArrayView(target.snapshot(), (stage,))
+    else:
+        view = ArrayView(target, (stage,))
+    return view if lazy else list(view.run())
+
+def call_value(function, args):
+    if not callable(function):
+        raise PNError(f"{type_name(function)} is not a function")
+    # Checked up front, so a TypeError raised inside the function is not mistaken for
+    # a wrong call. Values an arrow captured are keyword-only and never take an argument.
+    code = function.__code__
+    if len(args) < code.co_argcount - len(function.__defaults__ or ()) \
+            or len(args) > code.co_argcount and not code.co_flags & inspect.CO_VARARGS:
+        raise PNError(f"Wrong number of arguments ({len(args)}) in call")
+    return function(*args)
+
+def array_items(name, value):
+    if type(value) not in ITERABLE_TYPES:
+        raise PNError(f"{name}() expects an array, not {type_name(value)}")
+    return value
+
+def checked_number(item):
+    if type(item) not in NUMBER_TYPES:
+        raise PNError(f"Expected numbers, not {type_name(item)}")
+    return item
+
+def numbers(name, value):
+    # Items of an array checked to be numbers, without copying them; an unconsumed
+    # view is checked item by item as it streams
+    items = array_items(name, value)
+    if type(items) is ArrayView:
+        if items.items is None and not items.consumed:
+            if type(items.source) in (SharedArray, range, array.array) \
+                    and all(stage[0] in ('slice', 'filter') for stage in items.stages):
+                return items  # a selection of numbers is numbers
+            return map(checked_number, items)
+        items = items.values()
+        if type(items) is range:
+            return budgeted(items)  # numbers, but possibly billions of them
+    elif type(items) is Stream:
+        return map(checked_number, items)
+    elif type(items) is SharedArray:
+        return items.items
+    if type(items) is list and not set(map(type, items)) <= NUMBER_SET:
+        raise PNError(f"{name}() expects numbers")
+    return items  # a list of numbers, a range or a typed buffer
+
+def builtin_range(*args):
+    # Lazy: a view over a Python range, so nothing is allocated per item
+    if not 1 <= len(args) <= 3:
+        raise PNError("range() expects 1 to 3 arguments")
+    bounds = [integer_argument('range', arg) for arg in args]
+    if len(bounds) == 3 and bounds[2] == 0:
+        raise PNError("range() step must not be zero")
+    return ArrayView(range(*bounds), ())
+
+def builtin_sum(items):
+    if type(items) is ArrayView and type(items.items) is range:
+        numbers_range = items.items  # closed form
+        return len(numbers_range) * (numbers_range[0] + numbers_range[-1]) // 2 if numbers_range else 0
+    return sum(numbers('sum', items))
+
+def extreme(name, function, args):
+    # min()/max() of one array, or of the arguments themselves; null when empty
+    values = numbers(name, args[0]) if len(args) == 1 and type(args[0]) in ITERABLE_TYPES else numbers(name, list(args))
+    return function(values, default=None)
+
+def builtin_sort(items, key=None):
+    # A new sorted array (the argument is not changed); key is a function of one item
+    items = array_items('sort', items)
+    if key is not None and not callable(key):
+        raise PNError("sort() key must be a function")
+    try:
+        return sorted(items, key=key)
+    except TypeError:
+        raise PNError("sort() cannot compare items of different types") from None
+
+def builtin_join(items, separator=','):
+    items = array_items('join', items)
+    if type(separator) is not str:
+        raise PNError(f"join() separator must be a string, not {type_name(separator)}")
+    if type(items) is list and set(map(type, items)) <= {int, str}:
+        return separator.join(map(str, items))  # str() is format_value for these
+    return separator.join(map(format_value, items))
+
+class Stream:
+    # Records read lazily from a file or stdin, as a for loop collection or the source of
+    # a view. Only one chunk is held at a time. Each pass over a file stream reads the file
+    # again; passes over stdin continue where the last one stopped.
+    __slots__ = ('label', 'open_records')
+
+    def __init__(self, label, open_records):
+        self.label = label
+        self.open_records = open_records  # () -> iterator over the records
+
+    def __iter__(self):
+        return budgeted(self.open_records())
+
+def read_lines(stream):
+    # Lines without their line endings, decoded from large binary reads; splitting a
+    # whole chunk at once is about twice as fast as reading a text file line by line
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    rest = ''
+    try:
+        while True:
+            data = stream.read(STREAM_CHUNK)
+            text = rest + decoder.decode(data, final=not data)
+            if not data:
+                break
+            lines = text.split('\n')
+            rest = lines.pop()
+            if '\r' in text:
+                lines = [line[:-1] if line.endswith('\r') else line for line in lines]
+            yield from lines
+    except UnicodeDecodeError as error:
+        raise PNError(f"Input is not valid UTF-8: {error.reason}") from None
+    if rest:
+        yield rest[:-1] if rest.endswith('\r') else rest
+
+def file_records(path, read):
+    # Opens the file when a pass starts and closes it when the pass ends or is abandoned
+    try:
+        file = open(path, 'rb') if read is read_lines else open(path, encoding='utf-8', newline='',
+                                                                 buffering=STREAM_CHUNK)
+    except OSError as error:
+        raise PNError(f"Cannot open {path!r}: {error.strerror}") from None
+    with file:
+        try:
+            yield from read(file)
+        except UnicodeDecodeError as error:
+            raise PNError(f"{path!r} is not valid UTF-8: {error.reason}") from None
+
+def read_csv(file):
+    return map(list, csv.reader(file))
+
+def file_argument(name, path):
+    if type(path) is not str:
+        raise PNError(f"{name}() expects a file path, not {type_name(path)}")
+    if not os.path.isfile(path):
+        raise PNError(f"{name}(): no such file {path!r}")
+    return path
+
+def builtin_lines(path):
+    path = file_argument('lines', path)
+    return Stream(f'lines("{path}")', lambda: file_records(path, read_lines))
+
+def builtin_csv(path):
+    # Each record is an array of strings; quoted fields may span lines
+    path = file_argument('csv', path)
+    return Stream(f'csv("{path}")', lambda: file_records(path, read_csv))
+
+def stdin_records():
+    # One reader for the whole run, created on first use, so a later pass resumes it
+    if STDIN_READER[0] is None:
+        binary = getattr(sys.stdin, 'buffer', None)
+        STDIN_READER[0] = read_lines(binary) if binary is not None else (line.rstrip('\n') for line in sys.stdin)
+    return STDIN_READER[0]
+
+STDIN_READER = [None]
+ITERABLE_TYPES = (*ARRAY_TYPES, Stream)  # accepted by the builtins and array methods
+
+def builtin_shared(value):
+    # shared(n): n int zeros; shared(items): a copy of an array of numbers, of floats if
+    # any item is one. Typed buffers are copied as they are, without a list in between.
+    if type(value) is int:
+        if value < 0:
+            raise PNError("shared() size must not be negative")
+        return SharedArray.allocate('q', value)
+    items = numbers('shared', value)
+    if type(items) is memoryview:
+        return SharedArray.allocate(items.format, len(items), items)
+    if type(items) is array.array:
+        return SharedArray.allocate(items.typecode, len(items), items)
+    items = list(items)
+    typecode = 'd' if any(type(item) is float for item in items) else 'q'
+    try:
+        return SharedArray.allocate(typecode, len(items), array.array(typecode, items))
+    except OverflowError:
+        raise PNError("Shared int arrays hold 64-bit values") from None
+
+def store_index(target, index, value):
+    # `name[index] = value`; only shared arrays are written in place, other arrays stay
+    # values, so views over them and hoisted reads remain valid
+    if type(target) is not SharedArray:
+        raise PNError(f"Cannot assign to an index of {type_name(target)}; only shared arrays can be changed")
+    if type(index) is not int:
+        raise PNError(f"Index must be an int, not {type_name(index)}")
+    target.store(index, value)
+
+def portable(value):
+    # A value that can be pickled to another process; views are materialized first
+    if type(value) is StringBuilder:
+        return str(value)
+    if type(value) is ArrayView:
+        return ArrayView(value.values(), ())
+    if type(value) is list:
+        return [portable(item) for item in value]
+    if callable(value) or type(value) is Stream:
+        raise PNError(f"A {type_name(value)} cannot be sent to another process")
+    return value
+
+def run_worker(path, worker, workers, args, limits):
+    # One worker of parallel(), bounded by the caller's remaining (max_steps, seconds,
+    # max_memory): returns (output, result, error), error being the PNError raised
+    output = io.StringIO()
+    try:
+        lexer = Lexer(read_module(path))
+        interpreter = Interpreter(Parser(lexer.tokens, lexer).parse(), file_name=path, budget=Budget(*limits))
+        variables = interpreter.memory.variables
+        variables.update(worker=worker, workers=workers, args=args)
+        with contextlib.redirect_stdout(output):
+            interpreter.interpret()
+        return output.getvalue(), portable(variables.get('result')), None
+    except PNError as error:
+        return output.getvalue(), None, error
+
+def stop_pool(executor):
+    # Ends a ProcessPoolExecutor at once: queued calls are dropped and the running
+    # ones killed, as they would otherwise go on after the run that started them
+    processes = list((getattr(executor, '_processes', None) or {}).values())
+    executor.shutdown(wait=False, cancel_futures=True)
+    for process in processes:
+        process.kill()
+    for process in processes:
+        process.join()
+
+def builtin_parallel(path, workers, *args):
+    # Runs a .pn file in `workers` processes, each with `worker` (0-based), `workers`
+    # and `args` bound; returns the `result` each one left. Shared arrays in args are
+    # passed by name, any other value is copied into every worker. The workers get what
+    # is left of the caller's budget, and the caller stays at a safepoint while it waits.
+    path = file_argument('parallel', path)
+    if integer_argument('parallel', workers) < 1:
+        raise PNError("parallel() needs at least one worker")
+    args = [portable(arg) for arg in args]
+    budget = getattr(CURRENT_SCOPE, 'budget', None) or Budget()
+    limits = budget.remaining()
+    executor = ProcessPoolExecutor(max_workers=workers, mp_context=PROCESSES)
+    try:
+        futures = [executor.submit(run_worker, path, worker, workers, args, limits) for worker in range(workers)]
+        pending = futures
+        while pending:
+            budget.check_all()
+            _, pending = wait(pending, PARALLEL_CHECK_SECONDS)
+        finished = [future.result() for future in futures]
+    except BaseException:
+        stop_pool(executor)
+        raise
+    executor.shutdown()
+    for worker, (output, _, error) in enumerate(finished):
+        sys.stdout.write(output)
+        if error is not None:
+            raise type(error)(f"worker {worker}: {error}")
+    return [result for _, result, _ in finished]
+
+class Scope(dict):
+    # Copy-on-write variables of a task: names are read from the task's own bindings,
+    # else from the parent's; writes and deletes stay here unless merged by merge_scopes.
+    # Creating one copies nothing, so a task over a large program costs the same as over
+    # an empty one. A string the parent built with appends is read as a str, so that
+    # tasks do not append to its parts list from several threads.
+    __slots__ = ('parent', 'deleted')
+
+    def __init__(self, parent):
+        super().__init__()
+        self.parent = parent
+        self.deleted = ()  # names removed here, which the parent's bindings must not show through
+
+    def __missing__(self, name):
+        if name in self.deleted:
+            raise KeyError(name)
+        value = self.parent[name]
+        return str(value) if type(value) is StringBuilder else value
+
+    def __contains__(self, name):
+        return dict.__contains__(self, name) or name not in self.deleted and name in self.parent
+
+    def get(self, name, default=None):
+        value = dict.get(self, name, MISSING)
+        if value is not MISSING:
+            return value
+        if name in self.deleted:
+            return default
+        value = self.parent.get(name, default)
+        return str(value) if type(value) is StringBuilder else value
+
+    def pop(self, name, default=None):
+        # Every removal of a name, by delete or at the end of its block
+        if not self.deleted:
+            self.deleted = set()
+        self.deleted.add(name)
+        return dict.pop(self, name, default)
+
+def merge_scopes(scopes, rule, injected=()):
+    # Writes of sibling scopes back into their parent, in scope order (not completion
+    # order), so the outcome does not depend on scheduling. Names in `injected`, bound
+    # for each scope by its runner, are never written back:
+    #   discard    nothing is written back
+    #   new        names the parent does not have; the first scope to bind one wins
+    #   overwrite  every binding; the last scope to bind a name wins
+    #   strict     every binding, but two scopes binding a name to different values fail
+    if rule not in MERGE_RULES:
+        raise PNError(f"Unknown merge rule {rule!r}; expected one of {', '.join(MERGE_RULES)}")
+    if rule == 'discard' or not scopes:
+        return
+    parent = scopes[0].parent
+    writes = [{name: str(value) if type(value) is StringBuilder else value
+               for name, value in dict.items(scope) if name not in injected} for scope in scopes]
+    if rule == 'new':
+        for scope in writes:
+            for name, value in scope.items():
+                if name not in parent:
+                    parent[name] = value
+        return
+    if rule == 'strict':
+        writers = {}
+        for index, scope in enumerate(writes):
+            for name, value in scope.items():
+                first = writers.setdefault(name, (index, value))
+                if first[0] != index and not equals(first[1], value):
+                    raise PNError(f"Tasks {first[0]} and {index} wrote different values to {name!r}")
+    for scope in writes:
+        parent.update(scope)
+
+MERGE_RULES = ('discard', 'new', 'overwrite', 'strict')
+CURRENT_SCOPE = threading.local()  # variables and budget of the program running on this thread
+
+class TaskOutput(io.TextIOBase):
+    # sys.stdout while tasks run: each task thread prints into its own buffer, any other
+    # thread to the stream that was there before
+    def __init__(self, fallback):
+        self.fallback = fallback
+        self.local = threading.local()
+
+    def writable(self):
+        return True
+
+    def write(self, text):
+        return getattr(self.local, 'buffer', self.fallback).write(text)
+
+    def flush(self):
+        self.fallback.flush()
+
+def run_tasks(ast, parent, count, bindings, merge='discard', file_name=None):
+    # Runs a program `count` times at once on threads, each task in its own Scope over
+    # `parent` with bindings(task) added; returns (output, scope) per task, in task order.
+    # The tasks' writes are then merged into `parent` by the merge rule.
+    merge_scopes([], merge)  # an unknown rule fails before any task runs
+    output = TaskOutput(sys.stdout)
+    budget = getattr(CURRENT_SCOPE, 'budget', None)  # of the caller, charged by every task
+
+    def run(task):
+        interpreter = Interpreter(ast, file_name=file_name, scope=parent, budget=Budget(parent=budget))
+        interpreter.memory.variables.update(bindings(task))
+        output.local.buffer = buffer = io.StringIO()
+        try:
+            interpreter.interpret()
+        except PNError as error:
+            raise type(error)(f"task {task}: {error}") from None
+        return buffer.getvalue(), interpreter.memory.variables
+
+    sys.stdout = output
+    try:
+        with ThreadPoolExecutor(max_workers=min(count, TASK_THREADS)) as executor:
+            finished = list(executor.map(run, range(count)))
+    finally:
+        if sys.stdout is output:
+            sys.stdout = output.fallback
+    merge_scopes([scope for _, scope in finished], merge, set(bindings(0)))
+    return finished
+
+def builtin_tasks(path, count, *args):
+    # Runs a .pn file `count` times concurrently in this process, each task reading the
+    # caller's variables with `task` (0-based), `count` and `args` bound in its own scope;
+    # returns the `result` each one left. Other writes are not merged back.
+    return start_tasks('tasks', path, count, 'discard', args)
+
+def builtin_merge_tasks(path, count, rule, *args):
+    # tasks(), then the tasks' writes are merged into the caller's variables by `rule`,
+    # one of MERGE_RULES. A program that mentions merge_tasks is compiled without the
+    # analyses that assume they know which names a statement assigns (see Compiler.compile).
+    if type(rule) is not str:
+        raise PNError(f"merge_tasks() rule must be a string, not {type_name(rule)}")
+    return start_tasks('merge_tasks', path, count, rule, args)
+
+def start_tasks(name, path, count, merge, args):
+    path = file_argument(name, path)
+    if integer_argument(name, count) < 1:
+        raise PNError(f"{name}() needs at least one task")
+    lexer = Lexer(read_module(path))
+    ast = Parser(lexer.tokens, lexer).parse()
+    parent = getattr(CURRENT_SCOPE, 'variables', None)
+    finished = run_tasks(ast, {} if parent is None else parent, count,
+                         lambda task: {'task': task, 'count': count, 'args': list(args)}, merge, path)
+    results = []
+    for output, scope in finished:
+        sys.stdout.write(output)
+        result = dict.get(scope, 'result')  # the task's own, not one read through from the caller
+        results.append(str(result) if type(result) is StringBuilder else result)
+    return results
+
+def builtin_number(value):
+    # Parses a string such as a csv field; numbers are returned unchanged
+    if type(value) in NUMBER_TYPES:
+        return value
+    if type(value) is str:
+        for parse in (int, float):
+            try:
+                return parse(value)
+            except ValueError:
+                pass
+    raise PNError(f"number() cannot convert {repr_value(value)}")
+
+BUILTINS = {
+    'range': builtin_range,
+    'sum': builtin_sum,
+    'min': lambda *args: extreme('min', min, args),
+    'max': lambda *args: extreme('max', max, args),
+    'sort': builtin_sort,
+    'join': builtin_join,
+    'map': lambda items, function: array_method(items, 'map', [function]),
+    'filter': lambda items, function: array_method(items, 'filter', [function]),
+    'lines': builtin_lines,
+    'csv': builtin_csv,
+    'number': builtin_number,
+    'shared': builtin_shared,
+    'parallel': builtin_parallel,
+    'tasks': builtin_tasks,
+    'merge_tasks': builtin_merge_tasks,
+    'stdin': Stream('stdin', stdin_records),
+}
+
+def index_value(target, index):
+    # Materializes a view; out-of-range indexes give null
+    if type(index) is not int:
+        raise PNError(f"Index must be an int, not {type_name(index)}")
+    if type(target) is ArrayView:
+        target = target.values()
+    elif type(target) not in (list, str, SharedArray):
+        raise PNError(f"Cannot index {type_name(target)}")
+    return target[index] if 0 <= index < len(target) else None
+
+def length_of(value):
+    if type(value) in (list, str, ArrayView, SharedArray):
+        return len(value)
+    if type(value) is Stream:
+        return sum(1 for _ in value)  # one pass, counting
+    raise PNError(f"{type_name(value)} has no length")
+
+def type_name(value):
+    if type(value) is StringBuilder:
+        return 'string'
+    if value is None:
+        return 'null'
+    if type(value) is bool:
+        return 'boolean'
+    return {int: 'int', float: 'float', str: 'string', list: 'array', ArrayView: 'array', SharedArray: 'array',
+            Stream: 'stream'}.get(type(value), type(value).__name__)
+
+def repr_value(value):
+    if value is None:
+        return 'null'
+    if type(value) is bool:
+        return 'true' if value else 'false'
+    if type(value) is str:
+        return f'"{value}"'
+    if type(value) in ARRAY_TYPES:
+        return '[' + ', '.join(repr_value(item) for item in value) + ']'
+    if type(value) is Stream:
+        return f'[stream {value.label}]'
+    if callable(value):
+        return '[function]'
+    return str(value)
+
+def format_value(value):
+    if type(value) is str:
+        return value
+    if type(value) is StringBuilder:
+        return str(value)
+    return repr_value(value)
+
+def operand_error(op, a, b):
+    return PNError(f"Unsupported operand types for {op}: {type_name(a)} and {type_name(b)}")
+
+def generic_add(a, b):
+    if type(a) in NUMBER_TYPES and type(b) in NUMBER_TYPES:
+        return a + b
+    if type(a) is str or type(b) is str:
+        return format_value(a) + format_value(b)
+    if type(a) in ARRAY_TYPES and type(b) in ARRAY_TYPES:
+        return list(a) + list(b)
+    raise operand_error('+', a, b)
+
+def divide(a, b):
+    if not b:
+        raise PNError("Division by zero")
+    if type(a) is int and type(b) is int and a % b == 0:
+        return a // b
+    return a / b
+
+def modulo(a, b):
+    if not b:
+        raise PNError("Division by zero")
+    return a % b
+
+def arithmetic(op, function):
+    def generic(a, b):
+        if type(a) in NUMBER_TYPES and type(b) in NUMBER_TYPES:
+            return function(a, b)
+        raise operand_error(op, a, b)
+    return generic
+
+def ordering(op, function):
+    def generic(a, b):
+        if (type(a) in NUMBER_TYPES and type(b) in NUMBER_TYPES) or (type(a) is str and type(b) is str):
+            return function(a, b)
+        raise operand_error(op, a, b)
+    return generic
+
+def equals(a, b):
+    if type(a) is bool or type(b) is bool:
+        return type(a) is type(b) and a == b
+    return a == b
+
+GENERIC_OPS = {
+    '+': generic_add,
+    '-': arithmetic('-', operator.sub),
+    '*': arithmetic('*', operator.mul),
+    '/': arithmetic('/', divide),
+    '%': arithmetic('%', modulo),
+    '<': ordering('<', operator.lt),
+    '>': ordering('>', operator.gt),
+    '<=': ordering('<=', operator.le),
+    '>=': ordering('>=', operator.ge),
+    '==': equals,
+    '!=': lambda a, b: not equals(a, b),
+}
+
+# int-int fast paths: the operation is inlined and the generic function only runs when a guard fails
+INT_FAST_PATHS = {
+    '+': 'a + b', '-': 'a - b', '*': 'a * b',
+    '/': '(a // b if a % b == 0 else a / b) if b else generic(a, b)',
+    '%': 'a % b if b else generic(a, b)',
+    '<': 'a < b', '>': 'a > b', '<=': 'a <= b', '>=': 'a >= b', '==': 'a == b', '!=': 'a != b',
+}
+FAST_PATH_SOURCE = """
+def make_binary(left, right, generic):
+    def binary():
+        a = left()
+        b = right()
+        if type(a) is int and type(b) is int:
+            return {expr}
+        return generic(a, b)
+    return binary
+
+def make_binary_const(left, b, generic):
+    def binary():
+        a = left()
+        if type(a) is int:
+            return {expr}
+        return generic(a, b)
+    return binary
+"""
+
+def build_fast_paths():
+    factories = {}
+    for op, expr in INT_FAST_PATHS.items():
+        namespace = {}
+        exec(FAST_PATH_SOURCE.format(expr=expr), namespace)
+        factories[op] = (namespace['make_binary'], namespace['make_binary_const'])
+    return factories
+
+FAST_PATHS = build_fast_paths()
+
+# Operations on statically typed operands: no guard, only the zero checks stay
+FLOAT_PATHS = {
+    '+': 'a + b', '-': 'a - b', '*': 'a * b',
+    '/': 'a / b if b else generic(a, b)',
+    '%': 'a % b if b else generic(a, b)',
+    '<': 'a < b', '>': 'a > b', '<=': 'a <= b', '>=': 'a >= b', '==': 'a == b', '!=': 'a != b',
+}
+STRING_PATHS = {
+    '+': 'a + b',
+    '<': 'a < b', '>': 'a > b', '<=': 'a <= b', '>=': 'a >= b', '==': 'a == b', '!=': 'a != b',
+}
+EQUALITY_PATHS = {'==': 'a == b', '!=': 'a != b'}
+SPECIALIZED_SOURCE = """
+def make_binary(left, right, generic):
+    def binary():
+        a = left()
+        b = right()
+        return {expr}
+    return binary
+
+def make_binary_const(left, b, generic):
+    def binary():
+        a = left()
+        return {expr}
+    return binary
+"""
+
+def build_specializations():
+    factories = {}
+    for family, paths in (('int', INT_FAST_PATHS), ('float', FLOAT_PATHS), ('string', STRING_PATHS),
+                          ('any', EQUALITY_PATHS)):
+        for op, expr in paths.items():
+            namespace = {}
+            exec(SPECIALIZED_SOURCE.format(expr=expr), namespace)
+            factories[family, op] = (namespace['make_binary'], namespace['make_binary_const'])
+    return factories
+
+SPECIALIZATIONS = build_specializations()
+
+TYPED_SOURCE = """
+def make_typed(variables, PNError):
+    def typed():
+        try:
+            return {expr}
+        except KeyError as error:
+            raise PNError(f"{{error.args[0]!r}} is not defined") from None
+    return typed
+"""
+TYPED_FACTORIES = {}  # expression source -> factory, shared by all compilers
+
+def typed_source(node, types, top=True):
+    # One Python expression for a tree of numeric operations whose operand types are
+    # all known, or None. Only the root may be a comparison.
+    kind = node['type']
+    if kind == 'number':
+        return repr(node['value'])
+    if kind == 'name':
+        return f"variables[{node['name']!r}]" if types.get(id(node)) in ('int', 'float') else None
+    if kind != 'binary':
+        return None
+    op = node['op']
+    if op in COMPARISONS:
+        if not top:
+            return None
+    elif types.get(id(node)) not in ('int', 'float'):
+        return None
+    if op in ('/', '%') and (node['right']['type'] != 'number' or not node['right']['value']):
+        return None  # a variable divisor keeps the zero check
+    left, right = typed_source(node['left'], types, False), typed_source(node['right'], types, False)
+    if left is None or right is None:
+        return None
+    return f'({left} {op} {right})'
+
+def typed_factory(expr):
+    factory = TYPED_FACTORIES.get(expr)
+    if factory is None:
+        namespace = {}
+        exec(TYPED_SOURCE.format(expr=expr), namespace)
+        factory = TYPED_FACTORIES[expr] = namespace['make_typed']
+    return factory
+
+def specialization(op, left, right):
+    # Factories for `left op right` given the operands' static types, or None
+    if left == right == 'int':
+        family = 'int'
+    elif left in ('int', 'float') and right in ('int', 'float'):
+        family = 'float'
+    elif left == right == 'string':
+        family = 'string'
+    elif left and right and (left == 'boolean') == (right == 'boolean'):
+        family = 'any'  # equality without the true/1 distinction to check
+    else:
+        return None
+    return SPECIALIZATIONS.get((family, op))
+
+def concat_operands(node):
+    # Operands of a left-nested chain of '+', in evaluation order
+    operands = []
+    while node['type'] == 'binary' and node['op'] == '+':
+        operands.append(node['right'])
+        node = node['left']
+    operands.append(node)
+    return operands[::-1]
+
+def find_append_targets(node, targets):
+    # Names assigned as `name = name + ...` anywhere in the tree
+    if isinstance(node, list):
+        for item in node:
+            find_append_targets(item, targets)
+    elif isinstance(node, dict):
+        if node.get('type') == 'variable_assignment':
+            operands = concat_operands(node['value'])
+            if len(operands) > 1 and operands[0]['type'] == 'name' and operands[0]['name'] == node['name']:
+                targets.add(node['name'])
+        for value in node.values():
+            if isinstance(value, (list, dict)):
+                find_append_targets(value, targets)
+    return targets
+
+NOT_CONSTANT = object()
+MISSING = object()
+STREAM_READ = object()  # cache marker of a hoisted expression that reads a stream
+# Control signals returned by statements; None means carry on
+BREAK = object()     # ends the enclosing switch or loop
+CONTINUE = object()  # starts the next iteration of the enclosing loop
+
+def break_statement():
+    return BREAK
+
+def continue_statement():
+    return CONTINUE
+
+def walk(node):
+    # Every dict node in a tree of statements and expressions
+    if isinstance(node, list):
+        for item in node:
+            yield from walk(item)
+    elif isinstance(node, dict):
+        yield node
+        for value in node.values():
+            if isinstance(value, (list, dict)):
+                yield from walk(value)
+
+def assigned_names(statements):
+    names = set()
+    for node in walk(statements):
+        if node.get('type') in ('variable_assignment', 'delete'):
+            names.add(node['name'])
+        elif node.get('type') == 'for':
+            names.add(node['var'])
+        elif node.get('type') == 'import':
+            names.update(node.get('names', ()))  # set once the import is linked to its module
+    return names
+
+SCALAR_TYPES = ('int', 'float', 'boolean', 'null')
+
+def declared_names(statements):
+    # Names a block binds with let or const; the bindings end when the block is left
+    return list(dict.fromkeys(node['name'] for node in statements
+                              if node['type'] == 'variable_assignment' and node['kind'] in ('let', 'const')))
+
+def name_mentions(node):
+    # How often each name is read, bound or deleted in a tree
+    counts = collections.Counter()
+    for item in walk(node):
+        kind = item.get('type')
+        if kind in ('name', 'variable_assignment', 'index_assignment', 'delete'):
+            counts[item['name']] += 1
+        elif kind == 'for':
+            counts[item['var']] += 1
+        elif kind == 'arrow':
+            counts[item['param']] += 1
+        elif kind == 'import':
+            counts.update(item.get('names', ()))
+    return counts
+
+def child_blocks(node):
+    # (key, statements) of the blocks a statement opens; the cases of a switch share one
+    kind = node.get('type')
+    if kind == 'if':
+        return [(node['body'], node['body']), (node['else_body'], node['else_body'])]
+    if kind in ('while', 'do_while', 'for'):
+        return [(node['body'], node['body'])]
+    if kind == 'switch':
+        return [(node['cases'], [statement for case in node['cases'] for statement in case['body']])]
+    return []
+
+def block_scopes(statements, types=None):
+    # id(block key) -> (names the block declares, {statement index: names dead after it}).
+    # A declared name is dead after the last statement of its block that mentions it
+    # when nothing outside the block mentions it and the block first mentions it by
+    # declaring it, so no later statement or iteration reads the old value. A call
+    # counts as a use of every name, as tasks() reads the caller's scope by name at run
+    # time. Numbers, booleans and null (by their static type) are small enough not to
+    # be dropped early.
+    types = types or {}
+    total = name_mentions(statements)
+    scopes = {}
+    for node in walk(statements):
+        for key, block in child_blocks(node):
+            names = declared_names(block)
+            if not names:
+                continue
+            counts = [name_mentions(statement) for statement in block]
+            calls = [index for index, statement in enumerate(block)
+                     if any(item.get('type') == 'call' for item in walk(statement))]
+            releases = {}
+            for name in names:
+                uses = [index for index, count in enumerate(counts) if count[name]]
+                first = block[uses[0]]
+                if sum(count[name] for count in counts) == total[name] \
+                        and first['type'] == 'variable_assignment' and first['name'] == name \
+                        and first['kind'] in ('let', 'const') and not name_mentions(first['value'])[name] \
+                        and types.get(id(first['value'])) not in SCALAR_TYPES:
+                    releases.setdefault(max(uses[-1], calls[-1] if calls else -1), []).append(name)
+            scopes[id(key)] = (names, releases)
+    return scopes
+
+def scoped_names(node, scopes):
+    # Names declared in the blocks of a statement, unbound when the statement ends
+    return list(dict.fromkeys(name for key, _ in child_blocks(node) for name in scopes.get(id(key), ((),))[0]))
+
+def referenced_names(expression):
+    return {node['name'] for node in walk(expression) if node.get('type') in ('name', 'index_assignment')}
+
+def free_names(node):
+    # Names an expression reads from its scope; an arrow's parameter is bound in its body
+    if isinstance(node, list):
+        return set().union(*(free_names(item) for item in node))
+    if node.get('type') == 'name':
+        return {node['name']}
+    if node.get('type') == 'arrow':
+        return free_names(node['body']) - {node['param']}
+    return set().union(*(free_names(value) for value in node.values() if isinstance(value, (list, dict))))
+
+def has_continue(node):
+    # A 'continue' that belongs to this loop, i.e. not inside a nested loop
+    if isinstance(node, list):
+        return any(has_continue(item) for item in node)
+    if not isinstance(node, dict) or node.get('type') in ('while', 'do_while', 'for'):
+        return False
+    if node.get('type') == 'continue':
+        return True
+    return any(has_continue(value) for value in node.values() if isinstance(value, (list, dict)))
+
+def counted_loop_shape(node):
+    # `while (i < n) { ...; i = i + step; }` with an int step and i assigned nowhere else
+    # -> (name, op, limit node, step), else None
+    condition, body = node['condition'], node['body']
+    if condition['type'] != 'binary' or condition['op'] not in ('<', '<=', '>', '>='):
+        return None
+    if condition['left']['type'] != 'name' or not body:
+        return None
+    name, last = condition['left']['name'], body[-1]
+    value = last.get('value')
+    if last['type'] != 'variable_assignment' or last['name'] != name or value['type'] != 'binary' \
+            or value['op'] not in ('+', '-') or value['left'] != {'type': 'name', 'name': name} \
+            or value['right']['type'] != 'number' or type(value['right']['value']) is not int:
+        return None
+    step = value['right']['value'] if value['op'] == '+' else -value['right']['value']
+    if step == 0 or (step > 0) != (condition['op'] in ('<', '<=')):
+        return None
+    if name in assigned_names(body[:-1]) or name in referenced_names(condition['right']) \
+            or referenced_names(condition['right']) & assigned_names(body) or has_continue(body):
+        return None
+    return name, condition['op'], condition['right'], step
+
+def locate(error, step):
+    # Give an error the line of the innermost statement that raised it
+    if error.line is None and getattr(step, 'line', None) is not None:
+        return type(error)(error.message, step.line)
+    return error
+
+def run_block(steps):
+    step = None
+    try:
+        for step in steps:
+            signal = step()
+            if signal is not None:
+                return signal
+    except PNError as error:
+        raise locate(error, step) from None
+    return None
+
+def run_loop_body(steps):
+    # None to keep looping, BREAK to leave the loop, or a signal for an outer construct
+    step = None
+    try:
+        for step in steps:
+            signal = step()
+            if signal is not None:
+                return None if signal is CONTINUE else signal
+    except PNError as error:
+        raise locate(error, step) from None
+    return None
+
+def scoped_statement(step, names, variables):
+    # A statement whose blocks declare names: on the way out each name gets back the
+    # binding it had before the statement, or is removed
+    def scoped():
+        saved = [variables.get(name, MISSING) for name in names]
+        try:
+            return step()
+        finally:
+            for name, value in zip(names, saved):
+                if value is MISSING:
+                    variables.pop(name, None)
+                else:
+                    variables[name] = value
+    return scoped
+
+def release_after(step, names, variables):
+    # A statement after which names are dead: their values are dropped right away
+    def release():
+        signal = step()
+        for name in names:
+            variables.pop(name, None)
+        return signal
+    release.line = step.line
+    return release
+
+def constant_value(node):
+    # Value of an expression made only of literals, or NOT_CONSTANT
+    if node['type'] in LITERAL_TYPES:
+        return node['value']
+    if node['type'] == 'binary':
+        left, right = constant_value(node['left']), constant_value(node['right'])
+        if left is not NOT_CONSTANT and right is not NOT_CONSTANT:
+            try:
+                return GENERIC_OPS[node['op']](left, right)
+            except PNError:
+                pass
+    return NOT_CONSTANT
+
+def switch_key(value):
+    # Dict key with the language's equality: true and 1 differ, 1 and 1.0 do not
+    return (bool, value) if type(value) is bool else value
+
+def iterate(value):
+    # Collection of a for loop, which has safepoints of its own: a view that needs no
+    # pass of its own, or a stream, is iterated without the per-chunk ones
+    if type(value) is ArrayView and value.items is not None:
+        return value.items
+    if type(value) is Stream:
+        return value.open_records()
+    if type(value) in (list, str, ArrayView, SharedArray):
+        return value
+    raise PNError(f"Cannot iterate over {type_name(value)}")
+
+NUMERIC_OPS = ('-', '*', '%')
+
+def join_types(*states):
+    # Per name, the type all states agree on, else None (unknown)
+    first, *rest = states
+    return {name: kind if all(state[name] == kind for state in rest) else None for name, kind in first.items()}
+
+class TypeInference:
+    # Flow-sensitive static types ('int', 'float', 'string', 'array', 'boolean', 'null')
+    # of expression nodes, keyed by id(node). A name has a type only where every path to
+    # it assigns one; anything else, including names bound from outside, is unknown.
+    # The environment is updated in place; branches and loops save and join only the
+    # names they assign, so a long program is not copied at every block.
+    def __init__(self):
+        self.env = {}
+        self.types = {}
+        self.breaks = []     # per enclosing loop or switch: (its names, states at its breaks)
+        self.continues = []  # per enclosing loop: (its names, states at its continues)
+
+    def infer(self, statements, env=None):
+        # env: static types the names are known to have on entry
+        self.env = dict(env or {})
+        self.statements(statements)
+        return self.types
+
+    def state(self, names):
+        return {name: self.env.get(name) for name in names}
+
+    def restore(self, state):
+        for name, kind in state.items():
+            if kind is None:
+                self.env.pop(name, None)
+            else:
+                self.env[name] = kind
+
+    def statements(self, statements):
+        for node in statements:
+            self.statement(node)
+
+    def statement(self, node):
+        kind = node['type']
+        if kind == 'variable_assignment':
+            self.restore({node['name']: self.expression(node['value'])})
+        elif kind in ('print', 'expression_statement'):
+            self.expression(node['value'])
+        elif kind == 'index_assignment':
+            self.expression(node['index'])
+            self.expression(node['value'])
+        elif kind == 'if':
+            self.expression(node['condition'])
+            else_body = node.get('else_body', [])
+            names = assigned_names(node['body']) | assigned_names(else_body)
+            entry = self.state(names)
+            self.statements(node['body'])
+            self.leave(node['body'], entry)
+            taken = self.state(names)
+            self.restore(entry)
+            self.statements(else_body)
+            self.leave(else_body, entry)
+            self.restore(join_types(taken, self.state(names)))
+        elif kind == 'switch':
+            self.switch(node)
+        elif kind in ('break', 'continue'):
+            names, states = (self.breaks if kind == 'break' else self.continues)[-1]
+            states.append(self.state(names))
+        elif kind in ('while', 'do_while', 'for'):
+            self.loop(node)
+        elif kind == 'import':
+            self.restore(dict.fromkeys(node.get('names', ())))
+        elif kind == 'delete':
+            self.restore({node['name']: None})
+
+    def leave(self, block, entry):
+        # Names a block declares have their types from before it again once it is left
+        self.restore({name: entry.get(name) for name in declared_names(block)})
+
+    def switch(self, node):
+        self.expression(node['subject'])
+        names = assigned_names([case['body'] for case in node['cases']])
+        entry = current = self.state(names)
+        self.breaks.append((names, []))
+        for case in node['cases']:
+            self.restore(join_types(entry, current))  # entered by its label or by fallthrough
+            if case['label'] is not None:
+                self.expression(case['label'])
+            self.statements(case['body'])
+            current = self.state(names)
+        exits = [current] + self.breaks.pop()[1]
+        if all(case['label'] is not None for case in node['cases']):
+            exits.append(entry)
+        self.restore(join_types(*exits))
+        self.leave([statement for case in node['cases'] for statement in case['body']], entry)
+
+    def loop(self, node):
+        # Iterates to a fixed point: names only ever lose their type at the loop head
+        kind = node['type']
+        names = assigned_names(node['body'])
+        if kind == 'for':
+            collection = self.expression(node['collection'])
+            names.add(node['var'])
+        head = before = self.state(names)
+        while True:
+            self.restore(head)
+            self.breaks.append((names, []))
+            self.continues.append((names, []))
+            if kind == 'for':
+                self.restore({node['var']: 'string' if collection == 'string' else None})
+            elif kind == 'while':
+                self.expression(node['condition'])
+            self.statements(node['body'])
+            end = join_types(self.state(names), *self.continues.pop()[1])
+            if kind == 'do_while':
+                self.restore(end)
+                self.expression(node['condition'])
+            breaks = self.breaks.pop()[1]
+            following = join_types(head, end)
+            if following == head:
+                # The loop is left at its condition (after the body for do-while) or a break
+                self.restore(join_types(end if kind == 'do_while' else head, *breaks))
+                self.leave(node['body'], before)
+                return
+            head = following
+
+    def expression(self, node):
+        kind = node['type']
+        if kind == 'number':
+            result = 'int' if type(node['value']) is int else 'float'
+        elif kind == 'string':
+            result = 'string'
+        elif kind == 'constant':
+            result = 'null' if node['value'] is None else 'boolean'
+        elif kind == 'name':
+            result = self.env.get(node['name'])
+        elif kind == 'array':
+            for item in node['items']:
+                self.expression(item)
+            result = 'array'
+        elif kind == 'template':
+            for part in node['parts']:
+                self.expression(part)
+            result = 'string'
+        elif kind == 'binary':
+            result = self.binary(node['op'], self.expression(node['left']), self.expression(node['right']))
+        elif kind == 'index':
+            self.expression(node['target'])
+            self.expression(node['index'])
+            result = None
+        elif kind == 'method':
+            self.expression(node['target'])
+            for arg in node['args']:
+                self.expression(arg)
+            result = 'array'
+        elif kind == 'property':
+            self.expression(node['target'])
+            result = 'int'
+        elif kind == 'call':
+            self.expression(node['callee'])
+            for arg in node['args']:
+                self.expression(arg)
+            result = None
+        elif kind == 'arrow':
+            # The body runs later, with the values its free names have now
+            param = node['param']
+            shadowed = self.env.pop(param, None)
+            self.expression(node['body'])
+            self.restore({param: shadowed})
+            result = 'function'
+        else:
+            result = None
+        self.types[id(node)] = result
+        return result
+
+    def binary(self, op, left, right):
+        if op in COMPARISONS:
+            return 'boolean'  # or an error, which ends the statement
+        numeric = left in ('int', 'float') and right in ('int', 'float')
+        if op == '+':
+            if left == 'string' or right == 'string':
+                return 'string'
+            if left == right == 'array':
+                return 'array'
+        if numeric and (op == '+' or op in NUMERIC_OPS):
+            return 'int' if left == right == 'int' else 'float'
+        if numeric and op == '/' and 'float' in (left, right):
+            return 'float'
+        return None
+
+def infer_types(statements, env=None):
+    return TypeInference().infer(statements, env)
+
+ARRAY_READS = ('index', 'method', 'property', 'call')  # expression nodes that may read array items
+ITEM_WRITERS = ('parallel', 'tasks', 'merge_tasks')  # builtins whose workers may assign to shared array items
+
+def writes_items(ast, builtins):
+    # Whether running ast may assign to shared array items: an index assignment, or a
+    # call that can start workers (parallel, tasks, or any function value, which may)
+    for node in walk(ast):
+        if node.get('type') == 'index_assignment':
+            return True
+        if node.get('type') == 'call':
+            callee = node['callee']
+            if callee['type'] != 'name' or callee['name'] not in builtins or callee['name'] in ITEM_WRITERS:
+                return True
+    return False
+
+def merges_writes(ast, builtins):
+    # Whether running ast may merge task writes into its variables: it names merge_tasks
+    return 'merge_tasks' in builtins and any(node.get('type') == 'name' and node['name'] == 'merge_tasks'
+                                             for node in walk(ast))
+
+TRACE_THRESHOLD = 1_000  # iterations, over all entries, before a loop is traced
+TRACE_VARIANTS = 4       # traces kept per loop, one per type signature on entry
+TRACEABLE = ('variable_assignment', 'index_assignment', 'print', 'if', 'while', 'for', 'break', 'continue')
+
+def observed_type(value):
+    # Static type name of a run-time value, as TypeInference spells it
+    if type(value) is StringBuilder:
+        return 'string'
+    return {int: 'int', float: 'float', str: 'string', list: 'array', ArrayView: 'array', SharedArray: 'array',
+            bool: 'boolean', type(None): 'null'}.get(type(value))
+
+def traceable(node):
+    # Loops whose statements all have a Python counterpart and whose names are identifiers.
+    # A trace keeps the names in Python locals until it ends, so a loop making calls while
+    # it runs is not traced: tasks() reads the caller's variables, and would see stale
+    # values. A for loop's collection is evaluated before the trace starts
+    return all(item['type'] in TRACEABLE for item in walk(node) if 'line' in item) \
+        and not any(item.get('type') == 'call' for item in walk([node.get('condition'), node['body']])) \
+        and all(f'v_{name}'.isidentifier() for name in assigned_names([node]) | referenced_names(node))
+
+def undefined(name):
+    raise PNError(f"{name!r} is not defined")
+
+def locate_line(error, line):
+    return type(error)(error.message, line) if error.line is None and line is not None else error
+
+TRACE_HEADER = """
+def make_trace(variables, budget):
+    def trace(items):
+"""
+
+class PythonSource:
+    # Python source for .pn expressions, with names read from `v_`-prefixed locals.
+    # Operations whose operand types are known are emitted inline, the rest call the
+    # generic operators.
+    def __init__(self, types, entry, builtins=()):
+        self.types = types  # id(node) -> static type, from infer_types
+        self.entry = entry  # names defined when the code starts running
+        self.builtins = builtins  # builtin names the program does not assign
+        self.bound = set()  # parameters of the arrows being emitted
+
+    def text(self, node):
+        # Source for format_value(node)
+        source, kind = self.expression(node)
+        if kind == 'string':
+            return source
+        if kind in ('int', 'float'):
+            return f'str({source})'
+        return f'format_value({source})'
+
+    def defined(self, name, node):
+        # Names present on entry stay defined; typed ones were assigned on every path
+        return name in self.entry or name in self.bound or self.types.get(id(node)) is not None
+
+    def guarded(self, op, left, right, right_node):
+        # Operands of unknown type: the int fast path inline when both are cheap to
+        # evaluate twice (a local or a literal), else the generic operator
+        generic = f"ops[{op!r}]({left}, {right})"
+        if not all(re.fullmatch(r'v_\w+|\(.*\)', source) and '(' not in source[1:-1]
+                   for source in (left, right)):
+            return generic
+        checks = [f'type({source}) is int' for source, node in ((left, None), (right, right_node))
+                  if node is None or node['type'] != 'number' or type(node['value']) is not int]
+        if not checks:
+            return generic
+        names = {'a': left, 'b': right, 'generic': f'ops[{op!r}]'}
+        fast = re.sub(r'\b(a|b|generic)\b', lambda match: names[match.group()], INT_FAST_PATHS[op])
+        return f"(({fast}) if {' and '.join(checks)} else {generic})"
+
+    def arrow(self, node):
+        # A lambda; free names are passed as defaults, so it keeps the values they have now
+        param = node['param']
+        defaults = ''.join(f', v_{name}=v_{name}' for name in sorted(free_names(node)))
+        if defaults:
+            defaults = ', *' + defaults  # keyword-only, so no call argument lands in one
+        outer, self.bound = self.bound, self.bound | {param}
+        body = self.expression(node['body'])[0]
+        self.bound = outer
+        return f'(lambda v_{param}{defaults}: {body})'
+
+    def expression(self, node):
+        # (Python source, static type or None)
+        kind = node['type']
+        result = self.types.get(id(node))
+        if kind in LITERAL_TYPES:
+            return f"({node['value']!r})", result
+        if kind == 'name':
+            name = node['name']
+            if name in self.builtins and name not in self.bound:
+                return f'BUILTINS[{name!r}]', result
+            if self.defined(name, node):
+                return f'v_{name}', result
+            return f"(v_{name} if v_{name} is not MISSING else undefined({name!r}))", result
+        if kind == 'call':
+            args = ', '.join(self.expression(arg)[0] for arg in node['args'])
+            callee = node['callee']
+            if callee['type'] == 'name' and callee['name'] in self.builtins and callee['name'] not in self.bound:
+                return f"call_value(builtin_{callee['name']}, [{args}])", result
+            return f"call_value({self.expression(callee)[0]}, [{args}])", result
+        if kind == 'array':
+            return '[' + ', '.join(self.expression(item)[0] for item in node['items']) + ']', result
+        if kind == 'template':
+            return '(' + ' + '.join(["''"] + [self.text(part) for part in node['parts']]) + ')', result
+        if kind == 'index':
+            return f"index_value({self.expression(node['target'])[0]}, {self.expression(node['index'])[0]})", result
+        if kind == 'method':
+            args = ', '.join(self.expression(arg)[0] for arg in node['args'])
+            return f"array_method({self.expression(node['target'])[0]}, {node['name']!r}, [{args}])", result
+        if kind == 'property':
+            return f"length_of({self.expression(node['target'])[0]})", result
+        if kind == 'arrow':
+            return self.arrow(node), result
+        op = node['op']
+        (left, left_type), (right, right_type) = self.expression(node['left']), self.expression(node['right'])
+        if left_type is None or right_type is None:
+            return self.guarded(op, left, right, node['right']), result
+        numeric = left_type in ('int', 'float') and right_type in ('int', 'float')
+        literal_divisor = node['right']['type'] == 'number' and node['right']['value']
+        if op == '+' and 'string' in (left_type, right_type):
+            return f"({self.text(node['left'])} + {self.text(node['right'])})", result
+        if op in ('+', '-', '*') and numeric:
+            return f'({left} {op} {right})', result
+        if op in ('/', '%') and numeric:
+            if literal_divisor and not (op == '/' and left_type == right_type == 'int'):
+                return f'({left} {op} {right})', result
+            return f"{'divide' if op == '/' else 'modulo'}({left}, {right})", result
+        if op in ('<', '>', '<=', '>=') and (numeric or left_type == right_type == 'string'):
+            return f'({left} {op} {right})', result
+        if op in ('==', '!=') and left_type and right_type and (left_type == 'boolean') == (right_type == 'boolean'):
+            return f'({left} {op} {right})', result
+        return f"ops[{op!r}]({left}, {right})", result
+
+# Globals of generated code
+SOURCE_NAMESPACE = {'MISSING': MISSING, 'PNError': PNError, 'StringBuilder': StringBuilder,
+                    'format_value': format_value, 'iterate': iterate, 'divide': divide, 'modulo': modulo,
+                    'ops': GENERIC_OPS, 'undefined': undefined, 'locate_line': locate_line,
+                    'index_value': index_value, 'array_method': array_method, 'length_of': length_of,
+                    'call_value': call_value, 'store_index': store_index, 'BUILTINS': BUILTINS,
+                    **{f'builtin_{name}': function for name, function in BUILTINS.items()}}
+
+def run_source(source, filename):
+    namespace = dict(SOURCE_NAMESPACE)
+    exec(compile(source, filename, 'exec'), namespace)
+    return namespace
+
+ARROW_SOURCE = """
+def make_arrow(variables):
+    def arrow():
+{loads}        return {expr}
+    return arrow
+"""
+
+def build_arrow(node, variables, types, append_targets, builtins):
+    # Closure evaluating an arrow expression: loads its free names, returns a lambda
+    loads = []
+    for name in sorted(free_names(node)):
+        loads.append(f"        v_{name} = variables.get({name!r}, MISSING)\n")
+        if name in append_targets:
+            loads.append(f"        if type(v_{name}) is StringBuilder:\n            v_{name} = str(v_{name})\n")
+    source = ARROW_SOURCE.format(loads=''.join(loads), expr=PythonSource(types, (), builtins).arrow(node))
+    return run_source(source, '<arrow>')['make_arrow'](variables)
+
+class TraceBuilder(PythonSource):
+    # Python source for one loop, specialized to the types its names have on entry.
+    # Names live in Python locals for the whole loop and are written back at the end.
+    # A trace only runs after its entry types were checked, and the inference is sound
+    # from there, so no guard is needed inside the loop.
+    def __init__(self, node, entry, append_targets, builtins, scopes):
+        # entry: name -> observed type; names missing on entry are absent
+        super().__init__(infer_types([node], {name: kind for name, kind in entry.items() if kind}), entry, builtins)
+        self.node = node
+        self.append_targets = append_targets
+        self.scopes = scopes
+        self.saves = 0  # locals holding the bindings shadowed by nested blocks
+        self.lines = []
+
+    def emit(self, depth, text):
+        self.lines.append('    ' * depth + text)
+
+    def build(self):
+        names = sorted(assigned_names([self.node]) | referenced_names(self.node))
+        source = [TRACE_HEADER]
+        for name in names:
+            source.append(f"        v_{name} = variables.get({name!r}, MISSING)\n")
+            if self.entry.get(name) == 'string':
+                source.append(f"        v_{name} = str(v_{name})\n")  # a StringBuilder is flattened once
+        node = self.node
+        source.append('        countdown = budget.left\n')  # a local: the budget is only touched per interval
+        self.emit(3, 'line = None')
+        if node['type'] == 'for':
+            self.emit(3, f"for v_{node['var']} in items:")
+        else:
+            self.emit(3, f"while {self.expression(node['condition'])[0]}:")
+        self.safepoint(4)
+        self.block(node['body'], 4)  # its own declarations are unbound by the loop statement
+        source.append('        try:\n')
+        source.extend(line + '\n' for line in self.lines)
+        source.append('        except PNError as error:\n')
+        source.append('            raise locate_line(error, line) from None\n')
+        source.append('        finally:\n')
+        source.append('            budget.left = countdown\n')
+        for name in sorted(assigned_names([node])):
+            source.append(f"            if v_{name} is not MISSING:\n")
+            source.append(f"                variables[{name!r}] = v_{name}\n")
+            source.append("            else:\n")
+            source.append(f"                variables.pop({name!r}, None)\n")
+        source.append('    return trace\n')
+        return ''.join(source)
+
+    def safepoint(self, depth):
+        # A cancel() is seen once the local countdown runs out, within an interval
+        self.emit(depth, 'countdown -= 1')
+        self.emit(depth, 'if countdown <= 0:')
+        self.emit(depth + 1, 'budget.left = countdown')
+        self.emit(depth + 1, 'budget.check()')
+        self.emit(depth + 1, 'countdown = budget.left')
+
+    def block(self, statements, depth):
+        if not statements:
+            self.emit(depth, 'pass')
+        _, releases = self.scopes.get(id(statements), ((), {}))
+        for index, node in enumerate(statements):
+            self.statement(node, depth)
+            for name in releases.get(index, ()):
+                self.emit(depth, f"v_{name} = MISSING")
+
+    def statement(self, node, depth):
+        # A statement whose blocks declare names gives them back their bindings after it
+        names = scoped_names(node, self.scopes)
+        if not names:
+            return self.plain_statement(node, depth)
+        self.saves += 1
+        saved = f"saved_{self.saves}"
+        locals_ = ', '.join(f"v_{name}" for name in names) + ','
+        self.emit(depth, f"{saved} = {locals_}")
+        self.emit(depth, 'try:')
+        self.plain_statement(node, depth + 1)
+        self.emit(depth, 'finally:')
+        self.emit(depth + 1, f"{locals_} = {saved}")
+
+    def plain_statement(self, node, depth):
+        kind = node['type']
+        self.emit(depth, f"line = {node['line']}")
+        if kind == 'variable_assignment':
+            name = node['name']
+            operands = concat_operands(node['value'])
+            if name in self.append_targets and len(operands) > 1 and operands[0] == {'type': 'name', 'name': name} \
+                    and self.types.get(id(operands[0])) == 'string' \
+                    and name not in referenced_names(operands[1:]):
+                # `s = s + a + b` on a str local: in-place appends, not a copy per piece
+                for operand in operands[1:]:
+                    self.emit(depth, f"v_{name} += {self.text(operand)}")
+                return
+            self.emit(depth, f"v_{name} = {self.expression(node['value'])[0]}")
+        elif kind == 'index_assignment':
+            target = self.expression({'type': 'name', 'name': node['name']})[0]
+            self.emit(depth, f"store_index({target}, {self.expression(node['index'])[0]}, "
+                             f"{self.expression(node['value'])[0]})")
+        elif kind == 'print':
+            self.emit(depth, f"print({self.text(node['value'])})")
+        elif kind == 'if':
+            self.emit(depth, f"if {self.expression(node['condition'])[0]}:")
+            self.block(node['body'], depth + 1)
+            if node.get('else_body'):
+                self.emit(depth, 'else:')
+                self.block(node['else_body'], depth + 1)
+        elif kind == 'while':
+            self.emit(depth, f"while {self.expression(node['condition'])[0]}:")
+            self.safepoint(depth + 1)
+            self.block(node['body'], depth + 1)
+        elif kind == 'for':
+            self.emit(depth, f"for v_{node['var']} in iterate({self.expression(node['collection'])[0]}):")
+            self.safepoint(depth + 1)
+            self.block(node['body'], depth + 1)
+        else:
+            self.emit(depth, kind)  # break or continue
+
+def build_trace(node, variables, entry, append_targets, builtins, scopes, budget):
+    source = TraceBuilder(node, entry, append_targets, builtins, scopes).build()
+    return run_source(source, f"<trace line {node['line']}>")['make_trace'](variables, budget)
+
+class LoopTracer:
+    # Iteration count and traces of one loop. A trace is looked up by the types the
+    # loop's names have when it is entered; a signature with no trace once the
+    # variants are used up keeps running in the interpreter.
+    def __init__(self, node, variables, append_targets, builtins, scopes, budget):
+        self.node = node
+        self.variables = variables
+        self.append_targets = append_targets
+        self.builtins = builtins
+        self.scopes = scopes
+        self.budget = budget
+        self.names = sorted(assigned_names([node]) | referenced_names(node))
+        self.count = 0
+        self.traces = {}
+        self.compile_seconds = 0.0
+
+    def entered(self):
+        # Trace to run the whole loop with, or None to interpret it
+        return self.trace() if self.count >= TRACE_THRESHOLD else None
+
+    def trace(self):
+        # Trace for the current types, built on first use, or None
+        variables = self.variables
+        signature = tuple(observed_type(variables[name]) if name in variables else MISSING for name in self.names)
+        trace = self.traces.get(signature)
+        if trace is None and len(self.traces) < TRACE_VARIANTS:
+            start = time.perf_counter()
+            entry = {name: kind for name, kind in zip(self.names, signature) if kind is not MISSING}
+            trace = self.traces[signature] = build_trace(self.node, variables, entry, self.append_targets,
+                                                         self.builtins, self.scopes, self.budget)
+            self.compile_seconds += time.perf_counter() - start
+        return trace
+
+class Compiler:
+    # Turns AST nodes into Python closures once, so running a program is a loop of calls
+    def __init__(self, memory, fast_paths=True, string_builders=True, jump_tables=True, loop_optimizations=True,
+                 type_specialization=True, tracing=True, lazy_arrays=True, lifetimes=True, budget=None):
+        self.variables = memory.variables
+        self.budget = budget if budget is not None else Budget()  # counted down by every loop
+        self.fast_paths = fast_paths
+        self.string_builders = string_builders
+        self.jump_tables = jump_tables
+        self.loop_optimizations = loop_optimizations
+        self.type_specialization = type_specialization
+        self.tracing = tracing
+        self.lazy_arrays = lazy_arrays
+        self.lifetimes = lifetimes  # block-scoped let/const, values dropped after their last use
+        self.scopes = {}  # from block_scopes
+        self.tracers = []  # LoopTracer of every traceable loop compiled
+        self.types = {}  # id(expression node) -> static type, from infer_types
+        self.operation_counts = {'folded': 0, 'specialized': 0, 'guarded': 0}
+        self.loop_scopes = []  # (names assigned in the loop, caches of its hoisted expressions)
+        self.append_targets = set()  # loads of these names may see a StringBuilder
+        self.builtins = set()  # builtin names the program does not assign, resolved when compiling
+        self.directory = None  # imports are looked up here first, else in the working directory
+        self.modules = {}  # path -> the Module last linked there by compile(), for cache invalidation
+        self.index_writes = False  # whether the program may assign to shared array items
+
+    def compile(self, ast):
+        ast = link_imports(ast, self.link)
+        if self.string_builders:
+            find_append_targets(ast, self.append_targets)
+        # Names bound before the run, e.g. read through a task's scope, shadow builtins too
+        self.builtins = {name for name in set(BUILTINS) - assigned_names(ast) if name not in self.variables}
+        if merges_writes(ast, self.builtins):
+            # merge_tasks() writes names behind the compiled code's back, which would leave
+            # hoisted values, traced locals and inferred types stale
+            self.loop_optimizations = self.tracing = self.type_specialization = False
+        self.types = infer_types(ast) if self.type_specialization else {}
+        self.index_writes = writes_items(ast, self.builtins)
+        self.scopes = block_scopes(ast, self.types) if self.lifetimes else {}
+        return [(node, self.compile_statement(node)) for node in ast]
+
+    def link(self, node):
+        # Import nodes get their module and the names it binds, so the analyses see them
+        try:
+            module = MODULES.load(find_module(node['path'], self.directory))
+        except PNError as error:
+            raise PNError(error.message if error.line is None else str(error), node['line']) from None
+        self.modules[module.path] = module  # a REPL importing a module again keeps one entry
+        return {**node, 'module': module, 'names': module.names}
+
+    def compile_statement(self, node):
+        step = self.compile_step(node)
+        names = scoped_names(node, self.scopes)
+        if names:
+            step = scoped_statement(step, names, self.variables)
+        if step is not break_statement and step is not continue_statement:
+            step.line = node.get('line')  # read by locate() when the statement raises
+        return step
+
+    def compile_step(self, node):
+        kind = node['type']
+        variables = self.variables
+        if kind == 'variable_assignment':
+            name, value = node['name'], self.compile_expression(node['value'])
+            if name in self.append_targets:
+                operands = concat_operands(node['value'])
+                if len(operands) > 1 and operands[0]['type'] == 'name' and operands[0]['name'] == name:
+                    return self.compile_append(name, operands[1:], value)
+
+            def assign():
+                variables[name] = value()
+            return assign
+        if kind == 'print':
+            value = self.compile_expression(node['value'])
+
+            def print_value():
+                print(format_value(value()))
+            return print_value
+        if kind == 'expression_statement':
+            value = self.compile_expression(node['value'])
+
+            def evaluate():
+                value()  # its result is not a break or continue signal
+            return evaluate
+        if kind == 'if':
+            condition = self.compile_expression(node['condition'])
+            body = self.compile_block(node['body'])
+            else_body = self.compile_block(node.get('else_body', []))
+
+            def if_statement():
+                step = None
+                try:
+                    for step in (body if condition() else else_body):
+                        signal = step()
+                        if signal is not None:
+                            return signal
+                except PNError as error:
+                    raise locate(error, step) from None
+                return None
+            return if_statement
+        if kind == 'for':
+            var_name, collection = node['var'], self.compile_expression(node['collection'])
+            steps, caches = self.compile_loop_body(node['body'], assigned_names(node['body']) | {var_name})
+            self.leave_loop()
+            tracer = self.loop_tracer(node)
+
+            budget = self.budget
+
+            def for_statement():
+                for cache in caches:
+                    cache[0] = MISSING
+                items = iter(iterate(collection()))
+                trace = tracer.entered() if tracer is not None else None
+                if trace is not None:
+                    return trace(items)
+                counting = tracer is not None and tracer.count < TRACE_THRESHOLD
+                for item in items:
+                    budget.left -= 1
+                    if budget.left <= 0:
+                        budget.check()
+                    variables[var_name] = item
+                    signal = run_loop_body(steps)
+                    if signal is not None:
+                        return None if signal is BREAK else signal
+                    if counting:
+                        tracer.count += 1
+                        if tracer.count >= TRACE_THRESHOLD:
+                            counting = False  # hot: the remaining items run in the trace
+                            trace = tracer.trace()
+                            if trace is not None:
+                                return trace(items)
+                return None
+            return for_statement
+        if kind == 'switch':
+            return self.compile_switch(node)
+        if kind == 'break':
+            return break_statement
+        if kind == 'continue':
+            return continue_statement
+        if kind in ('while', 'do_while'):
+            return self.compile_while(node)
+        if kind == 'import':
+            module = node['module']
+            return lambda: module.run(variables)
+        if kind == 'index_assignment':
+            target = self.compile_expression({'type': 'name', 'name': node['name']})
+            index, value = self.compile_expression(node['index']), self.compile_expression(node['value'])
+
+            def assign_index():
+                store_index(target(), index(), value())
+            return assign_index
+        if kind == 'delete':
+            name = node['name']
+
+            def delete():
+                variables.pop(name, None)
+            return delete
+        raise PNError(f"Unknown statement {kind!r}", node.get('line'))
+
+    def loop_tracer(self, node):
+        if not self.tracing or not traceable(node):
+            return None
+        tracer = LoopTracer(node, self.variables, self.append_targets, self.builtins, self.scopes, self.budget)
+        self.tracers.append(tracer)
+        return tracer
+
+    def compile_loop_body(self, body, assigned, block=None):
+        # Compiles the body (and anything else compiled before leave_loop) with hoisting
+        # of invariant expressions into this loop; returns the caches reset on loop entry
+        caches = []
+        self.loop_scopes.append((assigned, caches))
+        return self.compile_block(body, block), caches
+
+    def leave_loop(self):
+        self.loop_scopes.pop()
+
+    def compile_while(self, node):
+        variables, budget = self.variables, self.budget
+        body = node['body']
+        shape = counted_loop_shape(node) if self.loop_optimizations and node['type'] == 'while' else None
+        assigned = assigned_names(body)
+        steps, caches = self.compile_loop_body(body[:-1] if shape else body, assigned, body)
+        condition = self.compile_expression(node['condition'])
+        if shape:
+            name, op, limit_node, step = shape
+            limit = self.compile_expression(limit_node)
+            increment = self.compile_statement(body[-1])
+        self.leave_loop()
+        tracer = self.loop_tracer(node)
+
+        def while_loop():
+            for cache in caches:
+                cache[0] = MISSING
+            trace = tracer.entered() if tracer is not None else None
+            if trace is not None:
+                return trace(None)
+            counting = tracer is not None and tracer.count < TRACE_THRESHOLD
+            while condition():
+                budget.left -= 1
+                if budget.left <= 0:
+                    budget.check()
+                signal = run_loop_body(steps)
+                if signal is not None:
+                    return None if signal is BREAK else signal
+                if counting:
+                    tracer.count += 1
+                    if tracer.count >= TRACE_THRESHOLD:
+                        counting = False
+                        trace = tracer.trace()
+                        if trace is not None:
+                            return trace(None)
+            return None
+
+        def do_while_loop():
+            for cache in caches:
+                cache[0] = MISSING
+            while True:
+                budget.left -= 1
+                if budget.left <= 0:
+                    budget.check()
+                signal = run_loop_body(steps)
+                if signal is not None:
+                    return None if signal is BREAK else signal
+                if not condition():
+                    return None
+
+        if node['type'] == 'do_while':
+            return do_while_loop
+        if not shape:
+            return while_loop
+
+        def counted_loop():
+            # The counter runs over a native range; the condition and increment are not
+            # interpreted per iteration. Non-int bounds take the general loop.
+            for cache in caches:
+                cache[0] = MISSING
+            start, stop = variables.get(name), limit()
+            if type(start) is not int or type(stop) is not int:
+                return general_loop()
+            trace = tracer.entered() if tracer is not None else None
+            if trace is not None:
+                return trace(None)
+            counting = tracer is not None and tracer.count < TRACE_THRESHOLD
+            if op == '<=':
+                stop += 1
+            elif op == '>=':
+                stop -= 1
+            last = start
+            for value in range(start, stop, step):
+                budget.left -= 1
+                if budget.left <= 0:
+                    budget.check()
+                variables[name] = last = value
+                signal = run_loop_body(steps)
+                if signal is not None:
+                    return None if signal is BREAK else signal
+                if counting:
+                    tracer.count += 1
+                    if tracer.count >= TRACE_THRESHOLD:
+                        counting = False
+                        trace = tracer.trace()
+                        if trace is not None:
+                            variables[name] = value + step  # the trace resumes at the condition
+                            return trace(None)
+            if (step > 0 and start < stop) or (step < 0 and start > stop):
+                variables[name] = last + step
+            return None
+
+        def general_loop():
+            while condition():
+                budget.left -= 1
+                if budget.left <= 0:
+                    budget.check()
+                signal = run_loop_body(steps)
+                if signal is not None:
+                    return None if signal is BREAK else signal
+                increment()
+            return None
+        return counted_loop
+
+    def compile_block(self, statements, block=None):
+        # block: the statement list the scope analysis saw, if statements is part of it
+        return self.release_dead([self.compile_statement(statement) for statement in statements],
+                                 statements if block is None else block)
+
+    def release_dead(self, steps, block):
+        _, releases = self.scopes.get(id(block), ((), {}))
+        for index, names in releases.items():
+            if index < len(steps):
+                steps[index] = release_after(steps[index], names, self.variables)
+        return steps
+
+    def compile_switch(self, node):
+        # Constant labels go into a dict from value to case index (first one wins);
+        # other labels are compared in order, and only before the table's match
+        subject = self.compile_expression(node['subject'])
+        steps = []    # statements of all cases, in source order
+        entries = []  # index of each case's first statement in steps
+        table = {}
+        dynamic = []
+        default = None
+        for order, case in enumerate(node['cases']):
+            entries.append(len(steps))
+            steps.extend(self.compile_statement(statement) for statement in case['body'])
+            label = case['label']
+            if label is None:
+                default = order
+                continue
+            value = constant_value(label) if self.jump_tables else NOT_CONSTANT
+            if value is not NOT_CONSTANT:
+                table.setdefault(switch_key(value), order)
+            else:
+                dynamic.append((order, self.compile_expression(label)))
+        self.release_dead(steps, node['cases'])
+        # Fallthrough: a case runs on into later cases up to the first unconditional break
+        runs = []
+        for entry in entries:
+            stop = entry
+            while stop < len(steps) and steps[stop] is not break_statement:
+                stop += 1
+            runs.append(tuple(steps[entry:stop]))
+
+        def switch_statement():
+            value = subject()
+            try:
+                match = table.get(switch_key(value))
+            except TypeError:  # unhashable, e.g. an array
+                match = None
+            for order, label in dynamic:
+                if match is not None and order > match:
+                    break
+                if equals(value, label()):
+                    match = order
+                    break
+            if match is None:
+                match = default
+                if match is None:
+                    return None
+            signal = run_block(runs[match])
+            return None if signal is BREAK else signal
+        return switch_statement
+
+    def compile_append(self, name, operands, value):
+        # `s = s + a + b`: strings are appended to a StringBuilder; anything else
+        # (e.g. an int counter) runs the normally compiled expression
+        variables = self.variables
+        pieces = [self.compile_expression(operand) for operand in operands]
+
+        def append():
+            current = variables.get(name)
+            if type(current) is StringBuilder:
+                for piece in pieces:
+                    current = current.append(format_value(piece()))
+                variables[name] = current
+            elif type(current) is str:
+                parts = [current]
+                parts.extend(format_value(piece()) for piece in pieces)
+                variables[name] = StringBuilder(parts)
+            else:
+                variables[name] = value()
+        return append
+
+    def compile_expression(self, node):
+        if self.loop_scopes and node['type'] in ('binary', 'template') and self.loop_optimizations:
+            return self.compile_hoisted(node)
+        return self.compile_plain(node)
+
+    def compile_hoisted(self, node):
+        # An expression whose names are not assigned in the outermost possible enclosing
+        # loop is evaluated once per entry into that loop, on first use
+        names = referenced_names(node)
+        kinds = {item['type'] for item in walk(node)}
+        if 'call' in kinds:
+            return self.compile_plain(node)  # a call may have effects, or read stdin or a file
+        if any(type(BUILTINS[name]) is Stream for name in names & self.builtins):
+            return self.compile_plain(node)  # reading stdin consumes it
+        if self.index_writes and kinds.intersection(ARRAY_READS):
+            return self.compile_plain(node)  # the items may change while the names do not
+        for assigned, caches in self.loop_scopes:
+            if names and not names & assigned:
+                break
+        else:
+            return self.compile_plain(node)
+        scopes, self.loop_scopes = self.loop_scopes, []
+        expression = self.compile_plain(node)
+        self.loop_scopes = scopes
+        cache = [MISSING]
+        caches.append(cache)
+        variables = self.variables
+
+        def hoisted():
+            value = cache[0]
+            if value is MISSING:
+                # A name bound to a stream, e.g. `let input = stdin;`, is read again each time
+                if any(type(variables.get(name)) is Stream for name in names):
+                    cache[0] = STREAM_READ
+                    return expression()
+                value = cache[0] = expression()
+            elif value is STREAM_READ:
+                return expression()
+            return value
+        return hoisted
+
+    def compile_plain(self, node):
+        kind = node['type']
+        if kind in LITERAL_TYPES:
+            value = node['value']
+            return lambda: value
+        if kind == 'name':
+            variables, name = self.variables, node['name']
+            if name in self.builtins:
+                function = BUILTINS[name]
+                return lambda: function
+            if name in self.append_targets:
+                def load_string():
+                    try:
+                        value = variables[name]
+                    except KeyError:
+                        raise PNError(f"{name!r} is not defined") from None
+                    return str(value) if type(value) is StringBuilder else value
+                return load_string
+
+            def load():
+                try:
+                    return variables[name]
+                except KeyError:
+                    raise PNError(f"{name!r} is not defined") from None
+            return load
+        if kind == 'array':
+            items = [self.compile_expression(item) for item in node['items']]
+            return lambda: [item() for item in items]
+        if kind == 'template':
+            return self.compile_format(node['parts'])
+        if kind == 'index':
+            target, index = self.compile_expression(node['target']), self.compile_expression(node['index'])
+            return lambda: index_value(target(), index())
+        if kind == 'method':
+            target, name, lazy = self.compile_expression(node['target']), node['name'], self.lazy_arrays
+            args = [self.compile_expression(arg) for arg in node['args']]
+            return lambda: array_method(target(), name, [arg() for arg in args], lazy)
+        if kind == 'property':
+            target = self.compile_expression(node['target'])
+            return lambda: length_of(target())
+        if kind == 'call':
+            return self.compile_call(node)
+        if kind == 'arrow':
+            return build_arrow(node, self.variables, self.types, self.append_targets, self.builtins)
+        if kind == 'binary':
+            if node['op'] == '+':
+                operands = concat_operands(node)
+                if operands[0]['type'] == 'string' or self.types.get(id(operands[0])) == 'string':
+                    # The chain is a string from its first operand on: one format operation
+                    if operands[0]['type'] != 'string':
+                        self.operation_counts['specialized'] += len(operands) - 1
+                    return self.compile_format(operands)
+            return self.compile_binary(node)
+        raise PNError(f"Unknown expression {kind!r}")
+
+    def compile_call(self, node):
+        # Builtins are bound here, not looked up per call; one and two arguments, the
+        # common cases, get a closure without the argument list comprehension
+        callee, args = node['callee'], [self.compile_expression(arg) for arg in node['args']]
+        if callee['type'] == 'name' and callee['name'] in self.builtins:
+            function = BUILTINS[callee['name']]
+            if len(args) == 1:
+                (first,) = args
+                return lambda: call_value(function, (first(),))
+            if len(args) == 2:
+                first, second = args
+                return lambda: call_value(function, (first(), second()))
+            return lambda: call_value(function, [arg() for arg in args])
+        function = self.compile_expression(callee)
+        return lambda: call_value(function(), [arg() for arg in args])
+
+    def compile_format(self, parts):
+        # Literal text goes into a format string built once; only the expressions run
+        template = []
+        values = []
+        for part in parts:
+            if part['type'] in LITERAL_TYPES:
+                template.append(format_value(part['value']).replace('{', '{{').replace('}', '}}'))
+            else:
+                template.append('{}')
+                values.append(self.compile_expression(part))
+        text = ''.join(template)
+        if not values:
+            text = text.format()
+            return lambda: text
+        fmt = text.format
+        if len(values) == 1:
+            (only,) = values
+            return lambda: fmt(format_value(only()))
+        return lambda: fmt(*[format_value(value()) for value in values])
+
+    def compile_binary(self, node):
+        op, left_node, right_node = node['op'], node['left'], node['right']
+        generic = GENERIC_OPS[op]
+        counts = self.operation_counts
+        if left_node['type'] in LITERAL_TYPES and right_node['type'] in LITERAL_TYPES:
+            try:
+                value = generic(left_node['value'], right_node['value'])
+                counts['folded'] += 1
+                return lambda: value  # constant folding
+            except PNError:
+                pass  # report it when the statement runs
+        expr = typed_source(node, self.types) if self.types else None
+        if expr is not None:
+            # The whole tree is one Python expression: no guards and no call per operation
+            counts['specialized'] += expr.count('(')
+            return typed_factory(expr)(self.variables, PNError)
+        left = self.compile_expression(left_node)
+        factories = specialization(op, self.types.get(id(left_node)), self.types.get(id(right_node)))
+        if factories:
+            counts['specialized'] += 1
+            make_binary, make_binary_const = factories
+            if right_node['type'] in LITERAL_TYPES:
+                return make_binary_const(left, right_node['value'], generic)
+            return make_binary(left, self.compile_expression(right_node), generic)
+        counts['guarded'] += 1
+        if not self.fast_paths:
+            right = self.compile_expression(right_node)
+            return lambda: generic(left(), right())
+        make_binary, make_binary_const = FAST_PATHS[op]
+        if right_node['type'] == 'number' and type(right_node['value']) is int:
+            return make_binary_const(left, right_node['value'], generic)
+        return make_binary(left, self.compile_expression(right_node), generic)
 
 class Interpreter:
-    def __init__(self, ast):
+    def __init__(self, ast, fast_paths=True, file_name=None, scope=None, budget=None, tracing=True):
+        # scope: variables to run over copy-on-write, as a task does; budget: a Budget
+        # to stop the run by, else an unlimited one; tracing: compile hot loops to Python
         self.ast = ast
-        self.memory = OptimizedMemory()
+        self.memory = OptimizedMemory(scope)
+        self.compiler = Compiler(self.memory, fast_paths, tracing=tracing, budget=budget)
+        self.budget = self.compiler.budget
+        if file_name is not None:
+            self.compiler.directory = os.path.dirname(os.path.abspath(file_name))
 
     def interpret(self):
-        for node in self.ast:
-            if node['type'] == 'variable_assignment':
-                self.memory.set_variable(node['name'], node['value'])
-            elif node['type'] == 'print':
-                value = node['value']
-                print(self.memory.get_variable(value) or value)
-            elif node['type'] == 'if':
-                condition = node['condition']
-                if self.memory.get_variable(condition) == 'true':
-                    print("If condition met:", node['body'])
-            elif node['type'] == 'for':
-                collection = self.memory.get_variable(node['collection']) or []
-                for item in collection:
-                    self.memory.set_variable(node['var'], item)
-                    print(f"For loop item: {item}, Body: {node['body']}")
-
-def run_code(code, multiplier=1):
+        outer = getattr(RUN_IMPORTS, 'exports', None)
+        outer_scope, outer_budget = getattr(CURRENT_SCOPE, 'variables', None), getattr(CURRENT_SCOPE, 'budget', None)
+        RUN_IMPORTS.exports = {}
+        CURRENT_SCOPE.variables, CURRENT_SCOPE.budget = self.memory.variables, self.budget
+        self.budget.start()
+        try:
+            run_block([step for _, step in self.compiler.compile(self.ast)])
+        finally:
+            RUN_IMPORTS.exports = outer
+            CURRENT_SCOPE.variables, CURRENT_SCOPE.budget = outer_scope, outer_budget
+
+def link_imports(node, link):
+    # The tree with each import node replaced by link(node); parents of a replaced node
+    # are copied, everything else (and the whole tree when nothing is imported) is shared
+    if isinstance(node, list):
+        items = [link_imports(item, link) for item in node]
+        return node if all(new is old for new, old in zip(items, node)) else items
+    if node.get('type') == 'import':
+        return link(node)
+    changed = {}
+    for key, value in node.items():
+        if isinstance(value, (list, dict)):
+            new = link_imports(value, link)
+            if new is not value:
+                changed[key] = new
+    return {**node, **changed} if changed else node
+
+def find_module(name, directory=None):
+    for base in (directory or os.getcwd(), *MODULE_PATH):
+        path = os.path.join(base, name)
+        if os.path.isfile(path):
+            return os.path.realpath(path)
+    raise PNError(f"Cannot find module {name!r}")
+
+RUN_IMPORTS = threading.local()  # exports: Module -> names it bound, for the run on this thread
+
+class Module:
+    # A compiled .pn file, shared by every program in the process that imports it. The
+    # first import in a run executes it in its own variable store; every import copies
+    # the names it bound into the importer.
+    def __init__(self, path, stamp, digest, ast, compiler, steps):
+        self.path = path
+        self.stamp = stamp    # (mtime_ns, size) when last checked
+        self.digest = digest  # of the source, so a touched but unchanged file is kept
+        self.variables = compiler.variables
+        self.budget = compiler.budget  # charges the budget of the run importing it
+        self.dependencies = list(compiler.modules.values())
+        self.names = frozenset(assigned_names(ast).union(*(module.names for module in self.dependencies)))
+        self.steps = steps
+        self.lock = threading.Lock()  # one run at a time uses self.variables
+
+    def run(self, variables):
+        exports = getattr(RUN_IMPORTS, 'exports', None)
+        if exports is not None and self in exports:
+            variables.update(exports[self])
+            return
+        with self.lock:
+            self.variables.clear()
+            importer, importer_budget = getattr(CURRENT_SCOPE, 'variables', None), getattr(CURRENT_SCOPE, 'budget', None)
+            budget = self.budget
+            budget.cancelled, budget.parent = False, importer_budget
+            CURRENT_SCOPE.variables, CURRENT_SCOPE.budget = self.variables, budget
+            try:
+                run_block(self.steps)
+            except PNError as error:
+                name = os.path.basename(self.path)
+                raise type(error)(f"{name}:{error.line}: {error.message}" if error.line is not None
+                                  else f"{name}: {error.message}") from None
+            finally:
+                CURRENT_SCOPE.variables, CURRENT_SCOPE.budget = importer, importer_budget
+                budget.parent = None
+            exported = {name: str(value) if type(value) is StringBuilder else value
+                        for name, value in self.variables.items()}
+        if exports is not None:
+            exports[self] = exported
+        variables.update(exported)
+
+class ModuleCache:
+    # Compiled modules by real path. A module is reused while its file and every module
+    # it imports are unchanged; an import that leads back to a module still loading fails.
+    def __init__(self):
+        self.modules = {}
+        self.loading = []  # paths being compiled, outermost first
+        self.lock = threading.RLock()
+
+    def load(self, path):
+        with self.lock:
+            if path in self.loading:
+                cycle = self.loading[self.loading.index(path):] + [path]
+                raise PNError("Circular import: " + ' -> '.join(os.path.basename(item) for item in cycle))
+            self.loading.append(path)
+            try:
+                module = self.modules.get(path)
+                if module is None or not self.current(module):
+                    module = self.modules[path] = self.compile(path)
+                return module
+            finally:
+                self.loading.pop()
+
+    def current(self, module):
+        stamp = module_stamp(module.path)
+        if stamp != module.stamp:
+            if hashlib.blake2b(read_module(module.path)).digest() != module.digest:
+                return False
+            module.stamp = stamp
+        return all(self.load(dependency.path) is dependency for dependency in module.dependencies)
+
+    def compile(self, path):
+        stamp = module_stamp(path)
+        code = read_module(path)
+        lexer = Lexer(code)
+        compiler = Compiler(OptimizedMemory())
+        compiler.directory = os.path.dirname(path)
+        try:
+            ast = Parser(lexer.tokens, lexer).parse()
+            steps = [step for _, step in compiler.compile(ast)]
+        except PNError as error:
+            raise PNError(f"{os.path.basename(path)}:{error.line}: {error.message}" if error.line is not None
+                          else error.message) from None
+        return Module(path, stamp, hashlib.blake2b(code).digest(), ast, compiler, steps)
+
+    def clear(self):
+        with self.lock:
+            self.modules.clear()
+
+def module_stamp(path):
+    try:
+        status = os.stat(path)
+    except OSError as error:
+        raise PNError(f"Cannot import {os.path.basename(path)!r}: {error.strerror}") from None
+    return status.st_mtime_ns, status.st_size
+
+def read_module(path):
+    try:
+        with open(path, 'rb') as file:
+            return file.read()
+    except OSError as error:
+        raise PNError(f"Cannot import {os.path.basename(path)!r}: {error.strerror}") from None
+
+MODULES = ModuleCache()  # shared by every run in the process
+
+def load_source(file_name):
+    # Map the file instead of reading it into a str; the lexer scans the mapped bytes
+    with open(file_name, 'rb') as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            return b''  # mmap cannot map an empty file
+        return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+def run_code(code, multiplier=1, incremental=None, file_name=None, report=None, budget=None, ast=None,
+             tracing=True):
+    # report: a MemoryReport to fill in; without one nothing is traced. budget: a Budget
+    # to cancel or limit the run with. ast: the program already parsed, in place of code.
+    # tracing: whether hot loops are compiled to Python
     time.sleep(1 / multiplier)  # Simulate speed
-    lexer = Lexer(code)
-    parser = Parser(lexer.tokens)
-    ast = parser.parse()
-    interpreter = Interpreter(ast)
+    phase = report.phase if report is not None else untraced_phase
+    interpreter = None
+    if report is not None:
+        report.start()
+    try:
+        if report is not None:
+            with phase('lex'):
+                report.tokens = sum(1 for _ in Lexer(code).tokens)
+        with phase('parse'):
+            if ast is not None:
+                pass
+            elif incremental is not None:
+                ast = incremental.parse(code)
+            else:
+                lexer = Lexer(code)
+                parser = Parser(lexer.tokens, lexer)
+                ast = parser.parse()
+        interpreter = Interpreter(ast, file_name=file_name, budget=budget, tracing=tracing)
+        with phase('execute'):
+            interpreter.interpret()
+    finally:
+        if report is not None:
+            report.finish(ast, interpreter.memory.variables if interpreter is not None else {})
+        if isinstance(code, mmap.mmap):
+            try:
+                code.close()
+            except BufferError:
+                pass  # a parse error's traceback still holds the lexer; unmapped when it goes
+
+class ReplSession:
+    # Program state kept between inputs: one Compiler with its variables, its append
+    # targets and the imports run so far, and one SymbolTable. Each input is lexed, parsed
+    # and compiled on its own against the names bound by earlier ones; only its own
+    # statements run, so an input costs the same however much came before it
+    def __init__(self, directory=None):
+        self.directory = os.path.abspath(directory or os.getcwd())
+        self.reset()
+
+    def reset(self):
+        # A session with nothing bound or imported yet
+        self.memory = OptimizedMemory()
+        self.compiler = Compiler(self.memory)
+        self.compiler.directory = self.directory
+        self.symbols = SymbolTable()
+        self.exports = {}  # RUN_IMPORTS.exports of the session, so a module runs once
+        self.budget = None  # of the input running, for stop()
+        self.inputs = 0
+
+    def parse(self, source):
+        # Statements of an input; a bare expression becomes a print of its value
+        lexer = Lexer(source, symbols=self.symbols)
+        ast = Parser(lexer.tokens, lexer).parse()
+        if ast:
+            if len(ast) == 1 and ast[0]['type'] == 'expression_statement':
+                return [dict(ast[0], type='print')]
+            return ast
+        lexer = Lexer(source, symbols=self.symbols)
+        parser = Parser(lexer.tokens, lexer)
+        if parser.current_token is None:
+            return []
+        value = parser.parse_expression()
+        if parser.current_token is not None:
+            raise parser.error(f"Unexpected {parser.current_token!r}")
+        return [{'type': 'print', 'value': value, 'line': 1}]
+
+    def run(self, source):
+        self.execute(self.parse(source))
+
+    def execute(self, ast):
+        self.inputs += 1
+        # Loops compiled from this input count down a budget of its own
+        self.budget = self.compiler.budget = Budget()
+        steps = [step for _, step in self.compiler.compile(ast)]
+        outer = getattr(RUN_IMPORTS, 'exports', None)
+        outer_scope, outer_budget = getattr(CURRENT_SCOPE, 'variables', None), getattr(CURRENT_SCOPE, 'budget', None)
+        RUN_IMPORTS.exports = self.exports
+        CURRENT_SCOPE.variables, CURRENT_SCOPE.budget = self.memory.variables, self.budget
+        self.budget.start()
+        try:
+            run_block(steps)
+        finally:
+            RUN_IMPORTS.exports = outer
+            CURRENT_SCOPE.variables, CURRENT_SCOPE.budget = outer_scope, outer_budget
+
+    def stop(self):
+        budget = self.budget
+        if budget is not None:
+            budget.cancel()
+
+REPL_RESET = ':reset'  # entered on its own: starts the session over and recompiles imported modules
+
+def reset_session(session):
+    session.reset()
+    MODULES.clear()
+
+def incomplete_input(error):
+    # Whether a parse error only means the input has not been finished yet
+    return error.message.endswith("but found end of file")
+
+def run_repl(directory=None):
+    # Terminal REPL: input continues over lines while it is incomplete, Ctrl-C stops a
+    # running input, :reset starts over and Ctrl-D ends the session
+    session = ReplSession(directory)
+    lines = []
+    while True:
+        try:
+            lines.append(input('... ' if lines else 'pn> '))
+        except EOFError:
+            print()
+            return 0
+        except KeyboardInterrupt:
+            print()
+            lines = []
+            continue
+        if len(lines) == 1 and lines[0].strip() == REPL_RESET:
+            reset_session(session)
+            lines = []
+            continue
+        try:
+            ast = session.parse('\n'.join(lines))
+        except PNError as error:
+            if not (incomplete_input(error) and lines[-1].strip()):  # an empty line ends it anyway
+                print(f"{type(error).__name__}: {error}")
+                lines = []
+            continue
+        lines = []
+        try:
+            session.execute(ast)
+        except KeyboardInterrupt:
+            print("Interrupted")
+        except Exception as error:
+            print(f"{type(error).__name__}: {error}")
+
+def untraced_phase(name):
+    return UNTRACED
+
+UNTRACED = contextlib.nullcontext()
+MEMORY_TOP_SITES = 10
+
+class MemoryReport:
+    # Opt-in memory accounting for one run, with tracemalloc: extra peak and retained
+    # traced memory of each phase, sizes of the AST and the variable store, the sites
+    # holding the most memory after execution, and the live values by .pn type.
+    # tracemalloc is process-wide, so runs on other threads are counted too. Lexing is
+    # lazy and interleaved with parsing, so 'lex' is a separate tokenizing pass and
+    # 'parse' includes lexing again.
+    def __init__(self):
+        self.phases = {}
+        self.tokens = None
+        self.started = False
+        self.summary = {}
+
+    def start(self):
+        self.started = not tracemalloc.is_tracing()
+        if self.started:
+            tracemalloc.start()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            current, peak = tracemalloc.get_traced_memory()
+            self.phases[name] = {'seconds': round(time.perf_counter() - start, 6),
+                                 'peak_bytes': peak - before, 'retained_bytes': current - before}
+
+    def finish(self, ast, variables):
+        snapshot = tracemalloc.take_snapshot().filter_traces(
+            (tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, contextlib.__file__)))
+        sites = [{'site': f"{os.path.basename(stat.traceback[0].filename)}:{stat.traceback[0].lineno}",
+                  'bytes': stat.size, 'blocks': stat.count}
+                 for stat in snapshot.statistics('lineno')[:MEMORY_TOP_SITES]]
+        if self.started:
+            tracemalloc.stop()
+        self.summary = {'phases': self.phases, 'tokens': self.tokens,
+                        'ast_bytes': deep_size(ast) if ast is not None else None,
+                        'variables': {'names': len(variables), 'bytes': deep_size(variables)},
+                        'values': count_values(variables.values()), 'top_sites': sites}
+
+def deep_size(root):
+    # Bytes of a value and everything it holds, each object counted once; a shared
+    # block is counted by its Python objects, not the memory other processes see too
+    seen = set()
+    stack = [root]
+    total = 0
+    while stack:
+        value = stack.pop()
+        if id(value) in seen:
+            continue
+        seen.add(id(value))
+        total += sys.getsizeof(value)
+        if type(value) is dict:
+            stack.extend(value.keys())
+            stack.extend(value.values())
+        elif type(value) in (list, tuple):
+            stack.extend(value)
+        elif type(value) is ArrayView:
+            stack.extend((value.source, value.stages, value.items))
+        elif type(value) is StringBuilder:
+            stack.append(value.parts)
+    return total
+
+def count_values(values):
+    # Live .pn values by type, items of list arrays included. Numbers in typed buffers,
+    # ranges and shared arrays are not objects, so only their array is counted.
+    counts = collections.Counter()
+    stack = list(values)
+    while stack:
+        value = stack.pop()
+        counts[type_name(value)] += 1
+        if type(value) is ArrayView:
+            value = value.items
+        if type(value) is list:
+            stack.extend(value)
+    return dict(counts.most_common())
+
+def format_size(size):
+    for unit in ('B', 'KB', 'MB'):
+        if abs(size) < 1024:
+            return f"{size:.0f} {unit}" if unit == 'B' else f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} GB"
+
+def format_memory_report(summary):
+    phases = ', '.join(f"{name} peak {format_size(phase['peak_bytes'])} (kept {format_size(phase['retained_bytes'])})"
+                       for name, phase in summary['phases'].items())
+    lines = [f"memory: {phases}"]
+    if summary['ast_bytes'] is not None:
+        lines.append(f"ast {format_size(summary['ast_bytes'])} from {summary['tokens']} tokens; "
+                     f"variables {summary['variables']['names']} names, {format_size(summary['variables']['bytes'])}")
+    if summary['values']:
+        lines.append('values: ' + ', '.join(f"{kind} {count}" for kind, count in summary['values'].items()))
+    lines.extend(f"  {site['site']}: {format_size(site['bytes'])} in {site['blocks']} blocks"
+                 for site in summary['top_sites'])
+    return '\n'.join(lines) + '\n'
+
+def run_file_parallel(file_name, workers, budget=None):
+    ast = parse_parallel(file_name, workers)
+    interpreter = Interpreter(ast, file_name=file_name, budget=budget)
     interpreter.interpret()
 
+def expand_targets(targets):
+    # Files, globs and directories (searched recursively) -> paths in order, without duplicates
+    files = []
+    seen = set()
+    for target in targets:
+        if os.path.isdir(target):
+            matches = sorted(glob.glob(os.path.join(target, '**', '*.pn'), recursive=True))
+        elif glob.has_magic(target):
+            matches = sorted(glob.glob(target, recursive=True))
+        else:
+            matches = [target]
+        for match in matches:
+            if match not in seen:
+                seen.add(match)
+                files.append(match)
+    return files
+
+def run_file_captured(file_name, memory=False, limits=None, tracing=True):
+    # Batch worker: run one file, capturing its output, exit status and duration, and
+    # with memory=True a memory report. limits: Budget arguments; a run stopped by them
+    # exits with 124, as timeout(1) does. tracing=False runs hot loops in the interpreter
+    start = time.perf_counter()
+    result = {'file': file_name, 'exit_code': 0, 'error': None}
+    output = io.StringIO()
+    if not (os.path.exists(file_name) and file_name.endswith('.pn')):
+        result.update(exit_code=2, error="File not found or invalid extension.")
+    else:
+        report = MemoryReport() if memory else None
+        try:
+            with contextlib.redirect_stdout(output):
+                run_code(load_source(file_name), SPEED_MULTIPLIER, file_name=file_name, report=report,
+                         budget=Budget(**limits) if limits else None, tracing=tracing)
+        except RunStopped as error:
+            result.update(exit_code=124, error=str(error))
+        except Exception as error:
+            result.update(exit_code=1, error=f"{type(error).__name__}: {error}")
+        if report is not None:
+            result['memory'] = report.summary
+    result['duration'] = round(time.perf_counter() - start, 6)
+    result['output'] = output.getvalue()
+    return result
+
+def run_batch(files, workers=BATCH_WORKERS, memory=False, limits=None, tracing=True):
+    # Bounded process pool; results come back in input order
+    if workers == 1:
+        return [run_file_captured(file_name, memory, limits, tracing) for file_name in files]
+    chunksize = max(1, len(files) // (workers * 4))
+    with ProcessPoolExecutor(max_workers=workers, mp_context=PROCESSES) as executor:
+        return list(executor.map(run_file_captured, files, itertools.repeat(memory), itertools.repeat(limits),
+                                 itertools.repeat(tracing), chunksize=chunksize))
+
+RUN_OUTPUT_CHUNK = 4096  # characters
+RUN_OUTPUT_SECONDS = 0.05  # output of a run is sent at least this often while it prints
+RUN_KILL_GRACE = 1.0  # after Stop, for a run stuck where its budget is not checked
+RUN_CHANNEL = {}  # in a run worker process: send(report) and the stop event of its slot
+
+def kill_worker(process):
+    # Kills a RunQueue worker together with the processes of a parallel() it was running,
+    # which would otherwise go on without a budget
+    try:
+        if hasattr(os, 'killpg'):
+            os.killpg(process.pid, signal.SIGKILL)
+        else:
+            process.kill()
+    except ProcessLookupError:
+        pass  # already gone
+
+def run_worker_loop(jobs, reports, stop):
+    # A RunQueue worker process: runs the jobs sent to its slot one at a time, until None.
+    # Reports go back on a pipe of its own, so killing it affects no other worker
+    lock = threading.Lock()  # the run's thread and its watcher both report
+    if hasattr(os, 'setpgrp'):
+        os.setpgrp()  # its own process group, with the pool of any parallel() it starts
+
+    def send(report):
+        with lock:
+            reports.send(report)
+    RUN_CHANNEL.update(send=send, stop=stop)
+    while True:
+        job = jobs.recv()
+        if job is None:
+            return
+        run_in_worker(*job)
+
+class RunOutput(io.TextIOBase):
+    # sys.stdout of a launcher run, in a worker process or the REPL's thread: output is
+    # sent as ('output', text) reports in chunks, when a chunk fills up and when another
+    # thread (the run's watcher, the launcher's poll) flushes it while the run goes on
+    def __init__(self, send):
+        self.send = send
+        self.parts = []
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def writable(self):
+        return True
+
+    def write(self, text):
+        with self.lock:
+            self.parts.append(text)
+            self.size += len(text)
+        if self.size >= RUN_OUTPUT_CHUNK:
+            self.flush()
+        return len(text)
+
+    def flush(self):
+        # Under the lock, so chunks from the two threads are sent in order
+        with self.lock:
+            if self.parts:
+                self.send(('output', ''.join(self.parts)))
+                self.parts = []
+                self.size = 0
+
+def run_in_worker(file_name, memory=False, ast=None):
+    # One launcher run, in a worker process of a RunQueue: reports ('start', pid),
+    # ('output', text)... and ('exit', result). Setting the slot's stop event cancels the
+    # run's budget. ast: the program as the launcher parsed it; None to parse it here
+    send, stop = RUN_CHANNEL['send'], RUN_CHANNEL['stop']
+    send(('start', os.getpid()))
+    start = time.perf_counter()
+    result = {'file': file_name, 'exit_code': 0, 'error': None}
+    output = RunOutput(send)
+    budget = Budget()
+    finished = threading.Event()
+
+    def watch():
+        while not finished.is_set():
+            if stop.wait(RUN_OUTPUT_SECONDS):
+                budget.cancel()
+                return
+            output.flush()
+    threading.Thread(target=watch, daemon=True).start()
+    report = MemoryReport() if memory else None
+    sys.stdout = output
+    try:
+        if ast is not None:
+            run_code(None, SPEED_MULTIPLIER, file_name=file_name, budget=budget, ast=ast)
+        elif report is None and PARSE_WORKERS > 1 and os.path.getsize(file_name) >= PARALLEL_PARSE_MIN_SIZE:
+            run_file_parallel(file_name, PARSE_WORKERS, budget=budget)
+        else:
+            run_code(load_source(file_name), SPEED_MULTIPLIER, file_name=file_name, report=report, budget=budget)
+    except RunStopped as error:
+        result.update(exit_code=124, error=str(error))
+    except Exception as error:
+        result.update(exit_code=1, error=f"{type(error).__name__}: {error}")
+    finally:
+        sys.stdout = sys.__stdout__
+        finished.set()
+    if report is not None:
+        output.write(format_memory_report(report.summary))
+    output.flush()
+    result['duration'] = round(time.perf_counter() - start, 6)
+    send(('exit', result))
+
+class LauncherRun:
+    # One submission to a RunQueue. status: queued, running, done, failed or stopped
+    def __init__(self, number, file_name, memory=False):
+        self.number = number
+        self.file_name = file_name
+        self.memory = memory
+        self.status = 'queued'
+        self.slot = None
+        self.result = None
+        self.submitted = time.monotonic()
+        self.started = self.finished = None
+        self.stopping = None  # when Stop was asked for while it ran
+        self.parsed = None  # Future of its AST, when the launcher parses it
+
+    def elapsed(self):
+        # Seconds running so far, or in total once finished
+        if self.started is None:
+            return 0.0
+        return (self.finished or time.monotonic()) - self.started
+
+class RunQueue:
+    # Launcher runs on a bounded set of worker processes, one per slot, each running one
+    # run at a time; later submissions wait in order. A slot has its worker's stop event
+    # and the pipes jobs and reports go through; poll() applies the reports. A run still
+    # going RUN_KILL_GRACE after Stop has its worker killed, and the slot gets a new one.
+    # Files are parsed here, on one thread in submission order, with an IncrementalParser
+    # per file, and the AST is sent with the job: a re-run reparses only what was edited
+    # whichever worker it lands on, and a killed worker loses no parse state.
+    def __init__(self, workers=RUN_WORKERS):
+        self.workers = workers
+        self.stops = [PROCESSES.Event() for _ in range(workers)]
+        self.processes = [None] * workers  # slot -> (process, jobs, reports), started on first use
+        self.free = list(range(workers - 1, -1, -1))
+        self.pending = collections.deque()
+        self.running = {}  # slot -> LauncherRun
+        self.submitted = 0
+        self.parsers = {}  # absolute path -> IncrementalParser
+        self.parsing = ThreadPoolExecutor(max_workers=1)
+        self.failed = []  # runs whose parse failed, reported by the next poll()
+
+    def submit(self, file_name, memory=False):
+        self.submitted += 1
+        run = LauncherRun(self.submitted, file_name, memory)
+        if not memory:  # a memory report traces the parse itself, in the worker
+            run.parsed = self.parsing.submit(self.parse, file_name)
+        self.pending.append(run)
+        self.dispatch()
+        return run
+
+    def parse(self, file_name):
+        # None for a file large enough to be parsed in parallel, in the worker
+        if PARSE_WORKERS > 1 and os.path.getsize(file_name) >= PARALLEL_PARSE_MIN_SIZE:
+            return None
+        code = load_source(file_name)
+        try:
+            return self.parsers.setdefault(os.path.abspath(file_name), IncrementalParser()).parse(code)
+        finally:
+            if isinstance(code, mmap.mmap):
+                code.close()
+
+    def position(self, run):
+        # 1 for the next run to start; None once it has left the queue
+        return self.pending.index(run) + 1 if run.status == 'queued' else None
+
+    def worker(self, slot):
+        if self.processes[slot] is not None and not self.processes[slot][0].is_alive():
+            self.kill(slot)  # ended while idle
+        if self.processes[slot] is None:
+            jobs, job_sender = PROCESSES.Pipe(duplex=False)
+            reports, report_sender = PROCESSES.Pipe(duplex=False)
+            # Not daemonic, so that a run can still start the pool of parallel()
+            process = PROCESSES.Process(target=run_worker_loop, args=(jobs, report_sender, self.stops[slot]))
+            process.start()
+            jobs.close()
+            report_sender.close()
+            self.processes[slot] = (process, job_sender, reports)
+        return self.processes[slot]
+
+    def dispatch(self):
+        while self.free and self.pending:
+            run = self.pending[0]
+            if run.parsed is not None and not run.parsed.done():
+                return  # runs start in order, so later ones wait for this parse
+            self.pending.popleft()
+            try:
+                ast = run.parsed.result() if run.parsed is not None else None
+            except Exception as error:
+                run.status = 'failed'
+                run.started = run.finished = time.monotonic()
+                run.result = {'file': run.file_name, 'exit_code': 1, 'error': f"{type(error).__name__}: {error}",
+                              'duration': 0.0}
+                self.failed.append(run)
+                continue
+            run.slot = slot = self.free.pop()
+            run.status = 'running'
+            self.stops[slot].clear()
+            self.running[slot] = run
+            self.worker(slot)[1].send((run.file_name, run.memory, ast))
+
+    def stop(self, run):
+        if run.status == 'queued':
+            self.pending.remove(run)
+            run.status = 'stopped'
+            run.finished = time.monotonic()
+        elif run.status == 'running':
+            self.stops[run.slot].set()
+            if run.stopping is None:
+                run.stopping = time.monotonic()
+
+    def finish(self, run, result):
+        run.result = result
+        run.finished = time.monotonic()
+        if run.started is None:
+            run.started = run.finished
+        if result['exit_code'] == 0:
+            run.status = 'done'
+        else:
+            run.status = 'stopped' if result['exit_code'] == 124 and self.stops[run.slot].is_set() else 'failed'
+        del self.running[run.slot]
+        self.free.append(run.slot)
+
+    def kill(self, slot):
+        process, jobs, reports = self.processes[slot]
+        self.processes[slot] = None
+        kill_worker(process)
+        process.join()
+        jobs.close()
+        reports.close()
+
+    def poll(self, timeout=0):
+        # Applies what the workers reported, waiting up to `timeout` seconds for the first
+        # report, kills the workers of runs stuck after Stop and starts queued runs on the
+        # freed slots; returns [(kind, run, data)]
+        slots = {self.processes[slot][2]: slot for slot in self.running}
+        changes = [('exit', run, run.result) for run in self.failed]
+        self.failed = []
+        for reports in multiprocessing.connection.wait(list(slots), timeout):
+            run = self.running[slots[reports]]
+            try:
+                while run.finished is None and reports.poll():
+                    kind, data = reports.recv()
+                    if kind == 'start':
+                        run.started = time.monotonic()
+                    elif kind == 'exit':
+                        self.finish(run, data)
+                    changes.append((kind, run, data))
+            except (EOFError, OSError):
+                pass  # the worker ended; found below
+        now = time.monotonic()
+        for slot, run in list(self.running.items()):
+            process = self.processes[slot][0]
+            if run.stopping is not None and now - run.stopping >= RUN_KILL_GRACE:
+                self.kill(slot)
+                error = f"Stopped; the worker was killed after {RUN_KILL_GRACE:g}s"
+            elif not process.is_alive():
+                self.kill(slot)
+                error = f"Worker process ended with exit code {process.exitcode}"
+            else:
+                continue
+            self.finish(run, {'file': run.file_name, 'exit_code': 124 if run.stopping is not None else 1,
+                              'error': error, 'duration': round(run.elapsed(), 6)})
+            changes.append(('exit', run, run.result))
+        self.dispatch()
+        return changes
+
+    def close(self):
+        # Does not wait: the workers get RUN_KILL_GRACE to stop on their own, in a thread,
+        # and are killed after it
+        for run in list(self.pending):
+            self.stop(run)
+        self.parsing.shutdown(wait=False, cancel_futures=True)
+        for stop in self.stops:
+            stop.set()  # running runs end at their next safepoint
+        workers = [worker for worker in self.processes if worker is not None]
+        self.processes = [None] * self.workers
+        for _, jobs, _ in workers:
+            jobs.send(None)
+
+        def reap():
+            deadline = time.monotonic() + RUN_KILL_GRACE
+            for process, jobs, reports in workers:
+                process.join(max(0.0, deadline - time.monotonic()))
+                if process.is_alive():
+                    kill_worker(process)
+                jobs.close()
+                reports.close()
+        threading.Thread(target=reap, daemon=True).start()
+
+def format_summary(results, elapsed):
+    lines = []
+    for result in results:
+        status = 'OK' if result['exit_code'] == 0 else 'FAIL'
+        lines.append(f"{status:<4} {result['duration']:8.3f}s  {result['file']}")
+        if result['error']:
+            lines.append(f"     {result['error']}")
+        lines.extend(f"     | {line}" for line in result['output'].splitlines())
+        if result.get('memory'):
+            lines.extend(f"     {line}" for line in format_memory_report(result['memory']).splitlines())
+    failed = sum(1 for result in results if result['exit_code'])
+    lines.append(f"{len(results) - failed} passed, {failed} failed in {elapsed:.3f}s")
+    return '\n'.join(lines) + '\n'
+
+def main_cli(argv):
+    parser = argparse.ArgumentParser(prog='main.py', description="Run .pn programs without the launcher window")
+    sub = parser.add_subparsers(dest='command', required=True)
+    start = sub.add_parser('start', help="run files, globs or directories")
+    start.add_argument('targets', nargs='+')
+    start.add_argument('-j', '--workers', type=int, default=BATCH_WORKERS)
+    start.add_argument('--json', action='store_true', help="print the results as JSON")
+    start.add_argument('--memory', action='store_true', help="report memory use of each run (traced, slower)")
+    start.add_argument('--timeout', type=float, help="stop a run after this many seconds")
+    start.add_argument('--max-steps', type=int, help="stop a run after this many loop iterations")
+    start.add_argument('--max-memory', type=float, help="stop a run once the process is above this many MB")
+    start.add_argument('--no-tracing', dest='tracing', action='store_false',
+                       help="run hot loops in the interpreter instead of compiling them to Python")
+    repl = sub.add_parser('repl', help="interactive session that keeps its variables between inputs")
+    repl.add_argument('--dir', help="directory imports are looked up in (default: the working directory)")
+    args = parser.parse_args(argv)
+
+    if args.command == 'repl':
+        return run_repl(args.dir)
+
+    limits = {key: value for key, value in (('seconds', args.timeout), ('max_steps', args.max_steps),
+                                             ('max_memory', args.max_memory and int(args.max_memory * 2**20)))
+              if value is not None}
+    files = expand_targets(args.targets)
+    begin = time.perf_counter()
+    results = run_batch(files, max(1, args.workers), args.memory, limits, args.tracing)
+    elapsed = time.perf_counter() - begin
+    failed = sum(1 for result in results if result['exit_code'])
+    if args.json:
+        print(json.dumps({'results': results, 'passed': len(results) - failed, 'failed': failed,
+                          'elapsed': round(elapsed, 6)}, indent=2))
+    else:
+        sys.stdout.write(format_summary(results, elapsed))
+    return 1 if failed else 0
+
+OUTPUT_PAGE_BYTES = 64 * 1024  # about this much output per entry of the page index
+OUTPUT_SPILL_BYTES = 8 * 1024 * 1024  # output kept in memory before it moves to a temp file
+OUTPUT_CACHED_PAGES = 4
+
+class OutputBuffer:
+    # Append-only output for an OutputView. Text is kept UTF-8 encoded in a spooled temp
+    # file; the page index (byte offset and first line of a page, one per ~64 KB, always
+    # starting after a newline) finds any line with one read of one page, so memory
+    # hardly grows with the length of the output
+    def __init__(self):
+        self.file = tempfile.SpooledTemporaryFile(max_size=OUTPUT_SPILL_BYTES)
+        self.size = 0
+        self.newlines = 0
+        self.open_line = False  # output so far does not end with a newline
+        self.offsets = array.array('q', [0])
+        self.starts = array.array('q', [0])
+        self.cache = collections.OrderedDict()  # page -> its lines
+
+    def __len__(self):
+        return self.newlines + self.open_line
+
+    def append(self, text):
+        data = text.encode()
+        if not data:
+            return
+        # A page ends at the first newline once it holds OUTPUT_PAGE_BYTES, so one large
+        # append is split into as many pages as its lines allow
+        grown = len(self.offsets) - 1  # the last page, which this append extends
+        position, lines = 0, self.newlines
+        while True:
+            newline = data.find(b'\n', max(position, self.offsets[-1] + OUTPUT_PAGE_BYTES - 1 - self.size))
+            if newline < 0:
+                break
+            lines += data.count(b'\n', position, newline) + 1
+            position = newline + 1
+            self.offsets.append(self.size + position)
+            self.starts.append(lines)
+        self.file.seek(self.size)
+        self.file.write(data)
+        self.size += len(data)
+        self.newlines += data.count(b'\n')
+        self.open_line = not data.endswith(b'\n')
+        for page in range(grown, len(self.offsets)):
+            self.cache.pop(page, None)
+
+    def read_page(self, page):
+        start = self.offsets[page]
+        end = self.offsets[page + 1] if page + 1 < len(self.offsets) else self.size
+        self.file.seek(start)
+        return self.file.read(end - start)
+
+    def page_lines(self, page):
+        lines = self.cache.get(page)
+        if lines is None:
+            lines = self.read_page(page).decode(errors='replace').split('\n')
+            if page + 1 < len(self.offsets) or not self.open_line:
+                lines.pop()  # after the final newline
+            self.cache[page] = lines
+            if len(self.cache) > OUTPUT_CACHED_PAGES:
+                self.cache.popitem(last=False)
+        else:
+            self.cache.move_to_end(page)
+        return lines
+
+    def lines(self, first, count):
+        # Lines first .. first + count - 1, fewer at the end of the output
+        found = []
+        page = bisect.bisect_right(self.starts, first) - 1
+        while len(found) < count and page < len(self.offsets):
+            skip = first + len(found) - self.starts[page]
+            found.extend(self.page_lines(page)[skip:skip + count - len(found)])
+            page += 1
+        return found
+
+    def find(self, text, line=0):
+        # First line at or after `line` containing text, or None
+        needle = text.encode()
+        page = bisect.bisect_right(self.starts, line) - 1
+        while page < len(self.offsets):
+            data = self.read_page(page)
+            position = data.find(needle)
+            while position >= 0:
+                found = self.starts[page] + data.count(b'\n', 0, position)
+                if found >= line:
+                    return found
+                end = data.find(b'\n', position)
+                if end < 0:
+                    break
+                position = data.find(needle, end + 1)
+            page += 1
+        return None
+
+    def close(self):
+        self.file.close()
+
+class OutputView(tk.Frame):
+    # Output box over an OutputBuffer: the Text holds only the visible lines, and the
+    # scrollbar is driven from the line count, so a redraw costs the same at any output
+    # length. It follows the end of the output until scrolled away from it
+    def __init__(self, master, height=10, width=50):
+        super().__init__(master)
+        bar = tk.Frame(self)
+        bar.pack(fill=tk.X)
+        self.search_entry = tk.Entry(bar)
+        self.search_entry.pack(side=tk.LEFT, fill=tk.X, expand=True)
+        self.search_entry.bind('<Return>', lambda event: self.find_next())
+        tk.Button(bar, text="Find", command=self.find_next).pack(side=tk.LEFT)
+        tk.Button(bar, text="End", command=self.jump_to_end).pack(side=tk.LEFT)
+        self.scrollbar = tk.Scrollbar(self, command=self.scroll)
+        self.scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        self.text = tk.Text(self, height=height, width=width, wrap=tk.NONE, state=tk.DISABLED)
+        self.text.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        self.text.tag_configure('match', background='yellow')
+        self.line_height = tk.font.Font(font=self.text.cget('font')).metrics('linespace')
+        self.text.bind('<Configure>', self.resize)
+        for event in ('<MouseWheel>', '<Button-4>', '<Button-5>'):
+            self.text.bind(event, self.wheel)
+        self.buffer = OutputBuffer()
+        self.rows = height
+        self.top = 0
+        self.follow = True
+        self.match = None  # line of the last search match
+        self.pending = False
+
+    def write(self, text):
+        self.buffer.append(text)
+        self.schedule()
+
+    def clear(self):
+        self.buffer.close()
+        self.buffer = OutputBuffer()
+        self.top = 0
+        self.follow = True
+        self.match = None
+        self.schedule()
+
+    def schedule(self):
+        # Redraws at most once per pass of the event loop, however many writes came in
+        if not self.pending:
+            self.pending = True
+            self.after_idle(self.redraw)
+
+    def redraw(self):
+        self.pending = False
+        total = len(self.buffer)
+        last = max(0, total - self.rows)
+        self.top = last if self.follow else min(self.top, last)
+        self.text.config(state=tk.NORMAL)
+        self.text.delete('1.0', tk.END)
+        self.text.insert('1.0', '\n'.join(self.buffer.lines(self.top, self.rows)))
+        if self.match is not None and self.top <= self.match < self.top + self.rows:
+            row = self.match - self.top + 1
+            self.text.tag_add('match', f"{row}.0", f"{row}.end")
+        self.text.config(state=tk.DISABLED)
+        if total:
+            self.scrollbar.set(self.top / total, min(1.0, (self.top + self.rows) / total))
+        else:
+            self.scrollbar.set(0.0, 1.0)
+
+    def scroll(self, action, amount, unit=None):
+        # Scrollbar command: ('moveto', fraction) or ('scroll', count, 'units' | 'pages')
+        total = len(self.buffer)
+        if action == 'moveto':
+            top = int(float(amount) * total)
+        else:
+            top = self.top + int(amount) * (self.rows if unit == 'pages' else 1)
+        self.top = max(0, top)
+        self.follow = self.top >= total - self.rows
+        self.schedule()
+
+    def wheel(self, event):
+        up = event.num == 4 or getattr(event, 'delta', 0) > 0
+        self.scroll('scroll', -3 if up else 3, 'units')
+        return 'break'
+
+    def resize(self, event):
+        self.rows = max(1, event.height // self.line_height)
+        self.schedule()
+
+    def find_next(self):
+        # From the line after the last match, wrapping around to the start once
+        text = self.search_entry.get()
+        if not text:
+            return
+        start = self.top if self.match is None else self.match + 1
+        found = self.buffer.find(text, start)
+        if found is None and start:
+            found = self.buffer.find(text, 0)
+        if found is None:
+            self.bell()
+            return
+        self.match = found
+        self.top = max(0, found - self.rows // 2)
+        self.follow = False
+        self.schedule()
+
+    def jump_to_end(self):
+        self.follow = True
+        self.schedule()
+
+    def destroy(self):
+        self.buffer.close()
+        super().destroy()
+
+START_COMMAND_RE = re.compile(r'start\s+(?:-[-\w]|[\w./*~"\'])')  # not a statement about a name `start`
+
 class LauncherApp:
+    POLL_MS = 50
+
     def __init__(self, root):
         self.root = root
         self.root.title("PN Launcher V6")
         self.command_entry = tk.Entry(root, width=50)
         self.command_entry.pack(pady=20)
-        self.run_button = tk.Button(root, text="Run", command=self.run_command)
-        self.run_button.pack(pady=10)
-        self.output_text = tk.Text(root, height=10, width=50)
-        self.output_text.pack(pady=20)
+        self.command_entry.bind('<Return>', lambda event: self.run_command())
+        buttons = tk.Frame(root)
+        buttons.pack(pady=10)
+        self.run_button = tk.Button(buttons, text="Run", command=self.run_command)
+        self.run_button.pack(side=tk.LEFT)
+        self.stop_button = tk.Button(buttons, text="Stop", command=self.stop_run)
+        self.stop_button.pack(side=tk.LEFT)
+        self.close_button = tk.Button(buttons, text="Close tab", command=self.close_tab)
+        self.close_button.pack(side=tk.LEFT)
+        self.tabs = ttk.Notebook(root)
+        self.tabs.pack(pady=20, fill=tk.BOTH, expand=True)
+        # The first tab has messages and batch summaries; each run gets a tab of its own
+        self.output_text = OutputView(self.tabs)
+        self.tabs.add(self.output_text, text="Launcher")
+        # Anything entered that is not a start command is REPL input, run in order on one thread
+        self.repl_view = OutputView(self.tabs)
+        self.tabs.add(self.repl_view, text="REPL")
+        self.repl = ReplSession()
+        self.repl_lines = []  # of an input not finished yet
+        self.repl_reports = queue.SimpleQueue()
+        self.repl_output = RunOutput(self.repl_reports.put)
+        self.repl_runner = ThreadPoolExecutor(max_workers=1)
+        self.runs = RunQueue()
+        # Batches run one at a time, in the order started, so that only one pool of
+        # BATCH_WORKERS processes is up however often a batch is started
+        self.batches = ThreadPoolExecutor(max_workers=1)
+        self.batch = None  # Future of the batch started last
+        self.views = {}  # LauncherRun -> (frame, status label, OutputView)
+        self.root.protocol("WM_DELETE_WINDOW", self.close)
+        self.root.after(self.POLL_MS, self.poll_runs)
 
     def run_command(self):
         command = self.command_entry.get()
-        if command.startswith("start "):
-            file_name = command.split(" ", 1)[1].strip()
-            self.run_file(file_name)
-        else:
-            self.output_text.insert(tk.END, "Unknown command.\n")
+        if START_COMMAND_RE.match(command):
+            targets = shlex.split(command)[1:]
+            memory = '--memory' in targets
+            targets = [target for target in targets if target != '--memory']
+            workers = None
+            if len(targets) > 2 and targets[0] in ('-j', '--workers') and targets[1].isdigit():
+                workers = max(1, int(targets[1]))
+                targets = targets[2:]
+            if workers is None and len(targets) == 1 and not os.path.isdir(targets[0]) \
+                    and not glob.has_magic(targets[0]):
+                self.run_file(targets[0], memory)
+            else:
+                self.run_batch(targets, workers or BATCH_WORKERS, memory)
+        elif command.strip() or self.repl_lines:
+            self.run_input(command)
 
-    def run_file(self, file_name):
+    def run_input(self, line):
+        # One line of REPL input; an input goes on over lines while it is incomplete
+        self.command_entry.delete(0, tk.END)
+        self.tabs.select(self.repl_view)
+        self.repl_view.write(('... ' if self.repl_lines else 'pn> ') + line + '\n')
+        self.repl_lines.append(line)
+        if len(self.repl_lines) == 1 and line.strip() == REPL_RESET:
+            self.repl_lines = []
+            self.repl_runner.submit(reset_session, self.repl)  # after the inputs before it
+            return
+        try:
+            ast = self.repl.parse('\n'.join(self.repl_lines))
+        except PNError as error:
+            if not (incomplete_input(error) and line.strip()):  # an empty line ends it anyway
+                self.repl_lines = []
+                self.repl_view.write(f"{type(error).__name__}: {error}\n")
+            return
+        self.repl_lines = []
+        self.repl_runner.submit(self.execute_input, ast)
+
+    def execute_input(self, ast):
+        # On the REPL thread; stdout is redirected while an input runs
+        try:
+            with contextlib.redirect_stdout(self.repl_output):
+                self.repl.execute(ast)
+        except Exception as error:
+            self.repl_output.write(f"{type(error).__name__}: {error}\n")
+        self.repl_output.flush()
+
+    def run_batch(self, targets, workers, memory=False):
+        files = expand_targets(targets)
+        self.tabs.select(self.output_text)
+        busy = self.batch is not None and not self.batch.done()
+        if not busy:
+            self.output_text.clear()
+        if not files:
+            self.output_text.write("No .pn files matched.\n")
+            return
+        if busy:
+            self.output_text.write(f"Queued {len(files)} files until the batches before them finish.\n")
+        self.batch = self.batches.submit(self.batch_worker, files, workers, memory)
+
+    def batch_worker(self, files, workers, memory):
+        # On the batch thread
+        self.root.after(0, self.output_text.write, f"Running {len(files)} files on {workers} workers...\n")
+        start = time.perf_counter()
+        results = run_batch(files, workers, memory)
+        summary = format_summary(results, time.perf_counter() - start)
+        self.root.after(0, self.output_text.write, summary)  # Tk widgets only from the main thread
+
+    def run_file(self, file_name, memory=False):
         if os.path.exists(file_name) and file_name.endswith('.pn'):
-            with open(file_name, 'r', buffering=1) as file:  # Buffered I/O
-                code = file.read()
-            self.output_text.delete(1.0, tk.END)  # Clear previous output
-            thread = threading.Thread(target=run_code, args=(code, 10_000_000_000_000_000))
-            thread.start()  # Run code in a separate thread to avoid blocking
+            run = self.runs.submit(file_name, memory)
+            frame = tk.Frame(self.tabs)
+            status = tk.Label(frame, anchor=tk.W)
+            status.pack(fill=tk.X)
+            view = OutputView(frame)
+            view.pack(fill=tk.BOTH, expand=True)
+            self.views[run] = (frame, status, view)
+            self.tabs.add(frame, text=f"{run.number}: {os.path.basename(file_name)}")
+            self.tabs.select(frame)
+            self.show_status(run)
+        else:
+            self.output_text.write("File not found or invalid extension.\n")
+
+    def show_status(self, run):
+        frame, status, _ = self.views[run]
+        if run.status == 'queued':
+            label = f"queued, {self.runs.position(run)} of {len(self.runs.pending)}"
+        elif run.status == 'running':
+            label = f"running, {run.elapsed():.1f}s"
+        elif run.result is None:
+            label = "stopped before it started"
         else:
-            self.output_text.insert(tk.END, "File not found or invalid extension.\n")
+            label = f"{run.status} in {run.result['duration']:.3f}s"
+            if run.result['error']:
+                label += f": {run.result['error']}"
+        status.config(text=label)
+        self.tabs.tab(frame, text=f"{run.number}: {os.path.basename(run.file_name)} [{run.status}]")
+
+    def poll_runs(self):
+        self.repl_output.flush()
+        while not self.repl_reports.empty():
+            self.repl_view.write(self.repl_reports.get()[1])
+        changed = set()
+        for kind, run, data in self.runs.poll():
+            if run not in self.views:  # its tab was closed
+                continue
+            if kind == 'output':
+                self.views[run][2].write(data)
+            else:
+                changed.add(run)
+        for run in self.views:
+            if run in changed or run.status in ('queued', 'running'):
+                self.show_status(run)
+        self.root.after(self.POLL_MS, self.poll_runs)
+
+    def selected_run(self):
+        selected = self.tabs.select()
+        for run, (frame, _, _) in self.views.items():
+            if str(frame) == selected:
+                return run
+        return None
+
+    def stop_run(self):
+        # Stops the run in the selected tab; batch runs are in a pool of their own and are not stopped
+        if self.tabs.select() == str(self.repl_view):
+            self.repl.stop()  # the input running; later ones still run
+            return
+        run = self.selected_run()
+        if run is not None:
+            self.runs.stop(run)
+            self.show_status(run)
+
+    def close_tab(self):
+        run = self.selected_run()
+        if run is not None:
+            self.runs.stop(run)
+            self.views.pop(run)[0].destroy()  # also removes it from the notebook
+
+    def close(self):
+        self.repl.stop()
+        self.repl_runner.shutdown(wait=False, cancel_futures=True)
+        self.batches.shutdown(wait=False, cancel_futures=True)
+        self.runs.close()
+        self.root.destroy()
 
 if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        sys.exit(main_cli(sys.argv[1:]))
     root = tk.Tk()
     app = LauncherApp(root)
     root.mainloop()
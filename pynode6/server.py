@@ -0,0 +1,301 @@
+import argparse
+import asyncio
+import io
+import json
+import os
+import signal
+import struct
+import sys
+import time
+
+import main
+
+# Every message is a frame: 4-byte big-endian length + UTF-8 JSON.
+# Client -> server: {"source": "...", "timeout": 5}
+# Server -> worker: {"source": "...", "timeout": 5}
+# Server -> client: {"type": "output", "data": "..."} ... then {"type": "exit", "exit_code": 0, ...}
+HEADER = struct.Struct('>I')
+MAX_FRAME = 16 * 1024 * 1024
+OUTPUT_CHUNK = 4096
+DEFAULT_TIMEOUT = 10.0
+MAX_TIMEOUT = 300.0
+KILL_GRACE = 1.0  # after the timeout, for a run stuck where its budget is not checked
+WRITE_BUFFER_HIGH = 64 * 1024  # drain() blocks above this, which stops reads from the worker
+
+def encode_frame(message):
+    payload = json.dumps(message).encode()
+    return HEADER.pack(len(payload)) + payload
+
+def read_frame_sync(stream):
+    header = stream.read(HEADER.size)
+    if len(header) < HEADER.size:
+        return None
+    (size,) = HEADER.unpack(header)
+    return json.loads(stream.read(size))
+
+async def read_frame(reader):
+    try:
+        header = await reader.readexactly(HEADER.size)
+    except asyncio.IncompleteReadError:
+        return None
+    (size,) = HEADER.unpack(header)
+    if size > MAX_FRAME:
+        raise ValueError(f"Frame of {size} bytes exceeds {MAX_FRAME}")
+    return json.loads(await reader.readexactly(size))
+
+def request_timeout(request):
+    # Seconds the request may run, capped at MAX_TIMEOUT; ValueError unless a number >= 0
+    try:
+        timeout = float(request.get('timeout', DEFAULT_TIMEOUT))
+    except (TypeError, ValueError):
+        raise ValueError(f"timeout must be a number, not {request.get('timeout')!r}") from None
+    if not timeout >= 0:
+        raise ValueError(f"timeout must not be negative or NaN, not {timeout!r}")
+    return min(timeout, MAX_TIMEOUT)
+
+class FrameWriter(io.TextIOBase):
+    # Program stdout inside a worker; output is sent in chunks as it is produced
+    def __init__(self, stream):
+        self.stream = stream
+        self.parts = []
+        self.size = 0
+
+    def writable(self):
+        return True
+
+    def write(self, text):
+        self.parts.append(text)
+        self.size += len(text)
+        if self.size >= OUTPUT_CHUNK:
+            self.flush()
+        return len(text)
+
+    def flush(self):
+        if self.parts:
+            # Blocks when the pipe is full, i.e. when the client is reading slowly
+            self.stream.write(encode_frame({'type': 'output', 'data': ''.join(self.parts)}))
+            self.stream.flush()
+            self.parts = []
+            self.size = 0
+
+def worker_loop():
+    # Warm worker: `main` is imported once, then jobs are read from stdin until it closes.
+    # Jobs come through a copy of the pipe's descriptor, and fd 0 is pointed at
+    # /dev/null, so a program reading `stdin` gets no input rather than the next job
+    requests, frames = os.fdopen(os.dup(0), 'rb'), sys.stdout.buffer
+    null = os.open(os.devnull, os.O_RDONLY)
+    os.dup2(null, 0)
+    os.close(null)
+    output = FrameWriter(frames)
+    sys.stdout = output
+    while True:
+        job = read_frame_sync(requests)
+        if job is None:
+            break
+        start = time.perf_counter()
+        result = {'type': 'exit', 'exit_code': 0, 'error': None}
+        try:
+            # Stops itself at the timeout, so the worker is kept
+            main.run_code(job['source'], main.SPEED_MULTIPLIER, budget=main.Budget(seconds=job.get('timeout')))
+        except main.BudgetExceeded:
+            result.update(exit_code=124, error=f"Timed out after {job['timeout']:g}s.")
+        except Exception as error:
+            result.update(exit_code=1, error=f"{type(error).__name__}: {error}")
+        output.flush()
+        result['duration'] = round(time.perf_counter() - start, 6)
+        frames.write(encode_frame(result))
+        frames.flush()
+
+def kill_worker(worker):
+    # Kills a worker with its whole process group, which holds the pool of any
+    # parallel() it was running; those processes would otherwise outlive it
+    try:
+        if hasattr(os, 'killpg'):
+            os.killpg(worker.pid, signal.SIGKILL)
+        else:
+            worker.kill()
+    except ProcessLookupError:
+        pass  # already gone
+
+class WorkerPool:
+    def __init__(self, size):
+        self.size = size
+        self.idle = asyncio.Queue()
+        self.workers = set()
+
+    async def start(self):
+        for _ in range(self.size):
+            self.idle.put_nowait(await self.spawn())
+
+    async def spawn(self):
+        worker = await asyncio.create_subprocess_exec(
+            sys.executable, os.path.abspath(__file__), 'worker',
+            stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE, start_new_session=True)
+        self.workers.add(worker)
+        return worker
+
+    async def replace(self, worker):
+        # A timed-out or abandoned run may still be executing, so the worker is killed
+        self.workers.discard(worker)
+        kill_worker(worker)
+        await worker.wait()
+        self.idle.put_nowait(await self.spawn())
+
+    async def run(self, source, timeout, send):
+        # Waits for an idle worker, so requests queue once all workers are busy
+        worker = await self.idle.get()
+        deadline = time.monotonic() + timeout + KILL_GRACE
+        finished = False
+        try:
+            worker.stdin.write(encode_frame({'source': source, 'timeout': timeout}))
+            await worker.stdin.drain()
+            while True:
+                frame = await asyncio.wait_for(read_frame(worker.stdout), deadline - time.monotonic())
+                if frame is None:
+                    await send({'type': 'exit', 'exit_code': 1, 'error': "Worker exited unexpectedly."})
+                    return
+                await send(frame)
+                if frame['type'] == 'exit':
+                    finished = True
+                    return
+        except asyncio.TimeoutError:
+            await send({'type': 'exit', 'exit_code': 124, 'error': f"Timed out after {timeout:g}s."})
+        finally:
+            if finished:
+                self.idle.put_nowait(worker)
+            else:
+                await self.replace(worker)
+
+    async def close(self):
+        for worker in list(self.workers):
+            kill_worker(worker)
+            await worker.wait()
+
+async def start_server(host, port, workers):
+    pool = WorkerPool(workers)
+    await pool.start()
+
+    async def handle_client(reader, writer):
+        writer.transport.set_write_buffer_limits(high=WRITE_BUFFER_HIGH)
+
+        async def send(message):
+            writer.write(encode_frame(message))
+            await writer.drain()
+
+        try:
+            while True:
+                request = await read_frame(reader)
+                if request is None:
+                    break
+                try:
+                    if type(request) is not dict:
+                        raise ValueError(f"expected a JSON object, not {type(request).__name__}")
+                    timeout = request_timeout(request)
+                except ValueError as error:
+                    # Answered like a failed run, and the connection stays open
+                    await send({'type': 'exit', 'exit_code': 2, 'error': f"Bad request: {error}."})
+                    continue
+                await pool.run(request.get('source', ''), timeout, send)
+        except (ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle_client, host, port)
+    return server, pool
+
+async def submit(reader, writer, source, timeout=DEFAULT_TIMEOUT):
+    # Client side of one request on an open connection; returns (output, exit frame)
+    writer.write(encode_frame({'source': source, 'timeout': timeout}))
+    await writer.drain()
+    output = []
+    while True:
+        frame = await read_frame(reader)
+        if frame is None:
+            raise ConnectionError("Server closed the connection.")
+        if frame['type'] == 'output':
+            output.append(frame['data'])
+        else:
+            return ''.join(output), frame
+
+async def load_test(host, port, source, connections, requests, timeout):
+    latencies = []
+    failures = 0
+    remaining = iter(range(requests))
+
+    async def client():
+        nonlocal failures
+        reader, writer = await asyncio.open_connection(host, port)
+        try:
+            for _ in remaining:
+                start = time.perf_counter()
+                _, result = await submit(reader, writer, source, timeout)
+                latencies.append(time.perf_counter() - start)
+                failures += result['exit_code'] != 0
+        finally:
+            writer.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(connections)))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+
+    def percentile(p):
+        return round(latencies[min(len(latencies) - 1, int(len(latencies) * p / 100))] * 1000, 3)
+
+    return {'requests': len(latencies), 'failures': failures, 'connections': connections,
+            'elapsed_s': round(elapsed, 3), 'requests_per_s': round(len(latencies) / elapsed, 1),
+            'p50_ms': percentile(50), 'p90_ms': percentile(90), 'p99_ms': percentile(99)}
+
+async def serve(args):
+    server, pool = await start_server(args.host, args.port, args.workers)
+    print(f"Serving on {', '.join(str(sock.getsockname()) for sock in server.sockets)} with {args.workers} workers")
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        await pool.close()
+
+async def bench(args):
+    # Starts a local server unless --port points at a running one
+    server = pool = None
+    if not args.port:
+        server, pool = await start_server('127.0.0.1', 0, args.workers)
+        args.port = server.sockets[0].getsockname()[1]
+    if args.file:
+        with open(args.file) as file:
+            source = file.read()
+    else:
+        source = 'let x = 5;\nprint x;\nprint "done";\n'
+    try:
+        print(json.dumps(await load_test('127.0.0.1', args.port, source, args.connections,
+                                         args.requests, args.timeout)))
+    finally:
+        if server is not None:
+            server.close()
+            await server.wait_closed()
+            await pool.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pynode execution server")
+    sub = parser.add_subparsers(dest='command', required=True)
+    serve_parser = sub.add_parser('serve', help="run the server")
+    serve_parser.add_argument('--host', default='127.0.0.1')
+    serve_parser.add_argument('--port', type=int, default=8765)
+    serve_parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    bench_parser = sub.add_parser('bench', help="load generator")
+    bench_parser.add_argument('--port', type=int, default=0, help="existing server port (default: start one)")
+    bench_parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    bench_parser.add_argument('--connections', type=int, default=16)
+    bench_parser.add_argument('--requests', type=int, default=2_000)
+    bench_parser.add_argument('--timeout', type=float, default=DEFAULT_TIMEOUT)
+    bench_parser.add_argument('--file', help=".pn program to submit (default: a small built-in one)")
+    sub.add_parser('worker', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.command == 'worker':
+        worker_loop()
+    elif args.command == 'serve':
+        asyncio.run(serve(args))
+    else:
+        asyncio.run(bench(args))
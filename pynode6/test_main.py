@@ -0,0 +1,1187 @@
+import asyncio
+import contextlib
+import io
+import mmap
+import multiprocessing
+import os
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+import main
+import server
+
+def parse(source):
+    lexer = main.Lexer(source)
+    return main.Parser(lexer.tokens, lexer).parse()
+
+def run(source, budget=None, **settings):
+    # Output of a program run on this thread; settings override Compiler attributes
+    lexer = main.Lexer(source)
+    interpreter = main.Interpreter(main.Parser(lexer.tokens, lexer).parse(), budget=budget)
+    for name, value in settings.items():
+        setattr(interpreter.compiler, name, value)
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        interpreter.interpret()
+    return output.getvalue()
+
+class LexerTest(unittest.TestCase):
+    def tokens(self, source):
+        # The same source as str and as bytes, with and without interning
+        results = [list(main.Lexer(code, symbols=symbols).tokens)
+                   for code in (source, source.encode()) for symbols in (None, False)]
+        self.assertTrue(all(result == results[0] for result in results))
+        return results[0]
+
+    def test_comment_only_input_has_no_tokens(self):
+        self.assertEqual(self.tokens('// c'), [])
+        self.assertEqual(self.tokens('  \n// note\n// two\n'), [])
+        self.assertEqual(run('// only a comment\n'), '')
+
+    def test_trailing_comment(self):
+        source = '// head\nlet a = 1; // a\nprint a;\n// tail\n'
+        self.assertEqual(self.tokens(source), ['let', 'a', '=', '1', ';', 'print', 'a', ';'])
+        self.assertEqual(run(source), '1\n')
+        self.assertEqual(main.IncrementalParser().parse(source), parse(source))
+
+    def test_non_ascii_text(self):
+        self.assertEqual(self.tokens('let caf\u00e9 = 1;\nlet a\u00d7b = caf\u00e9 \u2014 2;\nprint\u00d7 "\u00e9";'),
+                         ['let', 'caf\u00e9', '=', '1', ';', 'let', 'a\u00d7b', '=', 'caf\u00e9', '2', ';',
+                          'print\u00d7', '"\u00e9"', ';'])
+        self.assertEqual(self.tokens('let\u00a0x = 1;\u3000print 1; // \u00e9\n'),
+                         ['let\u00a0x', '=', '1', ';', 'print', '1', ';'])
+        self.assertEqual(run('let a\u00d7b = 2;\nprint a\u00d7b * 3;\n'), '6\n')
+
+    def test_tokens_and_literals_are_shared(self):
+        source = 'let total = 1.5;\ntotal = total + "word";\nprint "word" + 1.5;\n'
+        for code in (source, source.encode()):
+            with self.subTest(code=type(code).__name__):
+                lexer = main.Lexer(code)
+                ast = main.Parser(lexer.tokens, lexer).parse()
+                self.assertEqual(ast, parse(source))
+                names = [ast[0]['name'], ast[1]['name'], ast[1]['value']['left']['name']]
+                self.assertTrue(all(name is names[0] for name in names))
+                self.assertIs(ast[1]['value']['right']['value'], ast[2]['value']['left']['value'])
+                self.assertIs(ast[0]['value']['value'], ast[2]['value']['right']['value'])
+                symbols = main.SymbolTable()
+                first = main.Lexer(code, symbols=symbols)
+                second = main.Lexer(code, symbols=symbols)
+                self.assertTrue(all(a is b for a, b in zip(first.tokens, second.tokens)))
+                lexer = main.Lexer(code, symbols=False)
+                self.assertEqual(main.Parser(lexer.tokens, lexer).parse(), ast)
+
+BLOCK_PROGRAMS = [
+    'let x = 1;\nif x > 5 {\n    print "big";\n}\nelse {\n    print "small";\n}\nprint "end";\n',
+    'let x = 9;\nif x > 5 {\n    print "big";\n}\n// between\n\nelse if x > 2 {\n    print "mid";\n} else {\n'
+    '    print "small";\n}\n',
+    'let n = 2;\ndo {\n    print n;\n    n = n - 1;\n}\nwhile n > 0;\nprint "end";\n',
+    'let n = 2;\ndo {\n    n = n - 1;\n}\nwhile n > 0\nprint n;\n',
+    'let n = 2;\nif n > 1 {\n    print n;\n}\nwhile n > 0 {\n    n = n - 1;\n}\nprint n;\n',
+]
+
+SEMICOLON_FREE_PROGRAMS = [
+    'let x = 5\nprint x\n\nif x > 3 {\n    print "x is greater than 3"\n}\n\nfor item in [1, 2, 3] {\n'
+    '    print item\n}\n',
+    'let n = 2\ndo {\n    n = n - 1\n}\nwhile n > 0\nprint n\n',
+    'let y = 1\nif y > 5 {\n    print "big"\n} else\nif y > 0 {\n    print "small"\n}\nprint "end" // done\n',
+    'let total = 0\n// a comment before\ntotal = total +\n    2\nprint total\nwhile total > 0 {\n'
+    '    total = total - 1\n}\n',
+]
+
+def outcome(parse, source):
+    # The AST, or PNError for a program that does not parse
+    try:
+        return parse(source)
+    except main.PNError:
+        return main.PNError
+
+class IncrementalParserTest(unittest.TestCase):
+    def test_blocks_followed_by_else_or_while(self):
+        for source in BLOCK_PROGRAMS:
+            with self.subTest(source=source):
+                self.assertEqual(main.IncrementalParser().parse(source), parse(source))
+
+    def test_edits_match_a_full_parse(self):
+        for source in BLOCK_PROGRAMS:
+            incremental = main.IncrementalParser()
+            incremental.parse(source)
+            lines = source.splitlines(keepends=True)
+            for index in range(len(lines)):
+                edited = ''.join(lines[:index] + ['let edit = 1;\n'] + lines[index:])
+                with self.subTest(source=source, index=index):
+                    self.assertEqual(outcome(incremental.parse, edited), outcome(parse, edited))
+                    self.assertEqual(incremental.parse(source), parse(source))
+
+    def test_replacements_and_deletions_match_a_full_parse(self):
+        source = ''.join(BLOCK_PROGRAMS) + ''.join(f'let v{index} = {index};\n' for index in range(40))
+        lines = source.splitlines(keepends=True)
+        incremental = main.IncrementalParser()
+        incremental.parse(source)
+        for index in range(len(lines)):
+            for edited in (lines[:index] + ['print 0;\n'] + lines[index + 1:], lines[:index] + lines[index + 1:]):
+                edited = ''.join(edited)
+                with self.subTest(index=index, edited=edited):
+                    self.assertEqual(outcome(incremental.parse, edited), outcome(parse, edited))
+                    self.assertEqual(incremental.parse(source), parse(source))
+        middle = lines.index('let v20 = 20;\n')
+        incremental.parse(''.join(lines[:middle] + ['let v20 = 21;\n'] + lines[middle + 1:]))
+        self.assertLessEqual(incremental.reparsed, 2)
+
+    def test_code_without_semicolons_is_split_and_reparsed_in_part(self):
+        source = ''.join(SEMICOLON_FREE_PROGRAMS) + ''.join(f'let v{index} = {index}\n' for index in range(40))
+        lines = source.splitlines(keepends=True)
+        incremental = main.IncrementalParser()
+        self.assertEqual(incremental.parse(source), parse(source))
+        self.assertGreater(len(incremental.spans), 40)
+        for index in range(len(lines)):
+            for edited in (lines[:index] + ['print 0\n'] + lines[index:],
+                           lines[:index] + ['x = 1 +\n'] + lines[index + 1:], lines[:index] + lines[index + 1:]):
+                edited = ''.join(edited)
+                with self.subTest(index=index, edited=edited):
+                    self.assertEqual(outcome(incremental.parse, edited), outcome(parse, edited))
+                    self.assertEqual(incremental.parse(source), parse(source))
+        middle = lines.index('let v20 = 20\n')
+        incremental.parse(''.join(lines[:middle] + ['let v20 = 21\n'] + lines[middle + 1:]))
+        self.assertLessEqual(incremental.reparsed, 2)
+
+    def test_else_body_runs_only_when_taken(self):
+        ast = main.IncrementalParser().parse(BLOCK_PROGRAMS[0])
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            main.Interpreter(ast).interpret()
+        self.assertEqual(output.getvalue(), 'small\nend\n')
+
+    def test_mmap_is_split_in_windows(self):
+        data = b'let a = 1;\r\nlet bb = 2;\n\nprint a + bb;\rprint "x"'
+        with tempfile.TemporaryFile() as file:
+            file.write(data)
+            file.flush()
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as code:
+                window = main.COUNT_WINDOW
+                try:
+                    for main.COUNT_WINDOW in range(1, len(data) + 2):
+                        with self.subTest(window=main.COUNT_WINDOW):
+                            self.assertEqual(main.split_lines(code), data.splitlines(keepends=True))
+                finally:
+                    main.COUNT_WINDOW = window
+                self.assertEqual(main.IncrementalParser().parse(code), main.IncrementalParser().parse(data))
+
+class ParallelParseTest(unittest.TestCase):
+    def test_chunks_end_at_statement_boundaries(self):
+        for source in BLOCK_PROGRAMS + SEMICOLON_FREE_PROGRAMS:
+            for code in (source, source.encode()):
+                with self.subTest(code=code):
+                    boundaries = main.find_statement_boundaries(code, len(code))
+                    ast, first_line = [], 1
+                    for start, end in zip(boundaries, boundaries[1:]):
+                        lexer = main.Lexer(code, start, end, first_line)
+                        ast += main.Parser(lexer.tokens, lexer).parse()
+                        first_line += main.count_newlines(code, start, end)
+                    self.assertEqual(ast, parse(source))
+
+    def test_parse_parallel_matches_a_full_parse(self):
+        with tempfile.TemporaryDirectory() as directory:
+            for source in BLOCK_PROGRAMS:
+                path = os.path.join(directory, 'program.pn')
+                with open(path, 'w') as file:
+                    file.write(source * 20)
+                with self.subTest(source=source):
+                    self.assertEqual(main.parse_parallel(path, 1), parse(source * 20))
+
+    def test_code_without_semicolons_is_chunked(self):
+        source = ''.join(SEMICOLON_FREE_PROGRAMS) * 20
+        self.assertEqual(len(main.find_statement_boundaries(source, 8)), 9)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'program.pn')
+            with open(path, 'w') as file:
+                file.write(source)
+            self.assertEqual(main.parse_parallel(path, 2), parse(source))
+            with open(path, 'w') as file:
+                file.write('if true {\n' + source + '}\n')  # one chunk: parsed without a pool
+            executor = main.ProcessPoolExecutor
+            main.ProcessPoolExecutor = None
+            try:
+                self.assertEqual(main.parse_parallel(path, 2), parse('if true {\n' + source + '}\n'))
+            finally:
+                main.ProcessPoolExecutor = executor
+
+class BudgetTest(unittest.TestCase):
+    def assertStops(self, source):
+        start = time.monotonic()
+        with self.assertRaises(main.BudgetExceeded):
+            run(source, main.Budget(seconds=0.2))
+        self.assertLess(time.monotonic() - start, 2)
+
+    def test_stage_less_range_view_times_out(self):
+        self.assertStops('print max(range(3000000000));')
+        self.assertStops('print join(range(300000000), ",").length;')
+        self.assertStops('let s = sort(range(300000000));')
+        self.assertStops('print range(300000000);')
+
+    def test_parallel_workers_are_stopped_with_the_run(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'spin.pn')
+            with open(path, 'w') as file:
+                file.write('let n = 0;\nwhile true {\n    n = n + 1;\n}\n')
+            self.assertStops(f'parallel("{path}", 2);')
+            with self.assertRaisesRegex(main.BudgetExceeded, 'worker 0: line 3: Step limit of 5000 exceeded'):
+                run(f'parallel("{path}", 2);', main.Budget(max_steps=5000))
+            budget = main.Budget()  # no limits for the workers: cancelling has to kill them
+            timer = threading.Timer(0.2, budget.cancel)
+            timer.start()
+            start = time.monotonic()
+            with self.assertRaises(main.RunCancelled):
+                run(f'parallel("{path}", 2);', budget)
+            self.assertLess(time.monotonic() - start, 2)
+            self.assertEqual(multiprocessing.active_children(), [])
+
+    def test_tasks_charge_the_run_budget_without_losing_steps(self):
+        parent = main.Budget()
+        interval, safepoints = sys.getswitchinterval(), main.SAFEPOINT_INTERVAL
+        sys.setswitchinterval(1e-6)  # switch threads often, inside the parent's check too
+        main.SAFEPOINT_INTERVAL = 2
+
+        def charge():
+            budget = main.Budget(parent=parent)
+            for _ in range(20000):
+                budget.left -= 1
+                budget.check()
+        threads = [threading.Thread(target=charge) for _ in range(8)]
+        try:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            sys.setswitchinterval(interval)
+            main.SAFEPOINT_INTERVAL = safepoints
+        self.assertEqual(parent.steps + parent.granted - parent.left, 8 * 20000)
+
+    def test_stage_less_range_view_still_works(self):
+        self.assertEqual(run('print max(range(10));\nprint join(range(4), "-");\n'), '9\n0-1-2-3\n')
+
+ARITHMETIC_PROGRAM = """let a = 7;
+let b = -3;
+print a + b * 2 - 1;
+print a / 2;
+print 6 / 3;
+print a % b;
+print -a % 3;
+print a - 10 / 4;
+print 1 + 2 * 3;
+print a >= 7;
+print a < b;
+print a == 7.0;
+print "n" + a;
+print a + 1.5;
+let i = 0;
+let acc = 0;
+while i < 50 {
+    acc = acc + i * 3 % 7 - i % 5;
+    i = i + 1;
+}
+print acc;
+"""
+
+class ArithmeticTest(unittest.TestCase):
+    def test_number_literals_are_converted_once(self):
+        ast = parse('let x = 5;\nlet y = 2.5;\nlet z = "5";\n')
+        self.assertEqual([node['value'] for node in ast],
+                         [{'type': 'number', 'value': 5}, {'type': 'number', 'value': 2.5},
+                          {'type': 'string', 'value': '5'}])
+        self.assertIs(type(ast[0]['value']['value']), int)
+
+    def test_declared_names_must_be_variable_names(self):
+        for source, keyword in [('let 5 = 3;\nprint 5;\n', 'let'), ('let in = 1;\n', 'let'),
+                                ('const true = 2;\n', 'const'), ('var print = 1;\n', 'var'),
+                                ('for 3 in [1] {\n}\n', 'for'), ('let;\n', 'let'), ('delete null;\n', 'delete')]:
+            with self.subTest(source=source):
+                with self.assertRaisesRegex(main.PNError, f"line 1: Expected a variable name after '{keyword}'"):
+                    parse(source)
+        self.assertEqual(run('let _a = 1;\nconst b2 = _a + 1;\nprint b2;\n'), '2\n')
+
+    def test_int_fast_paths_match_generic_dispatch(self):
+        expected = '0\n3.5\n2\n-2\n2\n4.5\n7\ntrue\nfalse\ntrue\nn7\n8.5\n47\n'
+        for fast_paths in (False, True):
+            # Without type specialization every operation goes through its guarded fast path
+            with self.subTest(fast_paths=fast_paths):
+                self.assertEqual(run(ARITHMETIC_PROGRAM, fast_paths=fast_paths, type_specialization=False),
+                                 expected)
+                with self.assertRaisesRegex(main.PNError, 'line 2: Unsupported operand types for \\+: boolean and int'):
+                    run('let t = true;\nprint t + 1;\n', fast_paths=fast_paths, type_specialization=False)
+                with self.assertRaisesRegex(main.PNError, 'line 2: Division by zero'):
+                    run('let z = 0;\nprint 5 % z;\n', fast_paths=fast_paths, type_specialization=False)
+
+STRING_PROGRAM = """let s = "";
+for i in range(0, 5) {
+    s = s + i + ",";
+}
+let old = s;
+s = s + "end";
+print old;
+print s;
+old = old + "x";
+print old;
+print s;
+let n = 0;
+for i in range(0, 4) {
+    n = n + i;
+}
+print n;
+let x = 3;
+print `{x} is ${x + 1} and ${s.length}`;
+print "a" + x * 2 + "{}";
+"""
+
+class StringBuilderTest(unittest.TestCase):
+    def test_builders_and_templates_match_plain_concatenation(self):
+        expected = '0,1,2,3,4,\n0,1,2,3,4,end\n0,1,2,3,4,x\n0,1,2,3,4,end\n6\n{x} is 4 and 13\na6{}\n'
+        for string_builders in (False, True):
+            with self.subTest(string_builders=string_builders):
+                self.assertEqual(run(STRING_PROGRAM, string_builders=string_builders), expected)
+
+    def test_an_alias_never_sees_later_appends(self):
+        first = main.StringBuilder(['a'])
+        second = first.append('b')
+        third = second.append('c')
+        other = second.append('d')  # appends from an old alias copy the parts it covers
+        self.assertEqual([str(first), str(second), str(third), str(other)], ['a', 'ab', 'abc', 'abd'])
+        self.assertIs(third.parts, first.parts)
+
+NESTED_PROGRAM = """let total = 0;
+for i in [1, 2, 3, 4] {
+    if i % 2 == 0 {
+        for j in [10, 20] {
+            total = total + i * j;
+        }
+    } else if i == 3 {
+        print "three";
+    } else {
+        let doubled = i * 2;
+        print doubled;
+    }
+}
+print total;
+"""
+
+class NestedBlockTest(unittest.TestCase):
+    def test_bodies_are_parsed_into_statements(self):
+        ast = parse('for i in [1] {\n    if i > 0 { print i; } else { print 0; }\n}\n')
+        body = ast[0]['body']
+        self.assertEqual([node['type'] for node in body], ['if'])
+        self.assertEqual(body[0]['body'], [{'type': 'print', 'value': {'type': 'name', 'name': 'i'}, 'line': 2}])
+        self.assertEqual(body[0]['else_body'], [{'type': 'print', 'value': {'type': 'number', 'value': 0}, 'line': 2}])
+
+    def test_nested_bodies_run_without_reparsing(self):
+        lexer = main.Lexer(NESTED_PROGRAM)
+        interpreter = main.Interpreter(main.Parser(lexer.tokens, lexer).parse())
+        parser, main.Parser = main.Parser, None
+        try:
+            output = io.StringIO()
+            with contextlib.redirect_stdout(output):
+                interpreter.interpret()
+        finally:
+            main.Parser = parser
+        self.assertEqual(output.getvalue(), '2\nthree\n180\n')
+        with self.assertRaisesRegex(main.PNError, "line 4: 'nope' is not defined"):
+            run('for i in [1] {\n    if i > 0 {\n        print i;\n        print nope;\n    }\n}\n')
+
+SWITCH_PROGRAM = """let two = 2;
+for v in [1, 1.0, true, 2, "a", 3, 4, [1]] {
+    switch v {
+        case true:
+            print "true";
+            break;
+        case two:
+            print "dynamic two";
+        case 1:
+            print "one";
+            break;
+        case "a":
+            print "letter";
+        default:
+            print "default";
+            break;
+        case 3:
+            print "three";
+    }
+}
+"""
+
+class SwitchTest(unittest.TestCase):
+    def test_jump_table_matches_comparing_in_order(self):
+        expected = 'one\none\ntrue\ndynamic two\none\nletter\ndefault\nthree\ndefault\ndefault\n'
+        for jump_tables in (False, True):
+            with self.subTest(jump_tables=jump_tables):
+                self.assertEqual(run(SWITCH_PROGRAM, jump_tables=jump_tables), expected)
+
+LOOP_PROGRAM = """let i = 0;
+while i < 5 {
+    i = i + 1;
+}
+print i;
+let j = 10;
+while j >= 4 {
+    print j;
+    j = j - 3;
+}
+print j;
+let k = 7;
+while k < 3 {
+    k = k + 1;
+}
+print k;
+let n = 3;
+let m = 0;
+while m <= n {
+    if m == 2 {
+        break;
+    }
+    m = m + 1;
+}
+print m;
+let f = 0.5;
+while f < 3 {
+    f = f + 1;
+}
+print f;
+let limit = 4;
+let c = 0;
+while c < limit {
+    limit = limit - 1;
+    c = c + 1;
+}
+print `${c} ${limit}`;
+let v = 0;
+let seen = [];
+while v < 10 {
+    v = v + 2;
+    seen = seen + [v];
+    v = v + 1;
+}
+print seen;
+print v;
+let base = 3;
+for round in [1, 2] {
+    let w = 0;
+    let acc = 0;
+    while w < 4 {
+        acc = acc + base * 2 + w;
+        w = w + 1;
+    }
+    print acc;
+    base = base + 10;
+}
+let d = 0;
+do {
+    d = d + base;
+} while d < 40;
+print d;
+for x in [1, 2, 3] {
+    let y = 0;
+    while y < x {
+        print `${x}:${y}:${x * 10 + base}`;
+        y = y + 1;
+    }
+}
+let h = 1;
+let sum = 0;
+while h <= 3000 {
+    sum = sum + h;
+    h = h + 3;
+}
+print `${h} ${sum}`;
+"""
+
+class LoopTest(unittest.TestCase):
+    def test_counted_and_hoisted_loops_match_plain_evaluation(self):
+        expected = ('5\n10\n7\n4\n1\n7\n2\n3.5\n2 2\n[2, 5, 8, 11]\n12\n30\n110\n46\n1:0:33\n2:0:43\n2:1:43\n'
+                    '3:0:53\n3:1:53\n3:2:53\n3001 1499500\n')
+        for loop_optimizations in (False, True):
+            for tracing in (False, True):
+                with self.subTest(loop_optimizations=loop_optimizations, tracing=tracing):
+                    self.assertEqual(run(LOOP_PROGRAM, loop_optimizations=loop_optimizations, tracing=tracing),
+                                     expected)
+
+    def test_stream_reads_are_not_hoisted(self):
+        source = ('let i = 0;\nlet input = stdin;\nwhile i < 3 {\n    print stdin.length + 0;\n'
+                  '    print input.length + 1;\n    i = i + 1;\n}\n')
+        stdin = sys.stdin
+        try:
+            for loop_optimizations in (False, True):
+                with self.subTest(loop_optimizations=loop_optimizations):
+                    sys.stdin = io.TextIOWrapper(io.BytesIO(b'a\nb\nc\nd\ne\nf'))
+                    main.STDIN_READER[0] = None
+                    self.assertEqual(run(source, loop_optimizations=loop_optimizations), '6\n1\n0\n1\n0\n1\n')
+        finally:
+            sys.stdin = stdin
+            main.STDIN_READER[0] = None
+
+TYPED_PROGRAM = """let a = 7;
+let b = 2;
+let f = 1.5;
+let s = "n=";
+print a + b * 3 - 1;
+print a / b;
+print a % b;
+print a * f;
+print s + a;
+print a > b;
+let x = 1;
+if a > 5 {
+    x = "text";
+}
+print x + 1;
+let i = 0;
+let total = 0;
+while i < 10 {
+    total = total + i * f;
+    i = i + 1;
+}
+print total;
+print 10 / 4;
+"""
+
+class TypeSpecializationTest(unittest.TestCase):
+    def test_specialized_operations_match_generic_ones(self):
+        expected = '12\n3.5\n1\n10.5\nn=7\ntrue\ntext1\n67.5\n2.5\n'
+        for specialization in (False, True):
+            with self.subTest(type_specialization=specialization):
+                self.assertEqual(run(TYPED_PROGRAM, type_specialization=specialization), expected)
+                with self.assertRaisesRegex(main.PNError, 'line 2: Division by zero'):
+                    run('let a = 1;\nprint a / 0;\n', type_specialization=specialization)
+
+    def test_a_name_assigned_on_one_branch_has_no_type_after_it(self):
+        ast = parse('let a = 1;\nlet b = a * 2.5;\nlet c = a + 1;\nif b > 1 { a = "s"; }\nlet d = a + 1;\n')
+        types = main.infer_types(ast)
+        values = [node['value'] for node in ast if node['type'] == 'variable_assignment']
+        self.assertEqual([types.get(id(value)) for value in values], ['int', 'float', 'int', None])
+
+SCOPED_PROGRAM = """let x = "outer";
+let go = true;
+if go {
+    let x = "inner";
+    let big = [1, 2, 3];
+    print x + big.length;
+    var kept = 1;
+}
+print x;
+print kept;
+for i in [1, 2] {
+    let row = [i, i];
+    print row;
+}
+let i = 0;
+while i < 3 {
+    let temp = join(range(i), "-");
+    i = i + 1;
+    print temp;
+}
+"""
+
+class LifetimeTest(unittest.TestCase):
+    def test_block_bindings_end_with_the_block(self):
+        for tracing in (False, True):
+            with self.subTest(tracing=tracing):
+                self.assertEqual(run(SCOPED_PROGRAM, tracing=tracing), 'inner3\nouter\n1\n[1, 1]\n[2, 2]\n\n0\n0-1\n')
+        self.assertEqual(run(SCOPED_PROGRAM, lifetimes=False), 'inner3\ninner\n1\n[1, 1]\n[2, 2]\n\n0\n0-1\n')
+        with self.assertRaisesRegex(main.PNError, "line 5: 'big' is not defined"):
+            run('let go = true;\nif go {\n    let big = [1];\n}\nprint big;\n')
+        with self.assertRaisesRegex(main.PNError, "line 4: 'row' is not defined"):
+            run('for i in [1] {\n    let row = [i];\n}\nprint row;\n')
+
+    def test_delete_removes_the_binding(self):
+        for lifetimes in (False, True):
+            with self.subTest(lifetimes=lifetimes):
+                with self.assertRaisesRegex(main.PNError, "line 3: 'gone' is not defined"):
+                    run('let gone = 5;\ndelete gone;\nprint gone;\n', lifetimes=lifetimes)
+                self.assertEqual(run('let a = [1];\ndelete a;\nlet a = 2;\nprint a;\n', lifetimes=lifetimes), '2\n')
+
+    def test_a_brace_that_opens_no_block_is_an_error(self):
+        # Skipping it would close the enclosing block early, moving statements out of it
+        for source, message in [('let i = 0;\nwhile i < 3 {\n    { let z = i; print z + 1; }\n    i = i + 1;\n}\n',
+                                 "line 3: Unexpected '{'"),
+                                ('print 1;\n}\n', "line 2: Unexpected '}'"),
+                                ('else { print 1; }\n', "line 1: Unexpected 'else'")]:
+            with self.subTest(source=source):
+                with self.assertRaisesRegex(main.PNError, message):
+                    parse(source)
+                with self.assertRaisesRegex(main.PNError, message):
+                    main.IncrementalParser().parse(source)
+        self.assertEqual(run('print 1;;\n;\n'), '1\n')
+
+    def test_dead_block_values_are_released_after_their_last_use(self):
+        ast = parse('let go = true;\nif go {\n    let big = [1, 2];\n    print big;\n    let n = 1;\n    print n;\n'
+                    '    print go;\n    let late = "s";\n    print late.length;\n}\nif go {\n    let x = [1];\n}\n'
+                    'print x;\n')
+        # n is an int, x is read after its block
+        self.assertEqual(list(main.block_scopes(ast, main.infer_types(ast)).values()),
+                         [(['big', 'n', 'late'], {1: ['big'], 6: ['late']}), (['x'], {})])
+
+HOT_LOOP = 'let i = 0;\nlet total = 0;\nwhile i < 5000 {\n    total = total + i;\n    i = i + 1;\n}\nprint total;\n'
+
+TRACED_PROGRAM = """for rep in [0, 1] {
+    let total = 0;
+    let text = "";
+    let evens = 0;
+    for i in range(0, 3000) {
+        if i % 7 == 0 {
+            continue;
+        }
+        let half = i / 2;
+        if i % 2 == 0 {
+            evens = evens + 1;
+        } else {
+            total = total + half;
+        }
+        if i > 2980 {
+            text = text + i % 10;
+        }
+        if i == 2990 {
+            break;
+        }
+    }
+    print total;
+    print evens;
+    print text;
+}
+let cells = shared(4);
+for rep in [0, 1] {
+    let n = 0;
+    while n < 2000 {
+        cells[n % 4] = cells[n % 4] + n;
+        n = n + 1;
+    }
+}
+print cells;
+for start in [1, 2.5, 3] {
+    let acc = start;
+    let m = 0;
+    while m < 1200 {
+        acc = acc + 1;
+        m = m + 1;
+    }
+    print acc;
+}
+"""
+
+class TracingTest(unittest.TestCase):
+    def test_tracing_can_be_turned_off(self):
+        for tracing in (False, True):
+            with self.subTest(tracing=tracing):
+                interpreter = main.Interpreter(parse(HOT_LOOP), tracing=tracing)
+                output = io.StringIO()
+                with contextlib.redirect_stdout(output):
+                    interpreter.interpret()
+                self.assertEqual(output.getvalue(), '12497500\n')
+                self.assertEqual(sum(len(tracer.traces) for tracer in interpreter.compiler.tracers), tracing)
+
+    def test_traces_match_the_interpreter(self):
+        expected = ('957226.5\n1282\n13456780\n' * 2 + '[998000, 999000, 1000000, 1001000]\n'
+                    '1201\n1202.5\n1203\n')
+        for tracing in (False, True):
+            with self.subTest(tracing=tracing):
+                interpreter = main.Interpreter(parse(TRACED_PROGRAM), tracing=tracing)
+                output = io.StringIO()
+                with contextlib.redirect_stdout(output):
+                    interpreter.interpret()
+                self.assertEqual(output.getvalue(), expected)
+                traced = {tracer.node['line']: len(tracer.traces) for tracer in interpreter.compiler.tracers}
+                if tracing:
+                    # The break/continue loop, the shared array loop and the last one for
+                    # two entry types; each loop's first entry is interpreted
+                    self.assertTrue(traced[5] and traced[29])
+                    self.assertEqual(traced[38], 2)
+                else:
+                    self.assertEqual(traced, {})
+
+    def test_calls_stop_tracing_only_inside_the_loop(self):
+        source = ('for rep in [0, 1] {\n    let total = 0;\n    for i in range(0, 2000) {\n        total = total + i;\n'
+                  '    }\n    print total;\n}\nlet i = 0;\nwhile i < 2000 {\n    i = i + max(1, 0);\n}\n')
+        interpreter = main.Interpreter(parse(source))
+        with contextlib.redirect_stdout(io.StringIO()):
+            interpreter.interpret()
+        self.assertEqual([tracer.node['line'] for tracer in interpreter.compiler.tracers if tracer.traces], [3])
+        self.assertNotIn(9, [tracer.node['line'] for tracer in interpreter.compiler.tracers])
+
+    def test_batch_runs_without_tracing(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'hot.pn')
+            with open(path, 'w') as file:
+                file.write(HOT_LOOP)
+            for tracing in (False, True):
+                with self.subTest(tracing=tracing):
+                    (result,) = main.run_batch([path], 1, tracing=tracing)
+                    self.assertEqual((result['exit_code'], result['output']), (0, '12497500\n'))
+
+VIEW_PROGRAM = """let a = [5, 1, 4, 2, 3, 6];
+let chain = a.map(x => x * 10).filter(x => x > 15).slice(1, -1);
+print chain;
+print chain.length;
+print chain;
+let spliced = a.splice(1, 2, 7, 8, 9).map(x => x + 1);
+print spliced;
+print a;
+let evens = range(0, 20).filter(x => x % 2 == 0);
+print sum(evens.map(x => x * x));
+print evens.slice(-3);
+print evens[2];
+let offset = 3;
+let shifted = a.map(x => x + offset);
+offset = 100;
+print shifted;
+print join(a.slice(2).map(x => x * 2), "-");
+print sort(a.filter(x => x != 4));
+"""
+
+class LazyArrayTest(unittest.TestCase):
+    def test_fused_chains_match_eager_arrays(self):
+        expected = ('[40, 20, 30]\n3\n[40, 20, 30]\n[6, 8, 9, 10, 3, 4, 7]\n[5, 1, 4, 2, 3, 6]\n1140\n'
+                    '[14, 16, 18]\n4\n[8, 4, 7, 5, 6, 9]\n8-4-6-12\n[1, 2, 3, 5, 6]\n')
+        for lazy in (False, True):
+            with self.subTest(lazy=lazy):
+                self.assertEqual(run(VIEW_PROGRAM, lazy_arrays=lazy), expected)
+
+    def test_view_of_a_shared_array_ignores_later_writes(self):
+        source = ('let s = shared([1, 2, 3]);\nlet d = s.map(x => x * 2);\nlet t = s.slice(0, 2);\n'
+                  's[0] = 100;\nprint d;\nprint t;\nprint s.filter(x => x > 2);\n')
+        for lazy in (False, True):
+            with self.subTest(lazy=lazy):
+                self.assertEqual(run(source, lazy_arrays=lazy), '[2, 4, 6]\n[1, 2]\n[100, 3]\n')
+
+class SharedArrayTest(unittest.TestCase):
+    def test_reads_in_a_loop_see_a_workers_writes(self):
+        source = ('let cells = shared([0]);\nfor i in range(0, 3) {\n    CALL;\n    print cells[0];\n'
+                  '    print cells[0] + 0;\n    print `v=${cells[0]}`;\n}\n')
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'worker.pn')
+            with open(path, 'w') as file:
+                file.write('let target = args[0];\ntarget[0] = target[0] + 1;\nlet result = 0;\n')
+            for call in (f'parallel("{path}", 1, cells)', f'tasks("{path}", 1, cells)'):
+                with self.subTest(call=call):
+                    self.assertEqual(run(source.replace('CALL', call)), '1\n1\nv=1\n2\n2\nv=2\n3\n3\nv=3\n')
+
+class StreamTest(unittest.TestCase):
+    def test_records_are_the_same_at_any_chunk_size(self):
+        with tempfile.TemporaryDirectory() as directory:
+            with open(os.path.join(directory, 'text.txt'), 'wb') as file:
+                file.write('h\u00e9llo\r\nw\u00f6rld\n\nlast'.encode())
+            with open(os.path.join(directory, 'rows.csv'), 'w', newline='') as file:
+                file.write('a,1\r\nb,2\n"multi\nline",3\nb,4\n')
+            source = ('for line in lines("DIR/text.txt") {\n    print `[${line}]`;\n}\n'
+                      'print lines("DIR/text.txt").length;\nlet rows = csv("DIR/rows.csv");\n'
+                      'print sum(rows.map(r => number(r[1])));\nprint rows.filter(r => r[0] == "b").length;\n'
+                      'for r in rows {\n    print r[0].length;\n}\n').replace('DIR', directory)
+            chunk = main.STREAM_CHUNK
+            try:
+                for main.STREAM_CHUNK in (1, 2, 3, chunk):
+                    with self.subTest(chunk=main.STREAM_CHUNK):
+                        self.assertEqual(run(source), '[h\u00e9llo]\n[w\u00f6rld]\n[]\n[last]\n4\n10\n2\n1\n1\n10\n1\n')
+            finally:
+                main.STREAM_CHUNK = chunk
+
+    def test_a_second_pass_over_stdin_resumes_it(self):
+        source = ('for line in stdin {\n    print line;\n    if line == "b" {\n        break;\n    }\n}\n'
+                  'for line in stdin {\n    print "rest " + line;\n}\n')
+        stdin = sys.stdin
+        sys.stdin = io.TextIOWrapper(io.BytesIO(b'a\nb\nc\nd'))
+        main.STDIN_READER[0] = None
+        try:
+            self.assertEqual(run(source), 'a\nb\nrest c\nrest d\n')
+        finally:
+            sys.stdin = stdin
+            main.STDIN_READER[0] = None
+
+class ExpressionStatementTest(unittest.TestCase):
+    def test_call_statement_runs(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'task.pn')
+            with open(path, 'w') as file:
+                file.write('print `task ${task}`;\n')
+            self.assertEqual(run(f'tasks("{path}", 2);\nprint "after";\n'), 'task 0\ntask 1\nafter\n')
+
+    def test_call_statement_in_loop(self):
+        self.assertEqual(run('let a = [3, 1, 2];\nfor i in a { sort(a); print i; }\n'), '3\n1\n2\n')
+
+    def test_call_in_loop_expression_is_not_hoisted(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'task.pn')
+            with open(path, 'w') as file:
+                file.write('print "ran";\n')
+            source = f'for i in range(0, 2) {{ print tasks("{path}", 1).length + 1; }}\n'
+            self.assertEqual(run(source), 'ran\n2\nran\n2\n')
+
+    def test_assignment_target_must_be_name_or_item(self):
+        with self.assertRaises(main.PNError):
+            run('let a = 1;\na + 1 = 2;\n')
+
+    def test_repl_echoes_expression(self):
+        session = main.ReplSession()
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            session.run('let a = [3, 1, 2];')
+            session.run('max(a)')
+        self.assertEqual(output.getvalue(), '3\n')
+
+class CallTest(unittest.TestCase):
+    def test_argument_count_is_checked_before_the_call(self):
+        for source, count in [('let b = 10;\nlet f = x => x + b;\nprint f(1, 2);\n', 2),
+                              ('let f = x => x;\nprint f();\n', 0), ('print join();\n', 0),
+                              ('print sort([1], 2, 3);\n', 3)]:
+            with self.subTest(source=source):
+                with self.assertRaisesRegex(main.PNError, rf'Wrong number of arguments \({count}\) in call'):
+                    run(source)
+        self.assertEqual(run('let b = 10;\nlet f = x => x + b;\nprint f(1) + max(3, 1, 2);\nprint join([1, 2]);\n'),
+                         '14\n1,2\n')
+
+    def test_a_type_error_inside_the_function_is_not_a_wrong_call(self):
+        with self.assertRaisesRegex(TypeError, 'has no len'):
+            main.call_value(lambda items: len(items), [5])
+
+class TaskScopeTest(unittest.TestCase):
+    def tasks(self, task_source, source):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'task.pn')
+            with open(path, 'w') as file:
+                file.write(task_source)
+            return run(source.replace('TASK', path))
+
+    def test_task_writes_stay_in_the_task(self):
+        task = 'x = task;\nlet y = 2;\nlet result = x;\n'
+        output = self.tasks(task, 'let x = 7;\nprint tasks("TASK", 2);\nprint x;\n')
+        self.assertEqual(output, '[0, 1]\n7\n')
+        with self.assertRaisesRegex(main.PNError, "'y' is not defined"):
+            self.tasks(task, 'tasks("TASK", 2);\nprint y;\n')
+
+    def test_delete_in_task_hides_the_callers_binding(self):
+        with self.assertRaisesRegex(main.PNError, "task 0: line 2: 'x' is not defined"):
+            self.tasks('delete x;\nlet result = x;\n', 'let x = 7;\ntasks("TASK", 1);\n')
+        task = 'delete x;\nlet x = task;\ndelete x;\nlet result = 1;\n'
+        self.assertEqual(self.tasks(task, 'let x = 7;\nprint tasks("TASK", 2);\nprint x;\n'), '[1, 1]\n7\n')
+
+    def test_task_reads_a_block_name_after_its_last_mention(self):
+        source = ('let go = true;\nif go {\n    let data = [1, 2, 3];\n    print data.length;\n'
+                  '    print tasks("TASK", 2);\n}\n')
+        self.assertEqual(self.tasks('let result = data[0] + task;\n', source), '3\n[1, 2]\n')
+        source = 'for i in [1, 2] {\n    let data = [i];\n    print data;\n    print tasks("TASK", 1);\n}\n'
+        self.assertEqual(self.tasks('let result = data[0] + task;\n', source), '[1]\n[1]\n[2]\n[2]\n')
+
+    def test_task_in_a_hot_loop_reads_current_values(self):
+        source = ('let i = 0;\nlet seen = [];\nwhile i < 1500 {\n    i = i + 1;\n'
+                  '    if i % 500 == 0 { seen = seen + tasks("TASK", 1); }\n}\nprint seen;\n')
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'task.pn')
+            with open(path, 'w') as file:
+                file.write('let result = i;\n')
+            for tracing in (False, True):
+                with self.subTest(tracing=tracing):
+                    self.assertEqual(run(source.replace('TASK', path), tracing=tracing), '[500, 1000, 1500]\n')
+
+    def test_task_appends_to_a_string_the_caller_built(self):
+        task = 's = s + "-" + task;\nlet result = s;\n'
+        source = 'let s = "";\nfor i in range(0, 3) { s = s + i; }\nprint tasks("TASK", 2);\nprint s;\n'
+        self.assertEqual(self.tasks(task, source), '["012-0", "012-1"]\n012\n')
+        scope = main.Scope({'s': main.StringBuilder(['a', 'b'])})
+        self.assertIs(type(scope['s']), str)
+        self.assertIs(type(scope.get('s')), str)
+
+    def test_merge_rules_write_back_in_task_order(self):
+        ast = parse('kept = task;\nlet own = task * 10;\nlet same = 1;\n')
+        expected = {'discard': {'kept': 5}, 'new': {'kept': 5, 'own': 0, 'same': 1},
+                    'overwrite': {'kept': 2, 'own': 20, 'same': 1}}
+        for rule, merged in expected.items():
+            with self.subTest(rule=rule):
+                parent = {'kept': 5}
+                main.run_tasks(ast, parent, 3, lambda task: {'task': task}, merge=rule)
+                self.assertEqual(parent, merged)  # the bound `task` is never merged
+        with self.assertRaisesRegex(main.PNError, "Tasks 0 and 1 wrote different values to 'kept'"):
+            main.run_tasks(ast, {'kept': 5}, 3, lambda task: {'task': task}, merge='strict')
+        parent = {'kept': 5}
+        main.run_tasks(parse('let same = 1;\n'), parent, 3, lambda task: {'task': task}, merge='strict')
+        self.assertEqual(parent, {'kept': 5, 'same': 1})
+        with self.assertRaisesRegex(main.PNError, "Unknown merge rule 'last'"):
+            main.run_tasks(ast, {}, 1, lambda task: {}, merge='last')
+
+    def test_merge_tasks_writes_back_by_rule(self):
+        task = 'x = "t" + task;\nlet extra = task;\nlet result = task * 10;\n'
+        self.assertEqual(self.tasks(task, 'let x = 1;\nprint merge_tasks("TASK", 2, "new");\nprint x;\nprint extra;\n'),
+                         '[0, 10]\n1\n0\n')
+        # A hoisted, traced or type-specialized read of x would miss the merged value
+        source = ('let x = 1;\nlet i = 0;\nlet seen = [];\nwhile i < 1500 {\n    i = i + 1;\n'
+                  '    if i % 500 == 0 { seen = seen + [x + 1]; }\n'
+                  '    if i == 700 { print merge_tasks("TASK", 2, "overwrite"); }\n}\nprint seen;\n')
+        self.assertEqual(self.tasks(task, source), '[0, 10]\n[2, "t11", "t11"]\n')
+        with self.assertRaisesRegex(main.PNError, "line 1: Tasks 0 and 1 wrote different values to 'x'"):
+            self.tasks(task, 'merge_tasks("TASK", 2, "strict");\n')
+        with self.assertRaisesRegex(main.PNError, "merge_tasks\\(\\) rule must be a string, not int"):
+            self.tasks(task, 'merge_tasks("TASK", 2, 3);\n')
+
+    def test_deleted_name_is_absent_from_scope(self):
+        scope = main.Scope({'x': 1, 'y': 2})
+        scope.pop('x')
+        self.assertNotIn('x', scope)
+        self.assertIsNone(scope.get('x'))
+        with self.assertRaises(KeyError):
+            scope['x']
+        scope['x'] = 3
+        self.assertEqual((scope['x'], scope['y']), (3, 2))
+
+LIB_MODULE = 'let base = 10;\nlet double = x => x * 2 + base;\nprint "lib ran";\n'
+
+class MemoryReportTest(unittest.TestCase):
+    def test_report_leaves_the_run_unchanged(self):
+        source = ('let big = sort(range(0, 50000).map(x => 50000 - x));\nlet words = ["a", "b"];\n'
+                  'let n = big[0] + big.length;\nprint n;\n')
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'report.pn')
+            with open(path, 'w') as file:
+                file.write(source)
+            plain = main.run_file_captured(path)
+            reported = main.run_file_captured(path, memory=True)
+        self.assertEqual((reported['output'], reported['exit_code']), (plain['output'], 0))
+        self.assertEqual(plain['output'], '50001\n')
+        self.assertNotIn('memory', plain)
+        self.assertFalse(main.tracemalloc.is_tracing())
+        summary = reported['memory']
+        self.assertEqual(list(summary['phases']), ['lex', 'parse', 'execute'])
+        self.assertEqual(summary['tokens'], sum(1 for _ in main.Lexer(source).tokens))
+        self.assertGreater(summary['phases']['execute']['retained_bytes'], 50000 * 8)  # big is kept
+        self.assertEqual(summary['variables']['names'], 3)
+        self.assertEqual(summary['values'], {'int': 50001, 'array': 2, 'string': 2})
+        self.assertIn('execute peak', main.format_memory_report(summary))
+
+class OutputBufferTest(unittest.TestCase):
+    def test_pages_give_the_same_lines_as_the_whole_text(self):
+        pieces = [f'line {index} \u00e9' + '\n' * (index % 3) for index in range(300)] + ['tail']
+        settings = main.OUTPUT_PAGE_BYTES, main.OUTPUT_SPILL_BYTES, main.OUTPUT_CACHED_PAGES
+        main.OUTPUT_PAGE_BYTES, main.OUTPUT_SPILL_BYTES, main.OUTPUT_CACHED_PAGES = 64, 512, 2
+        buffer = main.OutputBuffer()
+        try:
+            text = ''
+            for piece in pieces:
+                buffer.append(piece)
+                text += piece
+                expected = text.split('\n')
+                if not expected[-1]:
+                    expected.pop()
+                self.assertEqual(len(buffer), len(expected))
+            self.assertGreater(len(buffer.offsets), 10)
+            self.assertGreater(buffer.size, main.OUTPUT_SPILL_BYTES)  # spilled to a temp file
+            for first in range(0, len(expected), 7):
+                self.assertEqual(buffer.lines(first, 5), expected[first:first + 5])
+            self.assertEqual(buffer.lines(len(expected) - 2, 5), ['', 'tail'])
+            for needle, start in (('line 150 ', 0), ('line 1', 100), ('line 2', 150), ('tail', 0)):
+                found = next(index for index in range(start, len(expected)) if needle in expected[index])
+                self.assertEqual(buffer.find(needle, start), found)
+            self.assertIsNone(buffer.find('line 2', len(expected)))
+        finally:
+            buffer.close()
+            main.OUTPUT_PAGE_BYTES, main.OUTPUT_SPILL_BYTES, main.OUTPUT_CACHED_PAGES = settings
+
+    def test_one_large_append_is_split_into_pages(self):
+        settings = main.OUTPUT_PAGE_BYTES, main.OUTPUT_CACHED_PAGES
+        main.OUTPUT_PAGE_BYTES, main.OUTPUT_CACHED_PAGES = 64, 2
+        buffer = main.OutputBuffer()
+        try:
+            text = 'head'
+            buffer.append(text)
+            self.assertEqual(buffer.lines(0, 1), ['head'])  # cached, then extended by the next append
+            for piece in ('\n'.join(f'row {index}' for index in range(500)) + '\n', 'x' * 300 + '\nend'):
+                buffer.append(piece)
+                text += piece
+            expected = text.split('\n')
+            self.assertGreater(len(buffer.offsets), 50)
+            self.assertLessEqual(max(len(buffer.read_page(page)) for page in range(len(buffer.offsets) - 2)), 64 + 8)
+            for first in range(0, len(expected), 3):
+                self.assertEqual(buffer.lines(first, 4), expected[first:first + 4])
+            self.assertEqual(buffer.find('row 321'), 321)
+        finally:
+            buffer.close()
+            main.OUTPUT_PAGE_BYTES, main.OUTPUT_CACHED_PAGES = settings
+
+class ModuleTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+    def write(self, name, source):
+        with open(os.path.join(self.directory, name), 'w') as file:
+            file.write(source)
+        return os.path.realpath(os.path.join(self.directory, name))
+
+    def run_file(self, name):
+        result = main.run_file_captured(os.path.join(self.directory, name))
+        return result['output'], result['error']
+
+    def test_imports_run_like_the_inlined_source(self):
+        self.write('lib.pn', LIB_MODULE)
+        self.write('a.pn', 'import "lib.pn";\nlet a = double(1);\n')
+        self.write('b.pn', 'import "lib.pn";\nlet b = double(2);\n')
+        self.write('main.pn', 'import "a.pn";\nimport "b.pn";\nprint a + b;\nprint base;\n')
+        inlined = run(LIB_MODULE + 'let a = double(1);\nlet b = double(2);\nprint a + b;\nprint base;\n')
+        self.assertEqual(inlined, 'lib ran\n26\n10\n')
+        self.assertEqual(self.run_file('main.pn'), (inlined, None))  # lib.pn runs once per run
+
+    def test_cached_module_is_reused_until_a_dependency_changes(self):
+        lib = self.write('lib.pn', LIB_MODULE)
+        a = self.write('a.pn', 'import "lib.pn";\nlet a = double(1);\n')
+        self.write('main.pn', 'import "a.pn";\nprint a;\n')
+        self.assertEqual(self.run_file('main.pn'), ('lib ran\n12\n', None))
+        cached = main.MODULES.modules[lib], main.MODULES.modules[a]
+        self.assertEqual(self.run_file('main.pn'), ('lib ran\n12\n', None))
+        self.assertIs(main.MODULES.modules[lib], cached[0])
+        self.assertIs(main.MODULES.modules[a], cached[1])
+        self.write('lib.pn', LIB_MODULE.replace('10', '100'))
+        self.assertEqual(self.run_file('main.pn'), ('lib ran\n102\n', None))
+        self.assertIsNot(main.MODULES.modules[a], cached[1])  # recompiled for its dependency
+
+    def test_circular_import_fails(self):
+        self.write('c1.pn', 'import "c2.pn";\n')
+        self.write('c2.pn', 'import "c1.pn";\n')
+        self.assertIn('Circular import: c2.pn -> c1.pn -> c2.pn', self.run_file('c1.pn')[1])
+
+class ReplTest(unittest.TestCase):
+    def test_inputs_run_like_one_program(self):
+        inputs = ['let s = "a";', 'for i in range(0, 3) {\n    s = s + i;\n}', 'import "lib.pn";',
+                  'let add = x => x + base;', 'print add(1);', 's', 'import "lib.pn";',
+                  'let n = 0;\nwhile n < 1500 {\n    n = n + 2;\n}\nprint n;', 's.length + n']
+        with tempfile.TemporaryDirectory() as directory:
+            with open(os.path.join(directory, 'lib.pn'), 'w') as file:
+                file.write('let base = 10;\nprint "lib ran";\n')
+            path = os.path.join(directory, 'whole.pn')
+            with open(path, 'w') as file:
+                file.write('\n'.join(text if text.endswith((';', '}')) else f'print {text};' for text in inputs))
+            session = main.ReplSession(directory)
+            output = io.StringIO()
+            with contextlib.redirect_stdout(output):
+                for text in inputs:
+                    session.run(text)
+            self.assertEqual(output.getvalue(), 'lib ran\n11\na012\n1500\n1504\n')
+            self.assertEqual(main.run_file_captured(path)['output'], output.getvalue())
+
+    def test_reimport_keeps_one_module_entry(self):
+        with tempfile.TemporaryDirectory() as directory:
+            with open(os.path.join(directory, 'mod.pn'), 'w') as file:
+                file.write('let m = 1;\n')
+            session = main.ReplSession(directory)
+            for _ in range(3):
+                session.run('import "mod.pn";')
+            self.assertEqual(len(session.compiler.modules), 1)
+
+    def test_reset_clears_session_and_module_cache(self):
+        with tempfile.TemporaryDirectory() as directory:
+            with open(os.path.join(directory, 'mod.pn'), 'w') as file:
+                file.write('let m = 1;\n')
+            session = main.ReplSession(directory)
+            session.run('import "mod.pn";')
+            main.reset_session(session)
+            self.assertEqual((session.compiler.modules, main.MODULES.modules), ({}, {}))
+            with self.assertRaisesRegex(main.PNError, "'m' is not defined"):
+                session.run('print m;')
+
+class RunQueueTest(unittest.TestCase):
+    def finish(self, queue, run):
+        output = []
+        while run.finished is None:
+            output += [data for kind, changed, data in queue.poll(0.05) if changed is run and kind == 'output']
+        return ''.join(output)
+
+    def test_rerun_reparses_only_the_edit_on_any_worker(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'edit.pn')
+            with open(path, 'w') as file:
+                file.write('let a = 1;\nprint a;\nprint a + 1;\n')
+            queue = main.RunQueue(2)
+            try:
+                self.assertEqual(self.finish(queue, queue.submit(path)), '1\n2\n')
+                busy = queue.submit(path)  # keeps the first worker's slot busy
+                busy.parsed.result()
+                with open(path, 'w') as file:
+                    file.write('let a = 5;\nprint a;\nprint a + 1;\n')
+                self.assertEqual(self.finish(queue, queue.submit(path)), '5\n6\n')
+                self.finish(queue, busy)
+                self.assertEqual(queue.parsers[os.path.abspath(path)].reparsed, 1)
+            finally:
+                queue.close()
+
+    def test_workers_do_not_inherit_locks_held_by_other_threads(self):
+        with tempfile.TemporaryDirectory() as directory:
+            with open(os.path.join(directory, 'lib.pn'), 'w') as file:
+                file.write('let base = 3;\n')
+            path = os.path.join(directory, 'main.pn')
+            with open(path, 'w') as file:
+                file.write('import "lib.pn";\nprint base;\n')
+            held, release = threading.Event(), threading.Event()
+
+            def hold():
+                with main.MODULES.lock:  # e.g. the REPL importing while the worker starts
+                    held.set()
+                    release.wait()
+            holder = threading.Thread(target=hold)
+            holder.start()
+            held.wait()
+            queue = main.RunQueue(1)
+            try:
+                run = queue.submit(path)
+                run.parsed.result()
+                queue.poll(0)  # dispatches the run, starting the worker process
+                release.set()
+                holder.join()
+                output = []
+                deadline = time.monotonic() + 10
+                while run.finished is None and time.monotonic() < deadline:
+                    output += [data for kind, changed, data in queue.poll(0.05) if changed is run and kind == 'output']
+                self.assertEqual(''.join(output), '3\n')
+            finally:
+                release.set()
+                queue.close()
+
+class ServerTest(unittest.TestCase):
+    def exchange(self, requests):
+        # (output, exit frame) of each (source, timeout) sent in turn over one connection;
+        # a request given as a one-item tuple is sent as that JSON value
+        async def send(reader, writer, request):
+            if len(request) == 2:
+                return await server.submit(reader, writer, *request)
+            writer.write(server.encode_frame(request[0]))
+            return '', await server.read_frame(reader)
+
+        async def session():
+            listener, pool = await server.start_server('127.0.0.1', 0, 1)
+            try:
+                reader, writer = await asyncio.open_connection('127.0.0.1', listener.sockets[0].getsockname()[1])
+                try:
+                    return [await send(reader, writer, request) for request in requests]
+                finally:
+                    writer.close()
+            finally:
+                listener.close()
+                await listener.wait_closed()
+                await pool.close()
+        return asyncio.run(session())
+
+    def test_bad_timeout_is_answered_and_the_connection_kept(self):
+        results = self.exchange([('print 1;', None), ('print 2;', 'soon'), ('print 3;', float('nan')),
+                                 ('print 4;', 5)])
+        for output, frame in results[:3]:
+            self.assertEqual((output, frame['exit_code']), ('', 2))
+            self.assertRegex(frame['error'], '^Bad request: timeout must')
+        self.assertEqual((results[3][0], results[3][1]['exit_code']), ('4\n', 0))
+
+    def test_request_that_is_not_an_object_is_answered(self):
+        results = self.exchange([([],), ('x',), (3,), ('print 1;', 5)])
+        for output, frame in results[:3]:
+            self.assertEqual((output, frame['exit_code']), ('', 2))
+            self.assertRegex(frame['error'], '^Bad request: expected a JSON object')
+        self.assertEqual((results[3][0], results[3][1]['exit_code']), ('1\n', 0))
+
+    def test_program_reading_stdin_gets_no_input(self):
+        results = self.exchange([('print stdin.length;', 2), ('print "next";', 2)])
+        self.assertEqual([(output, frame['exit_code']) for output, frame in results], [('0\n', 0), ('next\n', 0)])
+
+if __name__ == "__main__":
+    unittest.main()